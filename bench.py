@@ -0,0 +1,520 @@
+import argparse
+import gc
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import platform
+
+import numpy as np
+import Tkinter as tk
+
+from brush import Brush
+from model import Model
+from model_canvas import ModelCanvas
+from model_canvas_layer import ViewLayer, SelectLayer
+from journal import Journal
+from item_pool import ItemPool
+import grid
+import raster
+import rbd_io
+import instrument
+
+""" Headless benchmarks of the designer's hot paths: model editing, grid conversions and rotations, file export
+and import, and layer updates.
+Each benchmark runs on synthetic models (see make_model()) of each of the requested sizes and reports the best
+of several runs. The layers draw on a StubCanvas, which needs a Tcl interpreter but no display, so the
+benchmarks run anywhere the designer's modules can be imported.
+Results are written as JSON to --output. Given a --baseline (by default bench_baseline.json, if it exists)
+written earlier with --save-baseline, each result is compared with the baseline's and the regressions beyond
+--tolerance are listed; the exit status is 1 if there are any.
+
+  python bench.py                              run every benchmark on 1e3, 1e4 and 1e5 particles
+  python bench.py --sizes 1000,1000000 model.  the model benchmarks on 1e3 and 1e6 particles
+  python bench.py --save-baseline bench_baseline.json
+"""
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+## Benchmarks timing one operation per particle do at most this many operations, on a model of the full size
+MAX_OPS = 20000
+## Regressions are ignored when the difference is less than this many seconds, as such timings are mostly noise
+MIN_DIFFERENCE = 0.002
+
+
+#### Synthetic models
+
+def make_specs(ptypes, bodies):
+  """ Returns lists of ptypes ParticleSpecs and bodies BodySpecs. """
+  particle_specs = [Brush.ParticleSpecs(name = 'P{0}'.format(i), color = '#{0:06X}'.format((i * 0x3D1F55) & 0xFFFFFF)) for i in range(ptypes)]
+  body_specs = [Brush.BodySpecs(idx = i, color = '#{0:06X}'.format((i * 0x1F3D77) & 0xFFFFFF)) for i in range(bodies)]
+  return particle_specs, body_specs
+
+def make_model(size, ptypes = 4, bodies = 16, grid_type = grid.GRID_SQUARE, fill = 0.8, seed = 0):
+  """ Returns a model of size particles scattered at random over a square filling the given fraction of its
+  cells. Particle types are random, and bodies are horizontal bands so each body is contiguous. """
+  rng = np.random.RandomState(seed)
+  side = int(math.ceil(math.sqrt(size / fill)))
+  cells = rng.permutation(side * side)[:size]
+  xs, ys = (cells % side).astype(np.int32), (cells // side).astype(np.int32)
+  particle_specs, body_specs = make_specs(ptypes, bodies)
+  model = Model(grid_type)
+  ## The specs are registered in order, so their ids are their positions in the lists
+  for specs in particle_specs:  model._particle_specs_id(specs)
+  for specs in body_specs:  model._body_specs_id(specs)
+  model._load_rows(xs, ys, rng.randint(0, ptypes, size).astype(np.int32), (ys * bodies // side).astype(np.int32))
+  return model
+
+def random_gridcoords(model, count, seed = 1):
+  """ Returns count grid coordinates of particles of the model, chosen at random. """
+  rows = np.random.RandomState(seed).choice(len(model), min(count, len(model)), replace = False)
+  return zip(model.xs[rows].tolist(), model.ys[rows].tolist())
+
+
+#### Stub canvas
+
+class StubCanvas(object):
+  """ Stands in for a ModelCanvas without a display. Items are not kept: creating an item returns a new id and
+  every other canvas command does nothing, so the layers' own work is timed rather than Tk's. Commands the
+  layers send to Tcl are run by a real interpreter, in which the canvas is a Tcl procedure doing the same.
+  Callbacks queued with after() and after_idle() run when run_idle() is called. """
+
+  def __init__(self, width = 1024, height = 768):
+    self.tk = tk.Tcl().tk
+    self._w = '.c'
+    self.tk.eval('set ::next_item 0\n'
+        'proc .c {command args} { if {$command eq "create"} { return [incr ::next_item] } }\n'
+        'proc bind args {}')
+    self._options = dict(scrollregion = '')
+    self._width, self._height = width, height
+    self._idle = []
+    self._layers = []
+    self.journal = Journal()
+    self.item_pool = ItemPool(self)
+    self._pending_updates = []
+    self._frame_id = None
+    self._last_frame = 0.0
+    self.frame_interval = 0
+    self.update_stats = dict(requested = 0, coalesced = 0, delayed = 0, dropped = 0, frames = 0, updates = 0)
+
+  def __getitem__(self, key):
+    return self._options[key]
+  def __setitem__(self, key, value):
+    if isinstance(value, (tuple, list)):  value = ' '.join([str(float(v)) for v in value])
+    self._options[key] = value
+
+  def canvasx(self, x):
+    return float(x)
+  def canvasy(self, y):
+    return float(y)
+  def winfo_width(self):
+    return self._width
+  def winfo_height(self):
+    return self._height
+
+  def after(self, ms, func = None, *args):
+    if func != None:  self._idle.append((func, args))
+    return 'after#{0}'.format(len(self._idle))
+  def after_idle(self, func, *args):
+    return self.after(0, func, *args)
+  def after_cancel(self, id):
+    pass
+  def run_idle(self):
+    while len(self._idle) > 0:
+      func, args = self._idle.pop(0)
+      func(*args)
+
+  def bind(self, sequence, func, add = None):
+    return 'stub{0}'.format(id(func))
+  def bind_class(self, tag, sequence, func, add = None):
+    return self.bind(sequence, func)
+  def bindtags(self):
+    return (self._w, 'all')
+  def find_withtag(self, tag):
+    return ()
+  def gettags(self, item):
+    return ()
+  def coords(self, item, *args):
+    return [] if len(args) == 0 else None
+  def create_image(self, *args, **kargs):
+    return int(self.tk.call(self._w, 'create', 'image'))
+
+  def _ignore(self, *args, **kargs):
+    pass
+  itemconfigure = itemconfig = addtag_withtag = dtag = tag_raise = tag_lower = delete = move = scale = _ignore
+  deletecommand = event_add = event_generate = _ignore
+
+for _name in ('top_layer', 'background_layer', 'push_layer', 'pop_layer', 'start_layer', 'merge_top_layer',
+    'cancel_top_layer', 'restack_layers', 'update_layer', 'run_frame'):
+  setattr(StubCanvas, _name, ModelCanvas.__dict__[_name])
+
+def start_layer(layer_class, model, **kargs):
+  """ Returns a started layer of the given class showing the model as ovals on a new StubCanvas, drawn once. """
+  canvas = StubCanvas()
+  layer = layer_class(canvas, model, **kargs)
+  layer.render_mode = 'ovals'
+  canvas.push_layer(layer)
+  layer.start()
+  canvas.run_idle()
+  return layer
+
+
+#### Benchmarks
+
+## Registered benchmarks, in the order they run: (name, setup function, largest size or None)
+BENCHMARKS = []
+
+def benchmark(name, max_size = None):
+  """ Decorator registering a benchmark. The decorated function is called with a model size, prepares
+  everything the benchmark needs, and returns the function to time and the number of operations it does. """
+  def register(setup):
+    BENCHMARKS.append((name, setup, max_size))
+    return setup
+  return register
+
+## Model
+
+@benchmark('model.add_particle')
+def bench_add_particle(size):
+  model = make_model(size)
+  particle_specs, body_specs = model.particle_specs_table, model.body_specs_table
+  bbox = model.calc_bbox()
+  gridcoords = [(bbox[2] + i % 256, bbox[1] + i // 256) for i in xrange(min(size, MAX_OPS))]
+  def run():
+    for i, gridcoord in enumerate(gridcoords):
+      model.add_particle(gridcoord, particle_specs[i % len(particle_specs)], body_specs[i % len(body_specs)])
+  return run, len(gridcoords)
+
+@benchmark('model.remove_particle')
+def bench_remove_particle(size):
+  model = make_model(size)
+  gridcoords = random_gridcoords(model, MAX_OPS)
+  def run():
+    for gridcoord in gridcoords:
+      model.remove_particle(gridcoord)
+  return run, len(gridcoords)
+
+@benchmark('model.set_particle_type')
+def bench_set_particle_type(size):
+  model = make_model(size)
+  particle_specs = model.particle_specs_table
+  gridcoords = random_gridcoords(model, MAX_OPS)
+  def run():
+    for i, gridcoord in enumerate(gridcoords):
+      model.set_particle_type(gridcoord, particle_specs[i % len(particle_specs)])
+  return run, len(gridcoords)
+
+@benchmark('model.transaction')
+def bench_transaction(size):
+  model = make_model(size)
+  particle_specs, body_specs = model.particle_specs_table, model.body_specs_table
+  gridcoords = random_gridcoords(model, MAX_OPS)
+  def run():
+    with model.transaction():
+      for i, gridcoord in enumerate(gridcoords):
+        if i % 2 == 0:
+          model.remove_particle(gridcoord)
+        else:
+          model.add_particle(gridcoord, particle_specs[0], body_specs[i % len(body_specs)])
+    model.calc_bbox()
+  return run, len(gridcoords)
+
+@benchmark('model.particles_setter')
+def bench_particles_setter(size):
+  particles = make_model(size).particles
+  model = Model()
+  def run():
+    model.particles = particles
+  return run, len(particles)
+
+@benchmark('model.set_type_ids_at')
+def bench_set_type_ids_at(size):
+  source = make_model(size, seed = 2)
+  model = make_model(size)
+  ptype_ids, body_ids = source.particle_type_ids.copy(), source.body_ids.copy()
+  xs, ys = source.xs.copy(), source.ys.copy()
+  def run():
+    model.set_type_ids_at(xs, ys, ptype_ids, body_ids)
+  return run, len(xs)
+
+@benchmark('model.copy_on_write')
+def bench_copy_on_write(size):
+  model = make_model(size)
+  particle_specs = model.particle_specs_table
+  gridcoords = random_gridcoords(model, 100)
+  def run():
+    copy = model.copy()
+    for gridcoord in gridcoords:
+      copy.set_particle_type(gridcoord, particle_specs[0])
+  return run, len(gridcoords)
+
+@benchmark('model.particles_in_bbox')
+def bench_particles_in_bbox(size):
+  model = make_model(size)
+  x0, y0, x1, y1 = model.calc_bbox()
+  box = (x0, y0, (x0 + x1) // 2, (y0 + y1) // 2)
+  def run():
+    model.particles_in_bbox(box)
+  return run, model.count_in_bbox(box)
+
+@benchmark('model.connected_body')
+def bench_connected_body(size):
+  model = make_model(size, bodies = 4)
+  gridcoord = random_gridcoords(model, 1)[0]
+  def run():
+    model.calc_connected_body_particles(gridcoord)
+  return run, len(model.body_gridcoords(model.get_body_type(gridcoord)))
+
+## Grid
+
+def grid_arrays(size, grid_type):
+  model = make_model(size, grid_type = grid_type)
+  return model.grid, model.xs.copy(), model.ys.copy()
+
+for _grid_type, _grid_name in ((grid.GRID_SQUARE, 'square'), (grid.GRID_HEX_HORIZ, 'hex')):
+  def bench_to_pixels(size, grid_type = _grid_type):
+    g, xs, ys = grid_arrays(size, grid_type)
+    return (lambda: g.gridcoords_to_pixels(xs, ys, 20.0)), size
+  def bench_to_gridcoords(size, grid_type = _grid_type):
+    g, xs, ys = grid_arrays(size, grid_type)
+    pxs, pys = g.gridcoords_to_pixels(xs, ys, 20.0)
+    pxs, pys = pxs + 3.0, pys + 3.0
+    return (lambda: g.pixels_to_gridcoords(pxs, pys, 20.0)), size
+  def bench_rotate(size, grid_type = _grid_type):
+    g, xs, ys = grid_arrays(size, grid_type)
+    return (lambda: g.rotate_gridcoords_array(xs, ys, (int(xs[0]), int(ys[0])), 1)), size
+  def bench_rotate_dict(size, grid_type = _grid_type):
+    g, xs, ys = grid_arrays(size, grid_type)
+    gridcoords = zip(xs.tolist(), ys.tolist())
+    return (lambda: g.rotate_gridcoords(gridcoords, gridcoords[0], 1)), size
+  def bench_to_pixel_scalar(size, grid_type = _grid_type):
+    g, xs, ys = grid_arrays(size, grid_type)
+    gridcoords = zip(xs.tolist(), ys.tolist())[:MAX_OPS]
+    def run():
+      for gridcoord in gridcoords:
+        g.gridcoord_to_pixel(gridcoord, 20.0)
+    return run, len(gridcoords)
+  benchmark('grid.{0}.gridcoords_to_pixels'.format(_grid_name))(bench_to_pixels)
+  benchmark('grid.{0}.pixels_to_gridcoords'.format(_grid_name))(bench_to_gridcoords)
+  benchmark('grid.{0}.gridcoord_to_pixel'.format(_grid_name))(bench_to_pixel_scalar)
+  benchmark('grid.{0}.rotate_gridcoords_array'.format(_grid_name))(bench_rotate)
+  benchmark('grid.{0}.rotate_gridcoords'.format(_grid_name))(bench_rotate_dict)
+
+## File export and import
+
+class _StubToolBox(object):
+  def set_particle_specs(self, specs):
+    self.particle_specs = specs
+  def set_body_specs(self, specs):
+    self.body_specs = specs
+  def set_models(self, models):
+    self.models = models
+
+class _StubDesignBox(object):
+  def __init__(self):
+    self.canvas = StubCanvas()
+
+class _StubApplication(object):
+  """ The parts of the application import_rbd() uses. """
+  def __init__(self):
+    self.design_box = _StubDesignBox()
+    self.tool_box = _StubToolBox()
+
+def export_models(size):
+  """ Returns two models of half the size each, one on each kind of grid, and the number of copies of each. """
+  return [make_model(size // 2), make_model(size - size // 2, grid_type = grid.GRID_HEX_HORIZ, seed = 3)], [1, 1]
+
+@benchmark('io.export_xml')
+def bench_export_xml(size):
+  models, copies = export_models(size)
+  path = os.path.join(tempfile.mkdtemp(), 'bench.xml')
+  return (lambda: rbd_io.export_xml(path, models, copies)), size
+
+@benchmark('io.export_rbd')
+def bench_export_rbd(size):
+  models, copies = export_models(size)
+  particle_specs, body_specs = models[0].particle_specs_table, models[0].body_specs_table
+  path = os.path.join(tempfile.mkdtemp(), 'bench.rbd')
+  return (lambda: rbd_io.export_rbd(path, models, particle_specs, body_specs)), size
+
+@benchmark('io.import_rbd')
+def bench_import_rbd(size):
+  models, copies = export_models(size)
+  path = os.path.join(tempfile.mkdtemp(), 'bench.rbd')
+  rbd_io.export_rbd(path, models, models[0].particle_specs_table, models[0].body_specs_table)
+  return (lambda: rbd_io.import_rbd(path, _StubApplication())), size
+
+@benchmark('io.lattice_positions')
+def bench_lattice_positions(size):
+  ## Many copies of a few small models, as for a simulation box
+  models = [make_model(n, seed = n) for n in (20, 50, 100)]
+  copies = [max(1, size // 170)] * len(models)
+  return (lambda: rbd_io.calc_model_lattice_positions(models, copies)), sum(copies)
+
+## Layers
+
+@benchmark('layer.view.start', max_size = 100000)
+def bench_view_start(size):
+  model = make_model(size)
+  canvas = StubCanvas()
+  def run():
+    layer = ViewLayer(canvas, model)
+    layer.render_mode = 'ovals'
+    canvas.push_layer(layer)
+    layer.start()
+    canvas.run_idle()
+  return run, size
+
+@benchmark('layer.view.model_change', max_size = 100000)
+def bench_view_model_change(size):
+  layer = start_layer(ViewLayer, make_model(size))
+  model, canvas = layer.model, layer.canvas
+  particle_specs = model.particle_specs_table
+  gridcoords = random_gridcoords(model, max(1, size // 100))
+  def run():
+    with model.transaction():
+      for gridcoord in gridcoords:
+        model.set_particle_type(gridcoord, particle_specs[0])
+    model.notify(gridcoords)
+    canvas.run_idle()
+  return run, len(gridcoords)
+
+@benchmark('layer.view.zoom', max_size = 100000)
+def bench_view_zoom(size):
+  layer = start_layer(ViewLayer, make_model(size), viewmode = 'none')
+  def run():
+    for zoom in (1.1, 1.2, 1.3, 1.2, 1.1, 1.0):
+      layer.zoom = zoom
+    layer.canvas.run_idle()
+  return run, size
+
+@benchmark('layer.select.start', max_size = 100000)
+def bench_select_start(size):
+  model = make_model(size)
+  canvas = StubCanvas()
+  def run():
+    layer = SelectLayer(canvas, model)
+    canvas.push_layer(layer)
+    layer.start()
+    canvas.run_idle()
+  return run, size
+
+@benchmark('layer.select.new_selection', max_size = 100000)
+def bench_select_new_selection(size):
+  layer = start_layer(SelectLayer, make_model(size))
+  selections = [[layer.get_particle_at(gridcoord) for gridcoord in random_gridcoords(layer.model, max(1, size // 10), seed)] for seed in (1, 2)]
+  def run():
+    for particles in selections:
+      layer.new_selection(particles)
+      layer.canvas.run_idle()
+  return run, sum([len(particles) for particles in selections])
+
+@benchmark('raster.render_image')
+def bench_render_image(size):
+  model = make_model(size)
+  diameters = (20.0, 2.0, 0.5) # one per level of detail
+  def run():
+    for diameter in diameters:
+      raster.render_image(model, 0, 0, 1024, 768, diameter)
+  return run, len(diameters)
+
+
+#### Running and comparing
+
+class _NullWriter(object):
+  def write(self, text):
+    pass
+
+def time_benchmark(setup, size, repeat):
+  """ Returns the best time of repeat runs of the benchmark in seconds, and its number of operations.
+  Each run has a fresh setup, and output printed by the code under test is discarded. """
+  best = None
+  for i in range(repeat):
+    stdout, sys.stdout = sys.stdout, _NullWriter()
+    try:
+      run, ops = setup(size)
+      gc.collect()
+      start = time.time()
+      run()
+      elapsed = time.time() - start
+    finally:
+      sys.stdout = stdout
+    best = elapsed if best == None else min(best, elapsed)
+  return best, ops
+
+def run_benchmarks(sizes, repeat, patterns):
+  results = []
+  for name, setup, max_size in BENCHMARKS:
+    if len(patterns) > 0 and not any([pattern in name for pattern in patterns]):
+      continue
+    for size in sizes:
+      if max_size != None and size > max_size:
+        continue
+      seconds, ops = time_benchmark(setup, size, repeat)
+      result = dict(name = name, size = size, ops = ops, seconds = seconds, us_per_op = seconds * 1e6 / max(ops, 1))
+      print '{0:<40} {1:>8} {2:>10.2f} ms {3:>10.3f} us/op'.format(name, size, seconds * 1000, result['us_per_op'])
+      sys.stdout.flush()
+      results.append(result)
+  return results
+
+def compare(results, baseline, tolerance):
+  """ Prints each result's time relative to the baseline's result of the same name and size, and returns the
+  results slower than the baseline by more than the tolerance (a fraction) and MIN_DIFFERENCE seconds. """
+  old = dict([((r['name'], r['size']), r) for r in baseline['results']])
+  regressions = []
+  print
+  print '{0:<40} {1:>8} {2:>12} {3:>12} {4:>7}'.format('compared with baseline', 'size', 'baseline ms', 'now ms', 'ratio')
+  for r in results:
+    base = old.get((r['name'], r['size']))
+    if base == None:
+      continue
+    ratio = r['seconds'] / max(base['seconds'], 1e-9)
+    regressed = ratio > 1 + tolerance and r['seconds'] - base['seconds'] > MIN_DIFFERENCE
+    if regressed:  regressions.append(r)
+    print '{0:<40} {1:>8} {2:>12.2f} {3:>12.2f} {4:>7.2f}{5}'.format(r['name'], r['size'], base['seconds'] * 1000,
+        r['seconds'] * 1000, ratio, '  REGRESSION' if regressed else '')
+  return regressions
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = 'Headless benchmarks of the rigid body designer.')
+  parser.add_argument('patterns', nargs = '*', help = 'run only the benchmarks whose names contain one of these')
+  parser.add_argument('--sizes', default = ','.join([str(s) for s in DEFAULT_SIZES]),
+      help = 'comma separated numbers of particles (default %(default)s)')
+  parser.add_argument('--repeat', type = int, default = 3, help = 'runs of each benchmark, the best is kept (default %(default)s)')
+  parser.add_argument('--output', default = 'bench_output.txt', help = 'file the JSON results are written to (default %(default)s)')
+  parser.add_argument('--baseline', help = 'JSON results to compare with (default {0}, if it exists)'.format(DEFAULT_BASELINE))
+  parser.add_argument('--save-baseline', metavar = 'FILE', help = 'also write the results to FILE as the new baseline')
+  parser.add_argument('--tolerance', type = float, default = 0.25, help = 'slowdown counted as a regression (default %(default)s)')
+  parser.add_argument('--stats', action = 'store_true', help = 'turn on instrumentation and print its report at the end')
+  args = parser.parse_args(argv)
+
+  sizes = [int(float(s)) for s in args.sizes.split(',')]
+  if args.stats:  instrument.enable()
+  results = run_benchmarks(sizes, args.repeat, args.patterns)
+  if args.stats:
+    print
+    print instrument.report()
+
+  output = dict(meta = dict(time = time.strftime('%Y-%m-%d %H:%M:%S'), python = platform.python_version(),
+      numpy = np.__version__, machine = platform.machine(), sizes = sizes, repeat = args.repeat), results = results)
+  for path in (args.output, args.save_baseline):
+    if path != None:
+      with open(path, 'w') as f:
+        json.dump(output, f, indent = 1, sort_keys = True)
+
+  baseline_path = args.baseline
+  if baseline_path == None and os.path.exists(DEFAULT_BASELINE) and args.save_baseline != DEFAULT_BASELINE:
+    baseline_path = DEFAULT_BASELINE
+  if baseline_path != None:
+    with open(baseline_path) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    if len(regressions) > 0:
+      print '{0} regression(s) beyond {1:.0%}'.format(len(regressions), args.tolerance)
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,175 @@
+import numpy as np
+
+""" Contiguity checks for the rigid bodies in a Model.
+A rigid body is expected to be a single group of particles connected through neighboring grid
+cells (4-connected on a square grid). analyze_bodies() finds the connected components of every
+body at once with a vectorized union-find over the model's coordinate arrays, and reports
+  - split bodies: bodies made of more than one connected component
+  - isolated particles: particles with no neighbor in their own body, in a body of several particles
+  - touching bodies: pairs of different bodies with neighboring particles
+"""
+
+## Bounding boxes up to this many times the particle count are looked up with a dense grid of rows;
+## sparser models fall back to sorting packed coordinates.
+DENSE_LOOKUP_RATIO = 8
+
+class BodyReport(object):
+  """ The result of analyze_bodies().
+    split_bodies: dict mapping each split BodySpecs to its number of components
+    isolated: list of grid coordinates of isolated particles
+    touching: set of (BodySpecs, BodySpecs) pairs of touching bodies
+  The components of a split body are only turned into grid coordinate sets on request, with components().
+  """
+  def __init__(self, xs, ys, bodies, labels, body_table, split_bodies, isolated, touching):
+    self._xs = xs
+    self._ys = ys
+    self._bodies = bodies
+    self._labels = labels
+    self._body_table = body_table
+    self.split_bodies = split_bodies
+    self.isolated = isolated
+    self.touching = touching
+
+  @property
+  def ok(self):
+    """ True iff every body is contiguous. Touching bodies are allowed. """
+    return len(self.split_bodies) == 0 and len(self.isolated) == 0
+
+  def _body_rows(self, body_specs):
+    """ Returns the rows of a body's particles sorted by component, and the component sizes, largest first. """
+    rows = np.nonzero(self._bodies == self._body_table.index(body_specs))[0]
+    labels, inverse, sizes = np.unique(self._labels[rows], return_inverse = True, return_counts = True)
+    rank = np.argsort(-sizes, kind = 'mergesort')
+    order = np.empty_like(rank)
+    order[rank] = np.arange(len(rank))
+    rows = rows[np.argsort(order[inverse], kind = 'mergesort')]
+    return rows, sizes[rank]
+
+  def components(self, body_specs):
+    """ Returns the components of the given body as a list of sets of grid coordinates, largest first. """
+    rows, sizes = self._body_rows(body_specs)
+    groups = np.split(rows, np.cumsum(sizes)[:-1])
+    return [set(zip(self._xs[g].tolist(), self._ys[g].tolist())) for g in groups]
+
+  def problem_gridcoords(self):
+    """ Returns the set of grid coordinates worth highlighting: every component of a split body
+    except its largest, and every isolated particle. """
+    gridcoords = set(self.isolated)
+    for body_specs in self.split_bodies:
+      rows, sizes = self._body_rows(body_specs)
+      rows = rows[sizes[0]:]
+      gridcoords.update(zip(self._xs[rows].tolist(), self._ys[rows].tolist()))
+    return gridcoords
+
+  def summary(self):
+    lines = []
+    for specs, num_components in self.split_bodies.iteritems():
+      sizes = self._body_rows(specs)[1]
+      lines.append('Body {0} is split into {1} pieces (largest {2}, smallest {3})'.format(
+        specs.idx, num_components, sizes[0], sizes[-1]))
+    if len(self.isolated) > 0:
+      lines.append('{0} isolated particle(s), e.g. at {1}'.format(len(self.isolated), self.isolated[0]))
+    if len(self.touching) > 0:
+      pairs = sorted([(a.idx, b.idx) for a, b in self.touching])
+      lines.append('Touching bodies: ' + ', '.join(['{0}-{1}'.format(a, b) for a, b in pairs]))
+    return '\n'.join(lines) if lines else 'All bodies are contiguous'
+
+def analyze_bodies(model):
+  """ Checks the contiguity of every body in the model, returning a BodyReport. """
+  xs = model.xs.astype(np.int64)
+  ys = model.ys.astype(np.int64)
+  bodies = model.body_ids.copy()
+  body_table = list(model.body_specs_table)
+  n = len(xs)
+  if n == 0:
+    return BodyReport(xs, ys, bodies, bodies, body_table, dict(), [], set())
+
+  ## Find all pairs (i, j) of rows holding neighboring particles
+  lookup = _row_lookup(xs, ys, model.calc_bbox())
+  pairs_i = []
+  pairs_j = []
+  for nxs, nys in model.grid.forward_neighbors(xs, ys):
+    rows = lookup(nxs, nys)
+    found = rows >= 0
+    pairs_i.append(np.nonzero(found)[0])
+    pairs_j.append(rows[found])
+  pairs_i = np.concatenate(pairs_i)
+  pairs_j = np.concatenate(pairs_j)
+
+  same = bodies[pairs_i] == bodies[pairs_j]
+  labels = _connected_components(n, pairs_i[same], pairs_j[same])
+
+  ## Split bodies: more than one distinct component label within a body
+  body_sizes = np.bincount(bodies, minlength = len(body_table))
+  body_label_pairs = np.unique(bodies.astype(np.int64) * n + labels)
+  components_per_body = np.bincount(body_label_pairs // n, minlength = len(body_table))
+  split_bodies = dict()
+  for body in np.nonzero(components_per_body > 1)[0].tolist():
+    split_bodies[body_table[body]] = int(components_per_body[body])
+
+  ## Isolated particles: no same-body neighbor, but the body has other particles
+  degree = np.bincount(pairs_i[same], minlength = n) + np.bincount(pairs_j[same], minlength = n)
+  isolated_rows = np.nonzero((degree == 0) & (body_sizes[bodies] > 1))[0]
+  isolated = zip(xs[isolated_rows].tolist(), ys[isolated_rows].tolist())
+
+  ## Touching bodies: neighboring particles with different bodies
+  bi = bodies[pairs_i[~same]]
+  bj = bodies[pairs_j[~same]]
+  touching_pairs = np.unique(np.minimum(bi, bj).astype(np.int64) * len(body_table) + np.maximum(bi, bj))
+  touching = set([(body_table[k // len(body_table)], body_table[k % len(body_table)]) for k in touching_pairs.tolist()])
+
+  return BodyReport(xs, ys, bodies, labels, body_table, split_bodies, isolated, touching)
+
+def _row_lookup(xs, ys, bbox):
+  """ Returns a function mapping arrays of grid coordinates to the rows holding them (-1 if absent). """
+  min_x, min_y, max_x, max_y = bbox
+  width = max_x - min_x
+  height = max_y - min_y
+
+  def inside(qxs, qys):
+    return (qxs >= min_x) & (qxs < max_x) & (qys >= min_y) & (qys < max_y)
+
+  if width * height <= DENSE_LOOKUP_RATIO * len(xs):
+    dense = np.full((width, height), -1, dtype = np.int64)
+    dense[xs - min_x, ys - min_y] = np.arange(len(xs))
+    def lookup(qxs, qys):
+      rows = np.full(len(qxs), -1, dtype = np.int64)
+      ok = inside(qxs, qys)
+      rows[ok] = dense[qxs[ok] - min_x, qys[ok] - min_y]
+      return rows
+  else:
+    keys = (xs - min_x) * height + (ys - min_y)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    def lookup(qxs, qys):
+      rows = np.full(len(qxs), -1, dtype = np.int64)
+      ok = inside(qxs, qys)
+      qkeys = (qxs[ok] - min_x) * height + (qys[ok] - min_y)
+      pos = np.minimum(np.searchsorted(sorted_keys, qkeys), len(sorted_keys) - 1)
+      hit = sorted_keys[pos] == qkeys
+      found = np.full(len(qkeys), -1, dtype = np.int64)
+      found[hit] = order[pos[hit]]
+      rows[ok] = found
+      return rows
+  return lookup
+
+def _connected_components(n, edges_i, edges_j):
+  """ Vectorized union-find: returns an array giving each of the n nodes the smallest node index
+  in its connected component. Roots are hooked onto smaller roots across every edge, then
+  paths are fully compressed, until no edge joins two different roots. """
+  parent = np.arange(n)
+  while True:
+    ri = parent[edges_i]
+    rj = parent[edges_j]
+    differ = ri != rj
+    if not differ.any():
+      return parent
+    lo = np.minimum(ri[differ], rj[differ])
+    hi = np.maximum(ri[differ], rj[differ])
+    ## Conflicting writes to the same root keep one of the candidates; the others are retried next round
+    parent[hi] = lo
+    while True:
+      grandparent = parent[parent]
+      if (grandparent == parent).all():
+        break
+      parent = grandparent
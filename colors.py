@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+import utils
+
+""" Interned colors and cached color arithmetic, for drawing many particles in a few colors.
+Colors are Tk color strings such as '#F80'. rgb() parses each distinct string only once, interning it as a
+tuple of 0-255 integers, and blend() keeps its results in a least-recently-used cache of up to MAX_BLENDS
+entries keyed by (color, target, weight), so blending a layer's particles toward white when it is paused
+costs a dictionary lookup per particle. Entries are keyed by color value and so never become stale;
+forget() drops the entries of a color that is no longer used, e.g. one just replaced in the BrushEditBox. """
+
+MAX_BLENDS = 4096
+
+_rgb = dict() # color string -> (r, g, b)
+_blends = OrderedDict() # (color, target, weight) -> blended color string
+
+## Statistics
+stats = dict(parses = 0, blend_hits = 0, blend_misses = 0)
+
+def rgb(color):
+  """ Returns the color as a tuple of 0-255 integers. """
+  try:
+    return _rgb[color]
+  except KeyError:
+    stats['parses'] += 1
+    value = tuple([int(round(v * 255)) for v in utils.color_str_to_tuple(color)])
+    _rgb[color] = value
+    return value
+
+def rgb_to_str(value):
+  return '#{0:02x}{1:02x}{2:02x}'.format(*value)
+
+def blend(color, target, weight):
+  """ Returns the color blended with the target color, with the given weight on the first color
+  (as utils.color_blend()). """
+  key = (color, target, weight)
+  try:
+    result = _blends.pop(key)
+    stats['blend_hits'] += 1
+  except KeyError:
+    stats['blend_misses'] += 1
+    result = rgb_to_str([int(round(v1 * weight + v2 * (1 - weight))) for v1, v2 in zip(rgb(color), rgb(target))])
+    if len(_blends) >= MAX_BLENDS:
+      _blends.popitem(last = False)
+  _blends[key] = result
+  return result
+
+def forget(color):
+  """ Drops the interned value of the color and the cached blends involving it. """
+  _rgb.pop(color, None)
+  for key in [key for key in _blends if key[0] == color or key[1] == color]:
+    del _blends[key]
+
+def clear():
+  _rgb.clear()
+  _blends.clear()
@@ -5,7 +5,7 @@ import itertools as it
 sticky_all = tk.N + tk.S + tk.E + tk.W
 
 from model_canvas import ModelCanvas
-import utils
+import event_store
 
 class DesignBox(tk.Frame):
   # canvas is the model....
@@ -33,11 +33,17 @@ class DesignBox(tk.Frame):
 
     ## Set up event handlers
     self.bind_all('<<ModelSelect>>', self.handle_model_select)
+    self.bind_all('<<ModelRemove>>', self.handle_model_remove)
 
   def switch_model(self, model):
     self.canvas.set_model(model)
 
   def handle_model_select(self, event):
     print 'modelselect'
-    model = utils.event_data_retrieve(event.state)
+    model = event_store.receive(event)
     self.switch_model(model)
+
+  def handle_model_remove(self, event):
+    """ Forgets the undo history of a model removed from the list, which would otherwise keep it alive. """
+    model = event_store.receive(event)
+    if model != None:  self.canvas.journal.discard(model)
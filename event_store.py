@@ -0,0 +1,122 @@
+import itertools as it
+import sys
+
+""" Payloads for virtual events.
+Tkinter does not implement the data field of virtual events, so a widget generating an event stores its payload
+here and passes the payload's key in the event's state field; handlers look the payload up with receive().
+Keys come from a counter, so no two payloads ever share a key. Payloads are reference counted: generate() counts
+the receivers bound to the event (the callbacks bound to the sequence on each of the widget's bindtags), and
+each receive() drops one reference, so a payload is released as soon as its last receiver has seen it.
+Receivers that never call receive() cannot leak it either: a payload is released after its event is
+dispatched, right after event_generate() returns, or for an event queued with when = 'tail', at the next
+idle time once the queue has been processed. Handlers that need a payload for longer (e.g. the clipboard) keep
+their own reference to it.
+The store keeps account of the payloads it holds: nbytes estimates their size (see payload_nbytes()), and
+stats counts the payloads registered and released, and the peak size of the store. """
+
+class EventStore(object):
+
+  def __init__(self):
+    self._keys = it.count(1)
+    self._payloads = dict() # key -> [payload, references left, estimated size in bytes]
+    self.nbytes = 0
+
+    ## Statistics
+    self.stats = dict(registered = 0, received = 0, released = 0, auto_released = 0, peak_nbytes = 0)
+
+  def __len__(self):
+    """ Returns the number of payloads held by the store. """
+    return len(self._payloads)
+
+  def register(self, payload, references = 1):
+    """ Stores the payload until it has been received references times or is released, and returns its key. """
+    key = next(self._keys)
+    size = payload_nbytes(payload)
+    self._payloads[key] = [payload, references, size]
+    self.nbytes += size
+    self.stats['registered'] += 1
+    self.stats['peak_nbytes'] = max(self.stats['peak_nbytes'], self.nbytes)
+    return key
+
+  def generate(self, widget, sequence, payload, when = None):
+    """ Generates the virtual event on the widget with the payload, which is released once the event
+    has been dispatched. """
+    key = self.register(payload, count_receivers(widget, sequence))
+    widget.event_generate(sequence, state = key, when = when)
+    if when == None:
+      self.release(key)
+    else:
+      widget.after_idle(self.release, key)
+    return key
+
+  def peek(self, key):
+    """ Returns the payload with the given key without dropping a reference, or None if there is none. """
+    entry = self._payloads.get(key)
+    return None if entry == None else entry[0]
+
+  def receive(self, event):
+    """ Returns the payload of the event, or None if it has none, and drops one reference to it. """
+    entry = self._payloads.get(event.state)
+    if entry == None:
+      return None
+    self.stats['received'] += 1
+    entry[1] -= 1
+    if entry[1] <= 0:
+      self._drop(event.state)
+    return entry[0]
+
+  def release(self, key):
+    """ Releases the payload with the given key, whether or not every receiver has seen it. """
+    if key in self._payloads:
+      self.stats['auto_released'] += 1
+      self._drop(key)
+
+  def clear(self):
+    for key in self._payloads.keys():
+      self.release(key)
+
+  def _drop(self, key):
+    self.nbytes -= self._payloads.pop(key)[2]
+    self.stats['released'] += 1
+
+
+def count_receivers(widget, sequence):
+  """ Returns the number of callbacks bound to the sequence on the widget's bindtags. Each callback
+  bound by Tkinter takes one line of the binding script. """
+  count = 0
+  for tag in widget.bindtags():
+    script = widget.tk.call('bind', tag, sequence)
+    count += len([line for line in str(script).split('\n') if line.strip() != ''])
+  return count
+
+## Containers with more items than this are measured by a sample of their items
+SAMPLE_SIZE = 64
+
+def payload_nbytes(payload, seen = None):
+  """ Estimates the memory held by the payload in bytes: containers are measured with their contents, objects
+  with an nbytes attribute (NumPy arrays, Models) by it, and anything else by sys.getsizeof(). Each object is
+  counted once. """
+  if seen == None:  seen = set()
+  if id(payload) in seen:
+    return 0
+  seen.add(id(payload))
+  if hasattr(payload, 'nbytes'):
+    return payload.nbytes
+  size = sys.getsizeof(payload)
+  if isinstance(payload, dict):
+    items = list(it.islice(payload.iteritems(), SAMPLE_SIZE))
+  elif isinstance(payload, (list, tuple, set, frozenset)):
+    items = list(it.islice(payload, SAMPLE_SIZE))
+  else:
+    return size
+  if len(items) > 0:
+    sample = sum([payload_nbytes(item, seen) for item in items])
+    size += sample * len(payload) // len(items)
+  return size
+
+
+## The store shared by the application's widgets
+store = EventStore()
+generate = store.generate
+receive = store.receive
+peek = store.peek
@@ -1,6 +1,8 @@
 import itertools as it
 import math
 
+import numpy as np
+
 GRID_SQUARE = 0
 GRID_HEX_HORIZ = 1
 GRID_HEX_VERT = 2
@@ -78,21 +80,266 @@ class SquareGrid(object):
     min_x, min_y, max_x, max_y = gc_bbox
     return min_x <= x < max_x and min_y <= y < max_y
 
+  def forward_neighbors(self, xs, ys):
+    """ Given arrays of grid coordinates, returns a list of (xs, ys) array pairs, one per neighbor direction.
+    Only half of the neighbor directions are returned, so that each adjacent pair of cells is reported
+    exactly once (from the cell earlier in the returned directions). The square grid is 4-connected. """
+    return [(xs + 1, ys), (xs, ys + 1)]
+
+  ### Batched conversions
+  ## Array-in/array-out versions of the conversions above, for converting many coordinates at once.
+  def gridcoords_to_pixels(self, xs, ys, cell_diameter):
+    """ Converts arrays of grid coordinates to arrays of pixel coordinates. See gridcoord_to_pixel(). """
+    cell_diameter = float(cell_diameter)
+    return (np.asarray(xs) * cell_diameter, np.asarray(ys) * cell_diameter)
+  def pixels_to_gridcoords(self, pxs, pys, cell_diameter):
+    """ Converts arrays of pixel coordinates to arrays of grid coordinates. See pixel_to_gridcoord(). """
+    cell_diameter = float(cell_diameter)
+    xs = np.floor(np.asarray(pxs) / cell_diameter).astype(np.int64)
+    ys = np.floor(np.asarray(pys) / cell_diameter).astype(np.int64)
+    return (xs, ys)
+
   ### Grid coordinate manipulation
+  ## Transformations are GridTransform objects, which can be composed with then() and applied
+  ## to arrays of grid coordinates with transform_gridcoords().
+  def rotation(self, axis, steps = 1):
+    """ Rotation by steps quarter turns (counter-clockwise on screen) about the grid coordinate axis. """
+    return GridTransform.rotation(axis, steps % 4)
+  def flip(self, axis, vertical = False):
+    """ Mirror image about the column (or, if vertical, the row) through the grid coordinate axis. """
+    return GridTransform.flip(axis, vertical)
+  def transposition(self, axis):
+    """ Mirror image about the diagonal through the grid coordinate axis. """
+    return GridTransform.transposition(axis)
+  def translation(self, offset):
+    return GridTransform.translation(offset)
+
+  def transform_gridcoords(self, xs, ys, transform):
+    """ Applies the GridTransform to arrays of grid coordinates, returning arrays of new grid coordinates. """
+    return transform.apply(xs, ys)
+
+  def rotate_gridcoords_array(self, xs, ys, axis, steps = 1):
+    return self.transform_gridcoords(xs, ys, self.rotation(axis, steps))
+  def flip_gridcoords_array(self, xs, ys, axis, vertical = False):
+    return self.transform_gridcoords(xs, ys, self.flip(axis, vertical))
+  def transpose_gridcoords_array(self, xs, ys, axis):
+    return self.transform_gridcoords(xs, ys, self.transposition(axis))
+  def translate_gridcoords_array(self, xs, ys, offset):
+    return self.transform_gridcoords(xs, ys, self.translation(offset))
+
   def rotate_gridcoords(self, gridcoords, axis, steps = 1):
-    steps = steps % 4
-    axis_x, axis_y = axis
-
-    mapping = {}
-    for gc in gridcoords:
-      x, y = gc
-      dx = x - axis_x 
-      dy = y - axis_y
-      if steps == 1:
-        dx, dy = dy, -dx
-      elif steps == 2:
-        dx, dy = -dx, -dy
-      elif steps == 3:
-        dx, dy = -dy, dx
-      mapping[gc] = (axis_x + dx, axis_y + dy)
-    return mapping
+    """ Returns a dict mapping each of the given grid coordinates to its rotated grid coordinate. """
+    gridcoords = list(gridcoords)
+    if len(gridcoords) == 0:
+      return {}
+    xs, ys = np.array(gridcoords, dtype = np.int64).T
+    new_xs, new_ys = self.rotate_gridcoords_array(xs, ys, axis, steps)
+    return dict(zip(gridcoords, zip(new_xs.tolist(), new_ys.tolist())))
+
+class HexGrid(SquareGrid):
+  """ Implements a hexagonal grid of touching circles, laid out in horizontal rows with every odd row
+  shifted right by half a cell. Rows are sqrt(3)/2 cell diameters apart.
+  Grid coordinates are (column, row) pairs, so bounding boxes of grid coordinates are rectangular on
+  screen just like on a SquareGrid. Internally, neighbors, rotations and pixel lookups are computed in
+  axial coordinates (q, r) = (column - floor(row / 2), row), in which the lattice is linear.
+  With vertical = True, the grid is transposed: vertical columns, every odd column shifted down by half
+  a cell, and grid coordinates are still (x, y) = (column, row). """
+
+  ROW_SPACING = math.sqrt(3) / 2
+
+  def __init__(self, vertical = False):
+    self._vertical = vertical
+
+  @property
+  def grid_type(self):
+    return GRID_HEX_VERT if self._vertical else GRID_HEX_HORIZ
+
+  ## Transposition helpers: all the computations below are written for the horizontal layout,
+  ## with coordinates swapped on the way in and out for the vertical layout.
+  def _swap(self, a, b):
+    return (b, a) if self._vertical else (a, b)
+  def _swap_box(self, box):
+    return (box[1], box[0], box[3], box[2]) if self._vertical else box
+
+  def _offset_to_axial(self, xs, ys):
+    cols, rows = self._swap(xs, ys)
+    return (cols - (rows >> 1), rows)
+  def _axial_to_offset(self, qs, rs):
+    return self._swap(qs + (rs >> 1), rs)
+
+  def gridcoord_to_pixel(self, coord, cell_diameter):
+    """ Converts the grid coordinate to the pixel coordinate of the top left corner of its circle's bounding box.
+    The origin grid coordinate (0,0) corresponds to pixel (0,0). """
+    col, row = self._swap(*coord)
+    x = (col + 0.5 * (row & 1)) * cell_diameter
+    y = row * self.ROW_SPACING * cell_diameter
+    return self._swap(x, y)
+  def pixel_to_gridcoord(self, pixel, cell_diameter):
+    xs, ys = self.pixels_to_gridcoords(np.array([pixel[0]]), np.array([pixel[1]]), cell_diameter)
+    return (int(xs[0]), int(ys[0]))
+
+  def gridcoords_to_pixels(self, xs, ys, cell_diameter):
+    cols, rows = self._swap(np.asarray(xs), np.asarray(ys))
+    px = (cols + 0.5 * (rows & 1)) * float(cell_diameter)
+    py = rows * (self.ROW_SPACING * cell_diameter)
+    return self._swap(px, py)
+  def pixels_to_gridcoords(self, pxs, pys, cell_diameter):
+    """ Finds the cell containing each pixel in O(1): the pixel is converted to fractional
+    axial coordinates, which are rounded to the nearest cell in cube coordinates. """
+    px, py = self._swap(np.asarray(pxs, dtype = float), np.asarray(pys, dtype = float))
+    ## Pixel relative to the center of cell (0,0), in units of the hexagon size (center to corner)
+    size = cell_diameter / math.sqrt(3)
+    px = (px - cell_diameter / 2.0) / size
+    py = (py - cell_diameter / 2.0) / size
+    q = math.sqrt(3) / 3 * px - py / 3.0
+    r = 2.0 / 3 * py
+    ## Cube rounding: round all three cube coordinates, then fix the one that moved the most
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    qs = rq.astype(np.int64)
+    rs = rr.astype(np.int64)
+    cols = qs + (rs >> 1)
+    return self._swap(cols, rs)
+
+  def gridcoord_to_pixel_bbox(self, gc_bbox, cell_diameter):
+    """ Returns the smallest bounding box in pixels containing the circles of all cells in the given grid coordinate bounding box. """
+    if gc_bbox == None:
+      return None
+
+    min_col, min_row, max_col, max_row = self._swap_box(gc_bbox)
+    has_even_row = max_row - min_row >= 2 or min_row & 1 == 0
+    has_odd_row = max_row - min_row >= 2 or min_row & 1 == 1
+    x1 = (min_col + (0 if has_even_row else 0.5)) * cell_diameter
+    x2 = (max_col + (0.5 if has_odd_row else 0)) * cell_diameter
+    y1 = min_row * self.ROW_SPACING * cell_diameter
+    y2 = (max_row - 1) * self.ROW_SPACING * cell_diameter + cell_diameter
+    return self._swap_box((x1, y1, x2, y2))
+
+  def pixel_to_gridcoord_bbox(self, pixel_bbox, cell_diameter):
+    """ Returns the smallest bounding box in grid coordinates containing every cell whose circle's
+    bounding box overlaps the given pixel bounding box. """
+    if pixel_bbox == None:
+      return None
+
+    min_x, min_y, max_x, max_y = self._swap_box(pixel_bbox)
+    row_spacing = self.ROW_SPACING * cell_diameter
+    min_row = int(math.floor((min_y - cell_diameter) / row_spacing)) + 1
+    max_row = int(math.ceil(max_y / row_spacing))
+    min_col = int(math.floor(min_x / cell_diameter - 1.5)) + 1
+    max_col = int(math.ceil(max_x / cell_diameter))
+    return self._swap_box((min_col, min_row, max_col, max_row))
+
+  def forward_neighbors(self, xs, ys):
+    """ See SquareGrid.forward_neighbors(). The hexagonal grid is 6-connected. """
+    cols, rows = self._swap(xs, ys)
+    odd = rows & 1
+    neighbors = [(cols + 1, rows), (cols - 1 + odd, rows + 1), (cols + odd, rows + 1)]
+    return [self._swap(c, r) for c, r in neighbors]
+
+  ### Grid coordinate manipulation
+  ## Transforms made by a HexGrid act on axial coordinates; apply them with transform_gridcoords().
+  def _axial_axis(self, axis):
+    qs, rs = self._offset_to_axial(np.array([axis[0]]), np.array([axis[1]]))
+    return (int(qs[0]), int(rs[0]))
+
+  def rotation(self, axis, steps = 1):
+    """ Rotation by steps sixth turns (counter-clockwise on screen) about the grid coordinate axis. """
+    ## Transposing the layout mirrors it, which reverses the sense of rotation
+    steps = (-steps if self._vertical else steps) % 6
+    matrix = ((1, 0), (0, 1))
+    for i in range(steps):
+      (a, b), (c, d) = matrix
+      matrix = ((a + c, b + d), (-a, -b))
+    return GridTransform.about(matrix, self._axial_axis(axis))
+  def flip(self, axis, vertical = False):
+    """ Mirror image about the column (or, if vertical, the row) through the grid coordinate axis. """
+    if vertical != self._vertical:
+      matrix = ((1, 1), (0, -1))
+    else:
+      matrix = ((-1, -1), (0, 1))
+    return GridTransform.about(matrix, self._axial_axis(axis))
+  def transposition(self, axis):
+    assert False, 'The diagonal is not a symmetry axis of a hexagonal grid'
+  def translation(self, offset):
+    """ Translation moving grid coordinate (0,0) to the grid coordinate offset. """
+    return GridTransform.translation(self._axial_axis(offset))
+
+  def transform_gridcoords(self, xs, ys, transform):
+    qs, rs = self._offset_to_axial(np.asarray(xs, dtype = np.int64), np.asarray(ys, dtype = np.int64))
+    qs, rs = transform.apply(qs, rs)
+    return self._axial_to_offset(qs, rs)
+
+class GridTransform(object):
+  """ An affine transformation of grid coordinates with integer coefficients:
+    x' = a*x + b*y + tx
+    y' = c*x + d*y + ty
+  where matrix = ((a, b), (c, d)) and offset = (tx, ty).
+  Transforms compose with then(): t1.then(t2) applies t1 first, then t2. """
+
+  def __init__(self, matrix = ((1, 0), (0, 1)), offset = (0, 0)):
+    self.matrix = (tuple(matrix[0]), tuple(matrix[1]))
+    self.offset = tuple(offset)
+
+  @staticmethod
+  def identity():
+    return GridTransform()
+  @staticmethod
+  def translation(offset):
+    return GridTransform(offset = offset)
+  @staticmethod
+  def about(matrix, axis):
+    """ The linear map given by matrix, applied about the fixed point axis rather than the origin. """
+    (a, b), (c, d) = matrix
+    ax, ay = axis
+    return GridTransform(matrix, (ax - (a*ax + b*ay), ay - (c*ax + d*ay)))
+  @staticmethod
+  def rotation(axis, steps = 1):
+    """ Rotation by steps quarter turns, mapping offset (dx, dy) from the axis to (dy, -dx) per step. """
+    matrix = ((1, 0), (0, 1))
+    for i in range(steps % 4):
+      (a, b), (c, d) = matrix
+      matrix = ((c, d), (-a, -b))
+    return GridTransform.about(matrix, axis)
+  @staticmethod
+  def flip(axis, vertical = False):
+    matrix = ((1, 0), (0, -1)) if vertical else ((-1, 0), (0, 1))
+    return GridTransform.about(matrix, axis)
+  @staticmethod
+  def transposition(axis):
+    return GridTransform.about(((0, 1), (1, 0)), axis)
+
+  def then(self, other):
+    """ Returns the transform applying self first, then other. """
+    (a1, b1), (c1, d1) = self.matrix
+    (a2, b2), (c2, d2) = other.matrix
+    tx, ty = self.offset
+    matrix = ((a2*a1 + b2*c1, a2*b1 + b2*d1), (c2*a1 + d2*c1, c2*b1 + d2*d1))
+    offset = (a2*tx + b2*ty + other.offset[0], c2*tx + d2*ty + other.offset[1])
+    return GridTransform(matrix, offset)
+
+  def inverse(self):
+    """ Returns the inverse transform. Only transforms with determinant +-1 (rotations, flips and
+    translations, and compositions of them) have inverses with integer coefficients. """
+    (a, b), (c, d) = self.matrix
+    det = a*d - b*c
+    assert det in (1, -1), 'GridTransform is not invertible on the grid'
+    matrix = ((d * det, -b * det), (-c * det, a * det))
+    tx, ty = self.offset
+    return GridTransform(matrix, (-(matrix[0][0]*tx + matrix[0][1]*ty), -(matrix[1][0]*tx + matrix[1][1]*ty)))
+
+  def apply(self, xs, ys):
+    """ Transforms arrays of grid coordinates, returning arrays of new grid coordinates. """
+    xs = np.asarray(xs, dtype = np.int64)
+    ys = np.asarray(ys, dtype = np.int64)
+    (a, b), (c, d) = self.matrix
+    tx, ty = self.offset
+    return (a*xs + b*ys + tx, c*xs + d*ys + ty)
+  def apply_gridcoord(self, gridcoord):
+    x, y = gridcoord
+    (a, b), (c, d) = self.matrix
+    return (a*x + b*y + self.offset[0], c*x + d*y + self.offset[1])
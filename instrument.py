@@ -0,0 +1,120 @@
+import time
+import functools
+
+import Tkinter as tk
+
+""" Named timers and counters for the hot paths of the designer.
+Functions decorated with @timed(name) and blocks inside "with timer(name):" add their running time to the
+timer of that name, and count(name, n) adds n to a counter. Instrumentation is off unless enable() is called
+(e.g. by setting the RBD_STATS environment variable, see rbd.py); while it is off, a timed function costs one
+extra call and a test of the enabled flag, and count() returns at once.
+report() formats the timers and counters as text, dump() appends the report to a log file, and a StatsOverlay
+shows it on screen, updated while the application runs. """
+
+enabled = False
+log_path = 'rbd_stats.log'
+
+_timers = dict() # name -> [calls, total seconds, longest call in seconds]
+_counters = dict() # name -> total
+
+def enable(path = None):
+  """ Turns instrumentation on, optionally setting the file dump() writes to. """
+  global enabled, log_path
+  enabled = True
+  if path != None:  log_path = path
+def disable():
+  global enabled
+  enabled = False
+
+def reset():
+  _timers.clear()
+  _counters.clear()
+
+def count(name, n = 1):
+  """ Adds n to the counter with the given name. """
+  if enabled:
+    _counters[name] = _counters.get(name, 0) + n
+
+def add_time(name, seconds):
+  """ Adds a call taking the given number of seconds to the timer with the given name. """
+  t = _timers.get(name)
+  if t == None:
+    _timers[name] = [1, seconds, seconds]
+  else:
+    t[0] += 1
+    t[1] += seconds
+    if seconds > t[2]:  t[2] = seconds
+
+def timed(name):
+  """ Decorator timing every call of the function with the timer of the given name. """
+  def decorate(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kargs):
+      if not enabled:
+        return f(*args, **kargs)
+      start = time.time()
+      try:
+        return f(*args, **kargs)
+      finally:
+        add_time(name, time.time() - start)
+    return wrapper
+  return decorate
+
+class _Timer(object):
+  def __init__(self, name):
+    self.name = name
+  def __enter__(self):
+    self.start = time.time()
+  def __exit__(self, exc_type, exc_value, traceback):
+    add_time(self.name, time.time() - self.start)
+    return False
+
+class _NullTimer(object):
+  def __enter__(self):
+    pass
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+_null_timer = _NullTimer()
+
+def timer(name):
+  """ Returns a context manager timing the block it wraps with the timer of the given name. """
+  return _Timer(name) if enabled else _null_timer
+
+def report():
+  """ Returns the timers and counters as lines of text, the slowest timers first. """
+  lines = ['{0:<32} {1:>8} {2:>10} {3:>9} {4:>9}'.format('timer', 'calls', 'total ms', 'mean ms', 'max ms')]
+  for name, (calls, total, longest) in sorted(_timers.items(), key = lambda item: -item[1][1]):
+    lines.append('{0:<32} {1:>8} {2:>10.1f} {3:>9.2f} {4:>9.2f}'.format(name, calls, total * 1000, total * 1000 / calls, longest * 1000))
+  lines.append('{0:<32} {1:>8}'.format('counter', 'total'))
+  for name, total in sorted(_counters.items()):
+    lines.append('{0:<32} {1:>8}'.format(name, total))
+  return '\n'.join(lines)
+
+def dump(path = None):
+  """ Appends the report to the log file, headed by the time of the dump. """
+  with open(path or log_path, 'a') as f:
+    f.write('## {0}\n{1}\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), report()))
+
+
+class StatsOverlay(tk.Toplevel):
+  """ A small window showing the report, refreshed every interval milliseconds. """
+
+  interval = 500
+
+  def __init__(self, master):
+    tk.Toplevel.__init__(self, master)
+    self.title('Stats')
+    self.text = tk.Label(self, font = 'TkFixedFont', justify = tk.LEFT, anchor = tk.NW)
+    self.text.pack(fill = tk.BOTH, expand = True)
+    self._refresh_id = None
+    self.refresh()
+
+  def refresh(self):
+    self.text['text'] = report() if enabled else 'Instrumentation is disabled (see instrument.enable())'
+    self._refresh_id = self.after(self.interval, self.refresh)
+
+  def destroy(self):
+    if self._refresh_id != None:
+      self.after_cancel(self._refresh_id)
+      self._refresh_id = None
+    tk.Toplevel.destroy(self)
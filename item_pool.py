@@ -0,0 +1,64 @@
+""" A pool of canvas ovals shared by the layers of a ModelCanvas.
+Creating and deleting Tk items is slow, so rather than creating ovals when a layer starts and deleting
+them when it is cleaned, layers lease ovals from the pool and release them back to it. Released ovals are
+hidden and their tags reset to POOL_TAG, and are handed out again by the next lease. Leasing and releasing
+any number of ovals takes a single Tcl command, as does creating any new ovals needed. """
+
+import instrument
+
+POOL_TAG = 'MCL_pool'
+
+def tcl_list(values):
+  """ Formats the strings as a Tcl list, bracing each so they may contain spaces. """
+  return ' '.join(['{{{0}}}'.format(v) for v in values])
+
+class ItemPool(object):
+
+  ## Released ovals beyond this many are deleted rather than kept for reuse
+  max_free = 50000
+
+  def __init__(self, canvas):
+    self.canvas = canvas
+    self._free = []
+
+    ## Statistics
+    self.created = 0
+    self.reused = 0
+    self.tcl_calls = 0
+
+  def __len__(self):
+    """ Returns the number of free ovals in the pool. """
+    return len(self._free)
+
+  def lease(self, count, tags):
+    """ Returns a list of count hidden ovals with the given tags, reusing free ovals before creating new ones. """
+    w = self.canvas._w
+    reused = self._free[max(0, len(self._free) - count):]
+    del self._free[len(self._free) - len(reused):]
+    if len(reused) > 0:
+      self._eval('foreach i {{{0}}} {{{1} itemconfigure $i -tags {{{2}}}}}'.format(' '.join(map(str, reused)), w, tcl_list(tags)))
+      self.reused += len(reused)
+    created = []
+    if count > len(reused):
+      script = 'set ids {{}}\nfor {{set k {0}}} {{$k > 0}} {{incr k -1}} {{lappend ids [{1} create oval 0 0 0 0 -state hidden -tags {{{2}}}]}}\nset ids'
+      result = self._eval(script.format(count - len(reused), w, tcl_list(tags)))
+      created = [int(i) for i in self.canvas.tk.splitlist(result)]
+      self.created += len(created)
+    return reused + created
+
+  def release(self, items):
+    """ Hides the ovals and returns them to the pool, removing all their tags. """
+    if len(items) == 0:  return
+    items = list(items)
+    keep = max(0, min(len(items), self.max_free - len(self._free)))
+    w = self.canvas._w
+    if keep > 0:
+      self._eval('foreach i {{{0}}} {{{1} itemconfigure $i -state hidden -tags {2}}}'.format(' '.join(map(str, items[:keep])), w, POOL_TAG))
+      self._free.extend(items[:keep])
+    if keep < len(items):
+      self._eval('{0} delete {1}'.format(w, ' '.join(map(str, items[keep:]))))
+
+  def _eval(self, script):
+    self.tcl_calls += 1
+    instrument.count('tcl_calls.item_pool')
+    return self.canvas.tk.eval(script)
@@ -0,0 +1,134 @@
+from collections import deque
+import itertools as it
+
+import numpy as np
+
+## Default limit on the memory used by the arrays of a Journal's deltas
+MAX_BYTES = 64 << 20
+
+class Delta(object):
+  """ The change made to a model at a set of grid coordinates by one edit: for each grid coordinate,
+  the particle type and body ids (as in Model.type_ids_at(), -1 for no particle) before and after the edit. """
+  __slots__ = ('model', 'label', 'serial', 'xs', 'ys', 'old_ptypes', 'old_bodies', 'new_ptypes', 'new_bodies')
+
+  def __init__(self, model, label, xs, ys):
+    self.model = model
+    self.label = label
+    self.serial = None # order of the delta among all the deltas committed to its journal
+    self.xs, self.ys = xs, ys
+    self.old_ptypes, self.old_bodies = model.type_ids_at(xs, ys)
+    self.new_ptypes, self.new_bodies = None, None
+
+  def __len__(self):
+    return len(self.xs)
+
+  @property
+  def nbytes(self):
+    return sum([a.nbytes for a in (self.xs, self.ys, self.old_ptypes, self.old_bodies, self.new_ptypes, self.new_bodies)])
+
+  @property
+  def gridcoords(self):
+    return zip(self.xs.tolist(), self.ys.tolist())
+
+  def undo(self):
+    self.model.set_type_ids_at(self.xs, self.ys, self.old_ptypes, self.old_bodies)
+  def redo(self):
+    self.model.set_type_ids_at(self.xs, self.ys, self.new_ptypes, self.new_bodies)
+
+
+class Journal(object):
+  """ Undo/redo history of edits to models, kept as a stack of Deltas for each model.
+  An edit is recorded by calling begin() with the model and the grid coordinates it may change, making the
+  change, and passing the returned Delta to commit(), which stores only the grid coordinates that actually
+  changed. Undoing or redoing a Delta takes time proportional to its size.
+  Each model has its own undo and redo stacks, so switching between models keeps the history of each, and
+  undo() and redo() act on the given model's stacks. The deltas of all the models share max_bytes: when they
+  use more, the oldest deltas, undone or not, are discarded whatever their model (see _evict()). The journal
+  keeps the models it holds deltas for alive, so a model that is thrown away should be passed to discard(). """
+
+  def __init__(self, max_bytes = MAX_BYTES):
+    self.max_bytes = max_bytes
+    self._undo = dict() # model -> deque of Deltas, the most recent last
+    self._redo = dict() # model -> deque of undone Deltas, the most recently undone last
+    self._serials = it.count()
+    self._nbytes = 0
+
+  @property
+  def nbytes(self):
+    return self._nbytes
+
+  def can_undo(self, model):
+    return model in self._undo
+  def can_redo(self, model):
+    return model in self._redo
+
+  def begin(self, model, gridcoords, label = ''):
+    """ Records the state of the model at the given grid coordinates before an edit. """
+    gcs = np.array(list(gridcoords), dtype = np.int32).reshape(-1, 2)
+    return Delta(model, label, gcs[:, 0].copy(), gcs[:, 1].copy())
+
+  def commit(self, delta):
+    """ Records the state of the model after the edit begun with begin(), and pushes the edit onto the model's
+    undo stack, emptying its redo stack. Returns the Delta, or None if the edit changed nothing. """
+    new_ptypes, new_bodies = delta.model.type_ids_at(delta.xs, delta.ys)
+    changed = (new_ptypes != delta.old_ptypes) | (new_bodies != delta.old_bodies)
+    if not changed.any():
+      return None
+    delta.xs, delta.ys = delta.xs[changed], delta.ys[changed]
+    delta.old_ptypes, delta.old_bodies = delta.old_ptypes[changed], delta.old_bodies[changed]
+    delta.new_ptypes, delta.new_bodies = new_ptypes[changed], new_bodies[changed]
+    delta.serial = next(self._serials)
+
+    self._nbytes -= sum([d.nbytes for d in self._redo.pop(delta.model, [])])
+    self._undo.setdefault(delta.model, deque()).append(delta)
+    self._nbytes += delta.nbytes
+    self._evict(keep = delta)
+    return delta
+
+  def undo(self, model):
+    """ Reverts the most recent edit to the model, returning its Delta, or None if there is nothing to undo. """
+    if not self.can_undo(model):
+      return None
+    delta = self._pop(self._undo, model)
+    delta.undo()
+    self._redo.setdefault(model, deque()).append(delta)
+    return delta
+  def redo(self, model):
+    """ Reapplies the most recently undone edit to the model, returning its Delta, or None if there is nothing to redo. """
+    if not self.can_redo(model):
+      return None
+    delta = self._pop(self._redo, model)
+    delta.redo()
+    self._undo.setdefault(model, deque()).append(delta)
+    return delta
+
+  def discard(self, model):
+    """ Forgets every delta of the given model, e.g. when a layer and its model are discarded. """
+    for stacks in (self._undo, self._redo):
+      self._nbytes -= sum([d.nbytes for d in stacks.pop(model, [])])
+
+  def clear(self):
+    self._undo.clear()
+    self._redo.clear()
+    self._nbytes = 0
+
+  def _pop(self, stacks, model):
+    """ Pops the top delta of the model's stack, dropping the stack once it is empty so the model can be freed. """
+    stack = stacks[model]
+    delta = stack.pop()
+    if len(stack) == 0:  del stacks[model]
+    return delta
+
+  def _evict(self, keep = None):
+    """ Discards the oldest deltas of any model until the journal fits in max_bytes, but never the delta keep.
+    Only the far end of a stack is discarded -- the first delta to have been done of an undo stack, and the
+    last to be redone of a redo stack -- so the deltas left can still be undone and redone in order. """
+    while self._nbytes > self.max_bytes:
+      ends = [(stack[0].serial, stacks, model) for stacks in (self._undo, self._redo)
+          for model, stack in stacks.iteritems() if stack[0] is not keep]
+      if len(ends) == 0:
+        return
+      serial, stacks, model = min(ends)
+      stack = stacks[model]
+      self._nbytes -= stack.popleft().nbytes
+      if len(stack) == 0:  del stacks[model]
@@ -1,114 +1,936 @@
+import itertools as it
 
-from copy import deepcopy
+import numpy as np
 
 import grid
 from particle import Particle
 
+## Side length (in grid cells) of the square chunks used by the Model's spatial index
+CHUNK_SHIFT = 6
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+
+## Source of Model versions, shared by all models so that no two different contents get the same version
+_versions = it.count(1)
+
 class Model(object):
   """ Model implements an object that stores points in a "model", or collection of points of various particle types
   and/or rigid body assignments. The Model class stores a grid that determines how the grid coordinate corresponding
   to each point is converted to a pixel.
-  Point information is stored in Particle objects, which are created and deleted as particles are added and removed
-  from the model. A Particle object relates a grid coordinate to a particle type and body type, represented as
-  ParticleSpecs and BodySpecs objects, respectively.
+  Point information is stored column-wise ("struct of arrays"): one NumPy integer array each for the x and y grid
+  coordinates, the particle type id and the body id of every particle. Particle and body type ids index into
+  per-model tables of the shared ParticleSpecs and BodySpecs objects. Removing a particle moves the last row into
+  the freed slot ("swap-remove"), so rows are always packed and the order of rows is arbitrary.
+  The grid is divided into CHUNK_SIZE x CHUNK_SIZE chunks, and for every chunk holding at least one particle the
+  Model keeps a grid of the row of each cell (-1 for empty cells) and its particle count. These map grid coordinates
+  to rows, and make the cost of a range query depend on the number of occupied chunks it touches rather than the
+  area it covers.
+  The Model also keeps a histogram of particle counts per x and per y coordinate, and uses them to keep its bounding
+  box up to date as particles are added and removed. Removing the last particle on an edge of the bounding box only
+  marks it stale; it is recomputed from the histograms the next time it is needed.
+  Finally, the Model keeps the set of grid coordinates belonging to each body and to each particle type, so
+  queries about a single body or type cost time proportional to its size rather than to the size of the model.
+  Copies and snapshots of a Model share its storage copy-on-write: taking one costs O(1), and afterwards each model
+  copies a chunk's row grid or a member set the first time it modifies it (the column arrays and small tables
+  are copied whole on the first modification).
   Externally, most interactions with the Model do not directly access Particle objects, instead using grid coordinates
-  to refer to locations in the Model that may or may not have an associated particle.
+  to refer to locations in the Model that may or may not have an associated particle. Particle objects returned by the
+  Model (get_particle(), particles) are detached copies built on demand; modifying them does not modify the Model.
   The Model implements the following functionality:
     - Allows particles to be added to the model with add_particle()
     - Allows particles to be removed from the model with remove_particle()
     - Query if a particle is in the model with has_particle()
     - Modify particles with set_particle_type() and set_body_type()
-    - Query particle information with get_particle_type() and get_particle_type()
+    - Query particle information with get_particle_type() and get_body_type()
     - Calculate a bounding box (in grid coordinates) over all grid coordinates in the model
+    - Query the number of particles per x or y coordinate with axis_histogram()
+    - Query the members of a body or particle type with body_gridcoords(), particle_type_gridcoords() and
+      calc_connected_body_particles(), and the types in use with body_specs_in_use() and particle_specs_in_use()
+    - Query the grid coordinates within a bounding box with particles_in_bbox(), count_in_bbox() and
+      iter_occupied_chunks()
     - Get an iterator over all grid coordinates in the model
+    - Bulk access to the underlying arrays with xs, ys, particle_type_ids and body_ids, look up the rows of
+      many grid coordinates at once with rows_at(), and read or restore the type ids of many grid coordinates
+      with type_ids_at() and set_type_ids_at()
+    - Take O(1) copies with copy() and read-only snapshots with snapshot(), and extract a selection with extract()
+    - Tell whether the model has changed by comparing its version, which changes on every modification
+    - Subscribe views to the changes announced by the model's editors with subscribe() and notify()
+    - Batch many edits with transaction(), which updates the indexes in bulk and merges notifications
     - Access the underlying grid object for grid coordinate/pixel conversions (model.grid)
   """
   _grid = None
-  
-  _particles = None
 
-  gridcoord_to_particle = None
+  _init_capacity = 64
+
+  _subscribers = () # callbacks for notify(), replaced by a new tuple on every (un)subscription
+  _tx = None # the open _Transaction, if any
 
   def __init__(self, grid_type = grid.GRID_SQUARE):
     ## Initialize to having no particles in model
-    self._particles = set([])
-    self.gridcoord_to_particle = dict()
+    self._init_storage()
+
+    ## Tables of specs objects; the type/body id of a particle is its specs' position in these tables
+    self._particle_specs = []
+    self._particle_specs_ids = dict()
+    self._body_specs = []
+    self._body_specs_ids = dict()
+    self._tables_owned = True
 
     ## Initialize grid
     self.init_grid(grid_type)
 
+  def _init_storage(self):
+    self._version = next(_versions)
+    if self._tx != None:
+      ## Everything left in the model after this is added during the transaction
+      self._tx.old.clear()
+    self._count = 0
+    self._xs = np.zeros(self._init_capacity, dtype = np.int32)
+    self._ys = np.zeros(self._init_capacity, dtype = np.int32)
+    self._ptypes = np.zeros(self._init_capacity, dtype = np.int32)
+    self._bodies = np.zeros(self._init_capacity, dtype = np.int32)
+    self._columns_owned = True
+    self._chunks = _CowDict(np.copy) # chunk key -> CHUNK_SIZE x CHUNK_SIZE grid of rows (-1 if empty), indexed [x, y]
+    self._chunk_counts = _CowDict() # chunk key -> number of particles in chunk
+    self._x_hist = _CowDict() # x -> number of particles with that x coordinate
+    self._y_hist = _CowDict() # y -> number of particles with that y coordinate
+    self._bbox = None
+    self._bbox_stale = False
+    self._body_members = _CowDict(set) # body id -> set of gridcoords
+    self._ptype_members = _CowDict(set) # particle type id -> set of gridcoords
+
   @property
   def particles(self):
-    return list(self._particles)
+    """ Returns a new list of Particle objects, one for each particle in the model.
+    Prefer points_iterator() or the bulk array accessors in loops over large models. """
+    return [self._row_particle(row) for row in xrange(self._count)]
 
   @particles.setter
   def particles(self, new_particles):
-    self._particles.clear()
-    self.gridcoord_to_particle.clear()
-
+    """ Replaces the model's particles, building its storage in bulk. If several of the new particles have the
+    same grid coordinate, the last of them is kept. """
+    rows = dict()
     for new_p in new_particles:
-      self.add_particle(new_p.gridcoord, new_p.particle_specs, new_p.body_specs)
+      rows[new_p.gridcoord] = (self._particle_specs_id(new_p.particle_specs), self._body_specs_id(new_p.body_specs))
+    self.clear()
+    gcs = np.array(rows.keys(), dtype = np.int32).reshape(-1, 2)
+    types = np.array(rows.values(), dtype = np.int32).reshape(-1, 2)
+    self._load_rows(gcs[:, 0], gcs[:, 1], types[:, 0], types[:, 1])
 
   def points_iterator(self):
-    return iter([p.gridcoord for p in self._particles])
+    return iter(zip(self.xs.tolist(), self.ys.tolist()))
+
+  def __len__(self):
+    return self._count
+
+  def copy(self):
+    """ Returns an editable copy of the model in O(1). The two models share their storage until either is
+    modified; the ParticleSpecs and BodySpecs objects are always shared. """
+    return self._share(Model)
+
+  def __copy__(self):
+    return self.copy()
+  def __deepcopy__(self, memo):
+    return self.copy()
+
+  def snapshot(self):
+    """ Returns a read-only ModelSnapshot of the model's current contents in O(1).
+    Later changes to the model do not affect the snapshot. """
+    return self._share(ModelSnapshot)
+
+  def extract(self, gridcoords):
+    """ Returns a new Model holding only the particles at the given grid coordinates (coordinates without a
+    particle are skipped). The new model is built with array operations and shares the specs tables. """
+    gcs = np.array(list(gridcoords), dtype = np.int64).reshape(-1, 2)
+    rows = self.rows_at(gcs[:, 0], gcs[:, 1])
+    rows = np.unique(rows[rows >= 0])
+    m = Model.__new__(Model)
+    m._grid = self._grid
+    m._init_storage()
+    self._share_tables(m)
+    m._load_rows(self._xs[rows], self._ys[rows], self._ptypes[rows], self._bodies[rows])
+    return m
 
   @property
   def grid(self):
     return self._grid
 
+  @property
+  def nbytes(self):
+    """ Approximate size in bytes of the model's column arrays and chunk grids, including any storage
+    shared copy-on-write with copies and snapshots. """
+    columns = self._xs.nbytes + self._ys.nbytes + self._ptypes.nbytes + self._bodies.nbytes
+    return columns + len(self._chunks) * CHUNK_SIZE * CHUNK_SIZE * np.dtype(np.int32).itemsize
+
+  @property
+  def version(self):
+    """ A number that changes whenever the model is modified, e.g. to key caches of things drawn from it.
+    Copies keep the version of the model they were taken from until either is modified. """
+    return self._version
+
   def init_grid(self, grid_type):
     """ Initializes the grid to a minimum size."""
+    self._version = next(_versions)
     if grid_type == grid.GRID_SQUARE:
       self._grid = grid.SquareGrid()
+    elif grid_type == grid.GRID_HEX_HORIZ:
+      self._grid = grid.HexGrid()
+    elif grid_type == grid.GRID_HEX_VERT:
+      self._grid = grid.HexGrid(vertical = True)
     else:
       assert False, "Grid type {0} not supported.".format(grid_type)
 
+  #### Bulk accessors
+  ## These return views into the model's storage, valid until the model is next modified.
+  ## Row i of each array describes the same particle.
+
+  @property
+  def xs(self):
+    return self._xs[:self._count]
+  @property
+  def ys(self):
+    return self._ys[:self._count]
+  @property
+  def particle_type_ids(self):
+    return self._ptypes[:self._count]
+  @property
+  def body_ids(self):
+    return self._bodies[:self._count]
+
+  @property
+  def particle_specs_table(self):
+    """ List of ParticleSpecs, indexed by the ids in particle_type_ids. """
+    return self._particle_specs
+  @property
+  def body_specs_table(self):
+    """ List of BodySpecs, indexed by the ids in body_ids. """
+    return self._body_specs
+
+  def rows_at(self, xs, ys):
+    """ Returns an array holding the row of the particle at each of the grid coordinates (xs[i], ys[i]),
+    or -1 where there is no particle. The lookup is done one occupied chunk at a time. """
+    xs, ys = np.asarray(xs, dtype = np.int64), np.asarray(ys, dtype = np.int64)
+    rows = np.empty(len(xs), dtype = np.int32)
+    rows.fill(-1)
+    for key, idx in _group_rows(xs >> CHUNK_SHIFT, ys >> CHUNK_SHIFT):
+      chunk_rows = self._chunks.get(key)
+      if chunk_rows is not None:
+        rows[idx] = chunk_rows[xs[idx] & CHUNK_MASK, ys[idx] & CHUNK_MASK]
+    return rows
+
+  def type_ids_at(self, xs, ys):
+    """ Returns arrays of the particle type id and body id of the particle at each of the grid coordinates
+    (xs[i], ys[i]), with -1 for both where there is no particle. """
+    rows = self.rows_at(xs, ys)
+    empty = rows < 0
+    ptypes, bodies = self._ptypes[rows], self._bodies[rows]
+    ptypes[empty], bodies[empty] = -1, -1
+    return ptypes, bodies
+
+  def set_type_ids_at(self, xs, ys, ptype_ids, body_ids):
+    """ Sets the particle at each of the grid coordinates (xs[i], ys[i]) to have the given particle type and
+    body ids, as returned by type_ids_at() on this model; a particle type id of -1 removes the particle. """
+    gridcoords = zip(np.asarray(xs).tolist(), np.asarray(ys).tolist())
+    with self.transaction():
+      for gridcoord, ptype, body in zip(gridcoords, np.asarray(ptype_ids).tolist(), np.asarray(body_ids).tolist()):
+        if ptype < 0:
+          self.remove_particle(gridcoord)
+          continue
+        row = self._row(gridcoord)
+        if row == None:
+          self._append_row(gridcoord, ptype, body)
+        else:
+          self._set_row_ptype(row, gridcoord, ptype)
+          self._set_row_body(row, gridcoord, body)
+
+  #### Particle editing
+
   def add_particle(self, gridcoord, particle_specs, body_specs):
     """ Add a new particle to the model with the given ParticleSpecs and BodySpecs objects.
     If there is already a particle at this coordinate, the existing particle's particle
     and body types are set to the given ParticleSpecs and BodySpecs objects.  """
-    if not self.has_particle(gridcoord):
-      particle = Particle(gridcoord, particle_specs, body_specs)
-      self.gridcoord_to_particle[gridcoord] = particle
-      self._particles.add(particle)
+    ptype = self._particle_specs_id(particle_specs)
+    body = self._body_specs_id(body_specs)
+    row = self._row(gridcoord)
+    if row == None:
+      self._append_row(gridcoord, ptype, body)
     else:
-      particle = self.gridcoord_to_particle[gridcoord]
-      particle.particle_specs = particle_specs
-      particle.body_specs = body_specs
-    return particle
+      self._set_row_ptype(row, gridcoord, ptype)
+      self._set_row_body(row, gridcoord, body)
+    return Particle(gridcoord, particle_specs, body_specs)
   def set_particle(self, gridcoord, particle):
-    """ Sets the particle at the given grid location to be the given particle.
-    If an existing particle is at this location, it is removed. """
+    """ Sets the particle at the given grid location to have the particle and body types of the given particle.
+    If an existing particle is at this location, it is replaced. """
     assert particle != None
-    self.remove_particle(gridcoord)
-    self.gridcoord_to_particle[gridcoord] = particle
-    self._particles.add(particle)
+    self.add_particle(gridcoord, particle.particle_specs, particle.body_specs)
   def remove_particle(self, gridcoord):
     """ Remove a given particle from the model, if it is in there.
     This method does nothing if the particle was not in the model """
-    if self.has_particle(gridcoord):
-      p = self.gridcoord_to_particle[gridcoord]
-      del self.gridcoord_to_particle[gridcoord]
-      self._particles.remove(p)
+    row = self._row(gridcoord)
+    if row == None:
+      return
+    self._own_columns()
+    self._version = next(_versions)
+    self._chunk_discard(gridcoord)
+    if self._tx != None:
+      self._tx.touch(gridcoord, (int(self._ptypes[row]), int(self._bodies[row])))
+    else:
+      self._stats_discard(gridcoord)
+      self._members_discard(self._ptype_members, self._ptypes[row], gridcoord)
+      self._members_discard(self._body_members, self._bodies[row], gridcoord)
+    last = self._count - 1
+    if row != last:
+      ## Swap-remove: move the last row into the freed slot
+      self._xs[row] = self._xs[last]
+      self._ys[row] = self._ys[last]
+      self._ptypes[row] = self._ptypes[last]
+      self._bodies[row] = self._bodies[last]
+      self._chunk_set((int(self._xs[row]), int(self._ys[row])), row)
+    self._count = last
+  def clear(self):
+    """ Removes all particles from the model. """
+    self._init_storage()
+
+  def set_particle_type(self, gridcoord, particle_specs):
+    """ Sets the particle type of the existing particle at the given grid coordinate. """
+    row = self._row(gridcoord)
+    if row == None:
+      raise KeyError(gridcoord)
+    self._set_row_ptype(row, gridcoord, self._particle_specs_id(particle_specs))
+  def set_body_type(self, gridcoord, body_specs):
+    """ Sets the body type of the existing particle at the given grid coordinate. """
+    row = self._row(gridcoord)
+    if row == None:
+      raise KeyError(gridcoord)
+    self._set_row_body(row, gridcoord, self._body_specs_id(body_specs))
+
+  #### Particle information
+
   def has_particle(self, gridcoord):
     """ Returns True iff there is a particle in the model at the given grid coordinate. """
-    return gridcoord in self.gridcoord_to_particle
+    return self._row(gridcoord) != None
 
   def get_particle(self, gridcoord):
-    """ Returns the associated particle at this location, or None if none exists. """
-    if self.has_particle(gridcoord):
-      return self.gridcoord_to_particle[gridcoord]
-    else:
+    """ Returns a Particle describing this location, or None if none exists. """
+    row = self._row(gridcoord)
+    if row == None:
       return None
+    return Particle(gridcoord, self._particle_specs[self._ptypes[row]], self._body_specs[self._bodies[row]])
+
+  def get_particle_type(self, gridcoord):
+    """ Returns the ParticleSpecs of the particle at this location, or None if none exists. """
+    row = self._row(gridcoord)
+    return None if row == None else self._particle_specs[self._ptypes[row]]
+  def get_body_type(self, gridcoord):
+    """ Returns the BodySpecs of the particle at this location, or None if none exists. """
+    row = self._row(gridcoord)
+    return None if row == None else self._body_specs[self._bodies[row]]
+
+  def body_gridcoords(self, body_specs):
+    """ Returns the set of grid coordinates of the particles with the given BodySpecs.
+    The set belongs to the model and must not be modified. """
+    self._flush_indexes()
+    body = self._body_specs_ids.get(body_specs)
+    return self._body_members.get(body, frozenset())
+  def particle_type_gridcoords(self, particle_specs):
+    """ Returns the set of grid coordinates of the particles with the given ParticleSpecs.
+    The set belongs to the model and must not be modified. """
+    self._flush_indexes()
+    ptype = self._particle_specs_ids.get(particle_specs)
+    return self._ptype_members.get(ptype, frozenset())
+
+  def body_specs_in_use(self):
+    """ Returns a list of the BodySpecs assigned to at least one particle. """
+    self._flush_indexes()
+    return [self._body_specs[body] for body in self._body_members]
+  def particle_specs_in_use(self):
+    """ Returns a list of the ParticleSpecs assigned to at least one particle. """
+    self._flush_indexes()
+    return [self._particle_specs[ptype] for ptype in self._ptype_members]
 
   def calc_connected_body_particles(self, gridcoord):
-    '''returns a list of particles in the same body as particle'''
-    body = particle.body_specs
-    buddies = []
-    for ite in self.particles:
-      if ite.body_specs == body and ite.present: 
-        buddies.append(ite)
-    return buddies
+    """ Returns the set of grid coordinates of all particles in the same body as the particle
+    at the given grid coordinate, or an empty set if there is no particle there. """
+    self._flush_indexes()
+    row = self._row(gridcoord)
+    if row == None:
+      return frozenset()
+    return self._body_members[int(self._bodies[row])]
 
   def calc_bbox(self):
-    return self.grid.calc_bbox([p.gridcoord for p in self._particles])
+    """ Returns the smallest grid coordinate bounding box containing every particle, or None if the model is empty. """
+    self._flush_indexes()
+    if self._bbox_stale:
+      if self._count == 0:
+        self._bbox = None
+      else:
+        self._bbox = (min(self._x_hist), min(self._y_hist), max(self._x_hist) + 1, max(self._y_hist) + 1)
+      self._bbox_stale = False
+    return self._bbox
+
+  def axis_histogram(self, axis):
+    """ Returns a dict mapping each x (axis 0) or y (axis 1) coordinate in use to its number of particles.
+    The dict belongs to the model and must not be modified. """
+    self._flush_indexes()
+    return (self._x_hist if axis == 0 else self._y_hist).as_dict()
+
+  #### Range queries
+
+  def particles_in_bbox(self, box):
+    """ Returns a list of the grid coordinates of all particles within the given grid coordinate bounding box. """
+    if box == None:
+      return []
+    gridcoords = []
+    for key in self._chunk_keys_in_bbox(box):
+      rows, origin = self._chunk_rows_in_bbox(key, box)
+      xs, ys = np.nonzero(rows >= 0)
+      gridcoords.extend(zip((xs + origin[0]).tolist(), (ys + origin[1]).tolist()))
+    return gridcoords
+
+  def rows_in_bbox(self, box):
+    """ Returns an array of the rows (indices into xs, ys, etc.) of all particles within the given grid coordinate bounding box. """
+    if box == None:
+      return np.zeros(0, dtype = np.int32)
+    rows = [np.zeros(0, dtype = np.int32)]
+    for key in self._chunk_keys_in_bbox(box):
+      chunk_rows = self._chunk_rows_in_bbox(key, box)[0]
+      rows.append(chunk_rows[chunk_rows >= 0])
+    return np.concatenate(rows)
+
+  def aggregate_blocks(self, box, block_size):
+    """ Summarizes the particles in blocks of block_size x block_size cells, for drawing a zoomed out model.
+    Blocks are aligned to multiples of block_size, which must divide CHUNK_SIZE, so each block lies within a chunk.
+    Returns arrays of the grid coordinates of the first cell of each occupied block overlapping the bounding box,
+    and a (block, particle type id) array of the number of particles of each type in each block. """
+    assert CHUNK_SIZE % block_size == 0, 'Block size must divide the chunk size {0}'.format(CHUNK_SIZE)
+    ntypes = len(self._particle_specs)
+    n = CHUNK_SIZE // block_size
+    block_xs, block_ys = np.divmod(np.arange(n * n), n)
+    block_xs, block_ys = block_xs * block_size, block_ys * block_size
+    offsets = (np.arange(n * n) * (ntypes + 1))[:, np.newaxis]
+    xs, ys, type_counts = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)], [np.zeros((0, ntypes), dtype = np.int64)]
+    for key in self._chunk_keys_in_bbox(box):
+      rows = self._chunks[key]
+      ## Type id of each cell, with ntypes for empty cells, grouped into one row of cells per block
+      ptypes = np.where(rows >= 0, self._ptypes[rows], ntypes)
+      ptypes = ptypes.reshape(n, block_size, n, block_size).transpose(0, 2, 1, 3).reshape(n * n, -1)
+      counts = np.bincount((ptypes + offsets).ravel(), minlength = n * n * (ntypes + 1)).reshape(n * n, ntypes + 1)[:, :ntypes]
+      x0s, y0s = block_xs + (key[0] << CHUNK_SHIFT), block_ys + (key[1] << CHUNK_SHIFT)
+      keep = (counts.sum(axis = 1) > 0) & (x0s + block_size > box[0]) & (x0s < box[2]) & (y0s + block_size > box[1]) & (y0s < box[3])
+      xs.append(x0s[keep])
+      ys.append(y0s[keep])
+      type_counts.append(counts[keep])
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(type_counts)
+
+  def count_in_bbox(self, box):
+    """ Returns the number of particles within the given grid coordinate bounding box. """
+    if box == None:
+      return 0
+    count = 0
+    for key in self._chunk_keys_in_bbox(box):
+      if self._chunk_covered(key, box):
+        count += self._chunk_counts[key]
+      else:
+        count += int(np.count_nonzero(self._chunk_rows_in_bbox(key, box)[0] >= 0))
+    return count
+
+  def iter_occupied_chunks(self, box = None):
+    """ Returns an iterator over (chunk_bbox, count) pairs, one for each chunk that contains particles
+    and overlaps the given bounding box (or every occupied chunk, if box is omitted).
+    chunk_bbox is the grid coordinate bounding box of the whole chunk and count is its number of particles. """
+    keys = self._chunks.keys() if box == None else self._chunk_keys_in_bbox(box)
+    for key in keys:
+      x0, y0 = key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT
+      yield (x0, y0, x0 + CHUNK_SIZE, y0 + CHUNK_SIZE), self._chunk_counts[key]
+
+  #### Change notification
+  ## Subscribers are not shared with copies and snapshots.
+
+  def subscribe(self, callback):
+    """ Has callback(change) called with a ModelChange for every change announced with notify(). """
+    if callback not in self._subscribers:
+      self._subscribers = self._subscribers + (callback,)
+  def unsubscribe(self, callback):
+    self._subscribers = tuple([c for c in self._subscribers if c != callback])
+  def notify(self, gridcoords = None, bbox = None, source = None):
+    """ Announces a change to the subscribers of this model, which costs nothing if there are none. The change
+    is described by the grid coordinates that changed, or else a grid coordinate bounding box containing them,
+    or else by neither if anything may have changed. source is the object that made the change, if known. """
+    if len(self._subscribers) == 0:
+      return
+    if self._tx != None:
+      self._tx.changes.append(ModelChange(self, gridcoords, bbox, source))
+      return
+    change = ModelChange(self, gridcoords, bbox, source)
+    for callback in self._subscribers:
+      callback(change)
+
+  #### Transactions
+
+  def transaction(self):
+    """ Returns a context manager for making many edits at once:
+      with model.transaction():
+        ...
+    Inside the transaction, edits update the model's rows and chunks as usual, but the histograms, bounding box
+    and member sets are only updated when the transaction ends, in bulk for all the grid coordinates it touched
+    (or earlier, the first time a query needs them). Changes announced with notify() are merged and delivered
+    to the subscribers as a single ModelChange when the transaction ends. Transactions may be nested; the
+    outermost one does the work. """
+    return _Transaction(self)
+
+  def _flush_indexes(self):
+    """ Brings the indexes deferred by the open transaction, if any, up to date. """
+    if self._tx == None or len(self._tx.old) == 0:
+      return
+    old, self._tx.old = self._tx.old, dict()
+    gcs = old.keys()
+    xs = np.array([gc[0] for gc in gcs], dtype = np.int64)
+    ys = np.array([gc[1] for gc in gcs], dtype = np.int64)
+    old_types = np.array([(-1, -1) if v == None else v for v in old.itervalues()], dtype = np.int64).reshape(-1, 2)
+    rows = self.rows_at(xs, ys)
+    present = rows >= 0
+    new_types = np.empty((len(gcs), 2), dtype = np.int64)
+    new_types.fill(-1)
+    new_types[present, 0] = self._ptypes[rows[present]]
+    new_types[present, 1] = self._bodies[rows[present]]
+
+    ## Histograms and bounding box
+    was_present = old_types[:, 0] >= 0
+    removed, added = was_present & ~present, present & ~was_present
+    for values, hist, edges in ((xs, self._x_hist, (0, 2)), (ys, self._y_hist, (1, 3))):
+      for v, n in zip(*[a.tolist() for a in np.unique(values[removed], return_counts = True)]):
+        if hist[v] > n:
+          hist[v] -= n
+        else:
+          del hist[v]
+          if self._bbox != None and (v == self._bbox[edges[0]] or v + 1 == self._bbox[edges[1]]):
+            self._bbox_stale = True
+      for v, n in zip(*[a.tolist() for a in np.unique(values[added], return_counts = True)]):
+        hist[v] = hist.get(v, 0) + n
+    if added.any() and not self._bbox_stale:
+      box = (int(xs[added].min()), int(ys[added].min()), int(xs[added].max()) + 1, int(ys[added].max()) + 1)
+      self._bbox = box if self._bbox == None else _box_union(self._bbox, box)
+
+    ## Member sets
+    for column, members in ((0, self._ptype_members), (1, self._body_members)):
+      changed = old_types[:, column] != new_types[:, column]
+      for ids, update in ((old_types[:, column], self._members_discard_all), (new_types[:, column], self._members_add_all)):
+        keep = changed & (ids >= 0)
+        for (key,), idx in _group_rows(ids[keep]):
+          update(members, key, [gcs[i] for i in np.flatnonzero(keep)[idx].tolist()])
+
+  def _members_add_all(self, members, key, gridcoords):
+    if key in members:
+      members.writable(key).update(gridcoords)
+    else:
+      members[key] = set(gridcoords)
+  def _members_discard_all(self, members, key, gridcoords):
+    if len(members[key]) == len(gridcoords):
+      del members[key]
+    else:
+      members.writable(key).difference_update(gridcoords)
+
+  #### Storage internals
+
+  def _share(self, cls):
+    """ Returns a new model of class cls sharing all of this model's storage copy-on-write. """
+    self._flush_indexes()
+    m = cls.__new__(cls)
+    m._grid = self._grid
+    m._version = self._version
+    m._count = self._count
+    m._xs, m._ys, m._ptypes, m._bodies = self._xs, self._ys, self._ptypes, self._bodies
+    self._columns_owned = m._columns_owned = False
+    m._chunks = self._chunks.share()
+    m._chunk_counts = self._chunk_counts.share()
+    m._x_hist = self._x_hist.share()
+    m._y_hist = self._y_hist.share()
+    m._bbox = self._bbox
+    m._bbox_stale = self._bbox_stale
+    m._body_members = self._body_members.share()
+    m._ptype_members = self._ptype_members.share()
+    self._share_tables(m)
+    return m
+
+  def _share_tables(self, m):
+    m._particle_specs = self._particle_specs
+    m._particle_specs_ids = self._particle_specs_ids
+    m._body_specs = self._body_specs
+    m._body_specs_ids = self._body_specs_ids
+    self._tables_owned = m._tables_owned = False
+
+  def _own_columns(self):
+    """ Makes sure the column arrays are private to this model before they are modified. """
+    if not self._columns_owned:
+      self._xs, self._ys = self._xs.copy(), self._ys.copy()
+      self._ptypes, self._bodies = self._ptypes.copy(), self._bodies.copy()
+      self._columns_owned = True
+  def _own_tables(self):
+    """ Makes sure the specs tables are private to this model before they are extended. """
+    if not self._tables_owned:
+      self._particle_specs = list(self._particle_specs)
+      self._particle_specs_ids = self._particle_specs_ids.copy()
+      self._body_specs = list(self._body_specs)
+      self._body_specs_ids = self._body_specs_ids.copy()
+      self._tables_owned = True
+
+  def _load_rows(self, xs, ys, ptypes, bodies):
+    """ Fills an empty model from column arrays of particles at distinct grid coordinates,
+    building the chunk, histogram and member indexes with array operations. """
+    count = len(xs)
+    self._version = next(_versions)
+    self._reserve(count)
+    self._xs[:count], self._ys[:count] = xs, ys
+    self._ptypes[:count], self._bodies[:count] = ptypes, bodies
+    self._count = count
+    if count == 0:
+      return
+    xs, ys = self.xs.astype(np.int64), self.ys.astype(np.int64)
+    for key, idx in _group_rows(xs >> CHUNK_SHIFT, ys >> CHUNK_SHIFT):
+      rows = np.empty((CHUNK_SIZE, CHUNK_SIZE), dtype = np.int32)
+      rows.fill(-1)
+      rows[xs[idx] & CHUNK_MASK, ys[idx] & CHUNK_MASK] = idx
+      self._chunks[key] = rows
+      self._chunk_counts[key] = len(idx)
+    for values, hist in ((xs, self._x_hist), (ys, self._y_hist)):
+      values, counts = np.unique(values, return_counts = True)
+      hist.update(zip(values.tolist(), counts.tolist()))
+    for ids, members in ((self.particle_type_ids, self._ptype_members), (self.body_ids, self._body_members)):
+      for (key,), idx in _group_rows(ids):
+        members[key] = set(zip(xs[idx].tolist(), ys[idx].tolist()))
+    self._bbox = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+    self._bbox_stale = False
+
+  def _row(self, gridcoord):
+    """ Returns the row of the particle at the given grid coordinate, or None if there is none. """
+    x, y = gridcoord
+    rows = self._chunks.get((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+    if rows is None:
+      return None
+    row = rows.item(x & CHUNK_MASK, y & CHUNK_MASK)
+    return None if row < 0 else row
+
+  def _row_particle(self, row):
+    gridcoord = (int(self._xs[row]), int(self._ys[row]))
+    return Particle(gridcoord, self._particle_specs[self._ptypes[row]], self._body_specs[self._bodies[row]])
+
+  def _append_row(self, gridcoord, ptype, body):
+    row = self._count
+    if row == len(self._xs):
+      self._reserve(2 * row)
+    self._own_columns()
+    self._version = next(_versions)
+    self._xs[row], self._ys[row] = gridcoord
+    self._ptypes[row] = ptype
+    self._bodies[row] = body
+    self._count = row + 1
+    self._chunk_add(gridcoord, row)
+    if self._tx != None:
+      self._tx.touch(gridcoord, None)
+      return
+    self._stats_add(gridcoord)
+    self._members_add(self._ptype_members, ptype, gridcoord)
+    self._members_add(self._body_members, body, gridcoord)
+
+  def _set_row_ptype(self, row, gridcoord, ptype):
+    old = self._ptypes[row]
+    if old != ptype:
+      self._own_columns()
+      self._version = next(_versions)
+      if self._tx != None:
+        self._tx.touch(gridcoord, (int(old), int(self._bodies[row])))
+      else:
+        self._members_discard(self._ptype_members, old, gridcoord)
+        self._members_add(self._ptype_members, ptype, gridcoord)
+      self._ptypes[row] = ptype
+  def _set_row_body(self, row, gridcoord, body):
+    old = self._bodies[row]
+    if old != body:
+      self._own_columns()
+      self._version = next(_versions)
+      if self._tx != None:
+        self._tx.touch(gridcoord, (int(self._ptypes[row]), int(old)))
+      else:
+        self._members_discard(self._body_members, old, gridcoord)
+        self._members_add(self._body_members, body, gridcoord)
+      self._bodies[row] = body
+
+  def _members_add(self, members, key, gridcoord):
+    key = int(key)
+    if key in members:
+      members.writable(key).add(gridcoord)
+    else:
+      members[key] = set([gridcoord])
+  def _members_discard(self, members, key, gridcoord):
+    key = int(key)
+    if len(members[key]) == 1:
+      del members[key]
+    else:
+      members.writable(key).discard(gridcoord)
+
+  def _stats_add(self, gridcoord):
+    x, y = gridcoord
+    self._x_hist[x] = self._x_hist.get(x, 0) + 1
+    self._y_hist[y] = self._y_hist.get(y, 0) + 1
+    if self._bbox_stale:
+      return
+    if self._bbox == None:
+      self._bbox = (x, y, x + 1, y + 1)
+    else:
+      min_x, min_y, max_x, max_y = self._bbox
+      if not (min_x <= x < max_x and min_y <= y < max_y):
+        self._bbox = (min(min_x, x), min(min_y, y), max(max_x, x + 1), max(max_y, y + 1))
+  def _stats_discard(self, gridcoord):
+    x, y = gridcoord
+    for v, hist, edges in ((x, self._x_hist, (0, 2)), (y, self._y_hist, (1, 3))):
+      n = hist[v] - 1
+      if n > 0:
+        hist[v] = n
+      else:
+        del hist[v]
+        ## The bbox only shrinks if the last particle on one of its edges was removed
+        if self._bbox != None and (v == self._bbox[edges[0]] or v + 1 == self._bbox[edges[1]]):
+          self._bbox_stale = True
+
+  def _chunk_add(self, gridcoord, row):
+    x, y = gridcoord
+    key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+    if key in self._chunks:
+      rows = self._chunks.writable(key)
+      self._chunk_counts[key] += 1
+    else:
+      rows = self._chunks[key] = np.empty((CHUNK_SIZE, CHUNK_SIZE), dtype = np.int32)
+      rows.fill(-1)
+      self._chunk_counts[key] = 1
+    rows[x & CHUNK_MASK, y & CHUNK_MASK] = row
+  def _chunk_set(self, gridcoord, row):
+    x, y = gridcoord
+    self._chunks.writable((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))[x & CHUNK_MASK, y & CHUNK_MASK] = row
+  def _chunk_discard(self, gridcoord):
+    x, y = gridcoord
+    key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+    count = self._chunk_counts[key] - 1
+    if count == 0:
+      del self._chunks[key]
+      del self._chunk_counts[key]
+    else:
+      self._chunk_counts[key] = count
+      self._chunk_set(gridcoord, -1)
+
+  def _chunk_keys_in_bbox(self, box):
+    """ Returns the keys of the occupied chunks overlapping the given grid coordinate bounding box. """
+    min_cx, min_cy = box[0] >> CHUNK_SHIFT, box[1] >> CHUNK_SHIFT
+    max_cx, max_cy = (box[2] - 1) >> CHUNK_SHIFT, (box[3] - 1) >> CHUNK_SHIFT
+    if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) < len(self._chunks):
+      keys = it.product(xrange(min_cx, max_cx + 1), xrange(min_cy, max_cy + 1))
+      return [key for key in keys if key in self._chunks]
+    else:
+      return [key for key in self._chunks if min_cx <= key[0] <= max_cx and min_cy <= key[1] <= max_cy]
+  def _chunk_rows_in_bbox(self, key, box):
+    """ Returns the part of a chunk's row grid inside the bounding box, and the grid coordinate of its first cell. """
+    x0, y0 = key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT
+    min_x, min_y = max(box[0], x0), max(box[1], y0)
+    max_x, max_y = min(box[2], x0 + CHUNK_SIZE), min(box[3], y0 + CHUNK_SIZE)
+    rows = self._chunks[key][min_x - x0:max_x - x0, min_y - y0:max_y - y0]
+    return rows, (min_x, min_y)
+  def _chunk_covered(self, key, box):
+    x0, y0 = key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT
+    return box[0] <= x0 and box[1] <= y0 and x0 + CHUNK_SIZE <= box[2] and y0 + CHUNK_SIZE <= box[3]
+
+  def _reserve(self, capacity):
+    """ Grows the column arrays so they can hold at least capacity rows. """
+    if capacity <= len(self._xs):
+      return
+    for name in ('_xs', '_ys', '_ptypes', '_bodies'):
+      old = getattr(self, name)
+      new = np.zeros(capacity, dtype = old.dtype)
+      new[:self._count] = old[:self._count]
+      setattr(self, name, new)
+    self._columns_owned = True
+
+  def _particle_specs_id(self, specs):
+    specs_id = self._particle_specs_ids.get(specs)
+    if specs_id == None:
+      self._own_tables()
+      specs_id = len(self._particle_specs)
+      self._particle_specs.append(specs)
+      self._particle_specs_ids[specs] = specs_id
+    return specs_id
+  def _body_specs_id(self, specs):
+    specs_id = self._body_specs_ids.get(specs)
+    if specs_id == None:
+      self._own_tables()
+      specs_id = len(self._body_specs)
+      self._body_specs.append(specs)
+      self._body_specs_ids[specs] = specs_id
+    return specs_id
+
+
+class ModelChange(object):
+  """ A change to a Model, as passed to its subscribers by Model.notify(). gridcoords is the collection of grid
+  coordinates that changed, or None; bbox is a grid coordinate bounding box containing every change, or None.
+  If both are None, anything in the model may have changed. """
+
+  def __init__(self, model, gridcoords = None, bbox = None, source = None):
+    self.model = model
+    self.gridcoords = gridcoords
+    self.bbox = bbox
+    self.source = source
+
+  @property
+  def everything(self):
+    return self.gridcoords == None and self.bbox == None
+
+  @staticmethod
+  def merge(changes):
+    """ Returns a single ModelChange covering all of the given changes to one model. """
+    sources = set([c.source for c in changes])
+    source = sources.pop() if len(sources) == 1 else None
+    model = changes[0].model
+    if any([c.everything for c in changes]):
+      return ModelChange(model, source = source)
+    if all([c.gridcoords != None for c in changes]):
+      return ModelChange(model, set().union(*[c.gridcoords for c in changes]), source = source)
+    boxes = [c.bbox for c in changes if c.bbox != None]
+    for c in changes:
+      if c.gridcoords != None and len(c.gridcoords) > 0:
+        xs, ys = zip(*c.gridcoords)
+        boxes.append((min(xs), min(ys), max(xs) + 1, max(ys) + 1))
+    return ModelChange(model, bbox = reduce(_box_union, boxes), source = source)
+
+  def __repr__(self):
+    if self.gridcoords != None:
+      return 'ModelChange({0} gridcoords)'.format(len(self.gridcoords))
+    return 'ModelChange(bbox = {0})'.format(self.bbox)
+
+
+class _Transaction(object):
+  """ The context manager returned by Model.transaction(). """
+
+  def __init__(self, model):
+    self.model = model
+    self.nested = False
+    self.old = dict() # grid coordinate -> (type id, body id) when first touched, or None if it was empty
+    self.changes = [] # ModelChanges announced with notify() during the transaction
+
+  def touch(self, gridcoord, old):
+    """ Records the state of the cell at the grid coordinate before it is first changed. """
+    if gridcoord not in self.old:
+      self.old[gridcoord] = old
+
+  def __enter__(self):
+    self.nested = self.model._tx != None
+    if not self.nested:
+      self.model._tx = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.nested:
+      return False
+    model = self.model
+    try:
+      model._flush_indexes()
+    finally:
+      model._tx = None
+    if len(self.changes) > 0:
+      change = ModelChange.merge(self.changes)
+      model.notify(change.gridcoords, change.bbox, change.source)
+    return False
+
+
+class ModelSnapshot(Model):
+  """ A read-only Model holding the contents of another Model at the time of its snapshot() call.
+  The snapshot shares its storage with that model, so it costs O(1) to take and keep; copy() returns an
+  editable Model starting from the snapshot's contents, also in O(1). """
+
+  def snapshot(self):
+    return self
+
+  def _read_only(self, *args, **kargs):
+    assert False, "A ModelSnapshot cannot be modified; edit a copy() of it instead"
+  init_grid = add_particle = set_particle = remove_particle = clear = _read_only
+  set_particle_type = set_body_type = set_type_ids_at = _read_only
+
+
+class _CowDict(object):
+  """ A dict shared copy-on-write between models. share() returns a second _CowDict over the same storage;
+  after that, the first write through either one copies the dict (a shallow copy). If the values are mutable
+  containers, copy_value is used to copy each value the first time it is modified through writable().
+  Values read with get() or [] must not be modified. """
+  __slots__ = ('_data', '_own_data', '_owned_values', '_copy_value')
+
+  def __init__(self, copy_value = None):
+    self._data = dict()
+    self._own_data = True
+    self._owned_values = None # keys whose values are private to this dict, or None if all are
+    self._copy_value = copy_value
+
+  def share(self):
+    other = _CowDict(self._copy_value)
+    other._data = self._data
+    self._own_data = other._own_data = False
+    if self._copy_value != None:
+      self._owned_values, other._owned_values = set(), set()
+    return other
+
+  def as_dict(self):
+    """ Returns the underlying dict, which must not be modified. """
+    return self._data
+
+  def get(self, key, default = None):
+    return self._data.get(key, default)
+  def keys(self):
+    return self._data.keys()
+  def __getitem__(self, key):
+    return self._data[key]
+  def __contains__(self, key):
+    return key in self._data
+  def __iter__(self):
+    return iter(self._data)
+  def __len__(self):
+    return len(self._data)
+
+  def writable(self, key):
+    """ Returns the value for key, first copying it if it is shared with another _CowDict. """
+    value = self._data[key]
+    if self._owned_values != None and key not in self._owned_values:
+      value = self._copy_value(value)
+      self[key] = value
+    return value
+
+  def __setitem__(self, key, value):
+    self._own()[key] = value
+    if self._owned_values != None:
+      self._owned_values.add(key)
+  def __delitem__(self, key):
+    del self._own()[key]
+    if self._owned_values != None:
+      self._owned_values.discard(key)
+  def update(self, items):
+    for key, value in items:
+      self[key] = value
+
+  def _own(self):
+    if not self._own_data:
+      self._data = self._data.copy()
+      self._own_data = True
+    return self._data
+
+
+def _box_union(box1, box2):
+  return (min(box1[0], box2[0]), min(box1[1], box2[1]), max(box1[2], box2[2]), max(box1[3], box2[3]))
+
+def _group_rows(*keys):
+  """ Groups the indices of equal-length key arrays by their key values.
+  Returns a list of (key tuple, index array) pairs, one for each distinct combination of keys. """
+  if len(keys[0]) == 0:
+    return []
+  order = np.lexsort(keys[::-1])
+  sorted_keys = [key[order] for key in keys]
+  changed = np.zeros(len(order), dtype = np.bool_)
+  changed[0] = True
+  for key in sorted_keys:
+    changed[1:] |= key[1:] != key[:-1]
+  starts = np.flatnonzero(changed).tolist()
+  ends = starts[1:] + [len(order)]
+  return [(tuple([int(key[s]) for key in sorted_keys]), order[s:e]) for s, e in zip(starts, ends)]
@@ -2,12 +2,16 @@
 import Tkinter as tk
 import ttk
 import itertools as it
+import time
 
 from model import Model
 #from model_canvas_operation import MCO_Move
 #from particle import DrawnParticle
 #import grid
 import utils
+from journal import Journal
+from item_pool import ItemPool
+import instrument
 #import Operation
 #from brush import Brush
 #from copy import deepcopy
@@ -21,6 +25,17 @@ sticky_all = tk.N + tk.S + tk.E + tk.W
 #MOD_LEFTALT = 0x0008  
 
 class ModelCanvas(tk.Canvas, object):
+  """ Layer updates requested with update_layer() are coalesced into frames: a layer is updated at most once
+  per frame however many times it is requested, and frames are at least frame_interval milliseconds apart.
+  The counters in update_stats show how much work this saves:
+    requested: calls to update_layer()
+    coalesced: requests for a layer already waiting for the next frame
+    delayed: frames put off to keep to frame_interval
+    dropped: updates skipped because the layer was cleaned before its frame
+    frames, updates: frames run and layer updates done in them """
+
+  frame_interval = 16 # milliseconds, about 60 frames per second
+
   def __init__(self, master, model = None, mode = 'view', **kargs):
     tk.Canvas.__init__(self, master, bd = 0, highlightthickness = 0, takefocus=1, **kargs)
 
@@ -28,6 +43,17 @@ class ModelCanvas(tk.Canvas, object):
     self._model = model
     self._layers = []
 
+    ## Undo/redo history shared by the layers' models
+    self.journal = Journal()
+    ## Ovals leased by the layers to draw particles
+    self.item_pool = ItemPool(self)
+
+    ## Layers waiting for the next frame, in the order their updates were requested
+    self._pending_updates = []
+    self._frame_id = None
+    self._last_frame = 0.0
+    self.update_stats = dict(requested = 0, coalesced = 0, delayed = 0, dropped = 0, frames = 0, updates = 0)
+
     ## Set up base layer for either editing or viewing. The thumbnails in the list of
     ## models are set up for viewing mode while the main design box is set up for
     ## editing mode.
@@ -55,23 +81,73 @@ class ModelCanvas(tk.Canvas, object):
   def pop_layer(self):
     return self._layers.pop()
 
+  @instrument.timed('canvas.start_layer')
   def start_layer(self, layer):
     self.top_layer().pause()
     self.push_layer(layer)
     self.top_layer().start()
+  @instrument.timed('canvas.merge_top_layer')
   def merge_top_layer(self):
     layer = self.pop_layer()
     layer.finish()
     self.top_layer().merge(layer)
     layer.clean()
+    self.journal.discard(layer.model)
     self.top_layer().resume()
+  @instrument.timed('canvas.cancel_top_layer')
   def cancel_top_layer(self):
     layer = self._layers.pop()
     layer.cancel()
     layer.clean()
+    self.journal.discard(layer.model)
     self.top_layer().resume()
 
+  def xview(self, *args):
+    """ Extends Canvas.xview() to generate a <<Scroll>> event when the view is scrolled. """
+    result = tk.Canvas.xview(self, *args)
+    if len(args) > 0:  self.event_generate('<<Scroll>>', when = 'tail')
+    return result
+  def yview(self, *args):
+    """ Extends Canvas.yview() to generate a <<Scroll>> event when the view is scrolled. """
+    result = tk.Canvas.yview(self, *args)
+    if len(args) > 0:  self.event_generate('<<Scroll>>', when = 'tail')
+    return result
+
+  def restack_layers(self):
+    """ Raises the items of each layer above those of the layers below it, e.g. after a layer
+    has been given ovals from the item pool, which keep their old place in the stacking order. """
+    for layer in self._layers:
+      self.tag_raise(layer._tag)
+
   def update_layer(self, layer):
-    self.after_idle(layer.update)
+    """ Requests an update of the layer in the next frame. """
+    self.update_stats['requested'] += 1
+    if layer in self._pending_updates:
+      self.update_stats['coalesced'] += 1
+      return
+    self._pending_updates.append(layer)
+    if self._frame_id == None:
+      wait = int(self.frame_interval - (time.time() - self._last_frame) * 1000)
+      if wait > 0:
+        self.update_stats['delayed'] += 1
+        self._frame_id = self.after(wait, self.run_frame)
+      else:
+        self._frame_id = self.after_idle(self.run_frame)
     #print 'update requested:', layer
 
+  @instrument.timed('canvas.frame')
+  def run_frame(self):
+    """ Updates the layers waiting for the next frame. Updates requested meanwhile wait for the frame after. """
+    if self._frame_id != None:
+      self.after_cancel(self._frame_id)
+      self._frame_id = None
+    self._last_frame = time.time()
+    layers, self._pending_updates = self._pending_updates, []
+    self.update_stats['frames'] += 1
+    for layer in layers:
+      if layer.cleaned:
+        self.update_stats['dropped'] += 1
+        continue
+      layer.update()
+      self.update_stats['updates'] += 1
+
@@ -2,10 +2,14 @@ import Tkinter as tk
 
 import itertools
 
-from copy import deepcopy
+import numpy as np
 
 import utils
-from model import Model
+import event_store
+import instrument
+import colors
+import body_analysis
+import raster
 from particle import Particle, DrawnParticle
 
 MOD_SHIFT = 0x1
@@ -76,7 +80,7 @@ particles to be selected and implementing smart update strategies for drawing pa
 ###        self.model, set_model()
 ###      model viewing parameters:
 ###        diameter: diameter of drawnparticles
-###        zoom: overall scaling of model
+###        zoom: overall scaling of model (ovals are scaled in place, then snapped by relayout())
 ###        padding: padding (in units of diameter) around model
 ###      basic bounding box calculations
 ###        model_bbox(), visible_bbox()
@@ -85,11 +89,17 @@ particles to be selected and implementing smart update strategies for drawing pa
 ###        'scroll' (scrollregion always set to union of visible_bbox and model_bbox)
 ###        'none' (no automatic changes to view)
 ###      separate update functions for updating view and particles
-###        update(), update_view(), update_particles()
+###        update(), update_view(), update_particles(), update_items()
+###      batched canvas item commands, with Tcl commands counted in self.tcl_calls
+###        set_items_coords(), tag_items(), untag_items(), configure_items()
 ###      gridcoord-based particle actions
 ###        add_particle_at(), get_particle_at(), set_particle_at(), add_particles_at()
 ###      dirty updating model for efficiently updating displayed particles
-###        get_dirty(), mark_dirty(), mark_clean()
+###        get_dirty(), mark_dirty(), mark_dirty_at(), mark_clean()
+###      rendering modes: self.render_mode =
+###        'ovals' (one canvas oval per drawn particle)
+###        'raster' (particles rasterized into image tiles, see raster.py)
+###        'auto' (raster once the model has raster_threshold particles, or when zoomed far out)
 ###      gridcoord/particle iterators
 ###        points_iterator()
 ###        particles_iterator(), model_particles_iterator(), nonmodel_particles_iterator()
@@ -98,14 +108,16 @@ particles to be selected and implementing smart update strategies for drawing pa
 ###        particle_in_model(), particle_hidden()
 ###        particle_coords(), particle_params()
 ###      event handlers:
-###        handle_resize(), handle_model_event() [alive]
+###        handle_resize() [alive]
+###      model changes: subscribed to the displayed model while alive
+###        handle_model_change()
 ###  * SelectLayer(ViewLayer)
 ###      selections of particles
 ###        self.selected
 ###      selection modification utilities
 ###        new_selection(), box_selection(), body_selection(), toggle_selection()
 ###      displaying selection
-###        update_particle() [EXTENDS ViewLayer.update_particle()]
+###        update_items() [EXTENDS ViewLayer.update_items()]
 ###      particle info
 ###        particle_selected(), point_selected()
 ###        particle_params() [EXTENDS ViewLayer.particle_params()]
@@ -122,6 +134,7 @@ particles to be selected and implementing smart update strategies for drawing pa
 ###  * EditBackgroundLayer(EditBasicLayer)
 ###      draw nonmodel particles
 ###  * MoveLayer(SelectLayer)
+###      drag preview: one canvas.move() of the moving tag per frame; particles are moved in the model on release
 ###  * RotateLayer(SelectLayer)
 ###  * FlipLayer(SelectLayer)
 
@@ -245,23 +258,39 @@ class ViewLayer(ModelCanvasLayer):
   """ The ViewLayer subclass implements a basic layer for displaying the particles
   in a Model object without implementing any editing functionality.
   Note that the pause(), resume(), finish(), and cancel() functions do nothing
-  here as no user input is captured and no operation performed. merge() throws an error if it is called. """
+  here as no user input is captured and no operation performed. merge() throws an error if it is called.
+  Large models are drawn as raster tiles rather than ovals (see render_mode). In raster mode, drawn particles
+  are only created on demand, e.g. when a particle is clicked or selected, and have no oval. """
+
+  render_mode = 'auto'
+  raster_threshold = 20000
+  raster_blank_cells = False # whether raster tiles show blank particles in empty cells
+  relayout_delay = 250 # milliseconds after the last zoom change before ovals are snapped to exact coordinates
 
   def __init__(self, canvas, model = None, points = None, viewmode = 'auto'):
     ModelCanvasLayer.__init__(self, canvas, model)
 
     # Set up set of points (grid coords) drawn in this layer
     if points != None:  self.points = set(points)
-    elif model != None:  self.points = set([p.gridcoord for p in model.particles])
+    elif model != None:  self.points = set(model.points_iterator())
     else:  self.points = set([])
     self._init_points = frozenset(self.points)
     #assert all([not isinstance(p, Particle) for p in self.points]), '__init__(): invalid points given'
 
     # Set up dict to map between drawn particles and grid coordinates
     self._gridcoord_to_particle = dict()
+    # Drawn particles shown by an oval leased from the canvas's item pool, and those still waiting for one
+    self._item_particles = set()
+    self._unleased = set()
+    # Coordinates and style last applied to each oval, and number of Tcl commands issued by the last update
+    self._item_state = dict()
+    self.tcl_calls = 0
+    # Raster tiles, in raster mode
+    self._tiles = None
 
     self._diameter = 20.0 ## diameter of spheres, in unzoomed distance units (pixels?)
     self._zoom = 1.0 ## Zoom level (1 = no zoom)
+    self._relayout_id = None
     self._padding = 10 ## Padding to surround model with, in units of cell diameter
 
     self._dirty = set([])
@@ -272,7 +301,6 @@ class ViewLayer(ModelCanvasLayer):
       self.canvas['scrollregion'] = (0, 0, 0, 0)
     
     self.add_event_handler(self.alive_event_handlers, '<Configure>', self.handle_resize)
-    self.add_event_handler(self.alive_event_handlers, '<<Model>>', self.handle_model_event, 'all')
 
     # Tags for particle manipulation
     self._universal_tag = 'MCL_object'
@@ -285,14 +313,14 @@ class ViewLayer(ModelCanvasLayer):
   def model(self):
     return self._model
   def set_model(self, model):
+    if self.alive and self._model != None:  self._model.unsubscribe(self.handle_model_change)
     self._model = model
+    if self.alive and model != None:  model.subscribe(self.handle_model_change)
     if model != None:  self.points |= set(model.points_iterator())
+    if self._tiles != None:  self._tiles.invalidate()
     if self.started and model != None:
       self.add_particles_at(self.points_iterator())
-      new_particles = set([self.get_particle_at(gc) for gc in self.points_iterator()])
-      dirty_particles = set(self.particles_iterator()) | new_particles
-
-      self.mark_dirty(dirty_particles)
+      self.mark_dirty()
       self.canvas.update_layer(self)
 
 
@@ -301,9 +329,24 @@ class ViewLayer(ModelCanvasLayer):
     return self._zoom
   @zoom.setter
   def zoom(self, zoom):
+    """ Zooming scales the layer's ovals about the canvas origin with a single canvas.scale(), which puts them
+    where they belong at the new zoom level since grid pixel coordinates are proportional to the diameter.
+    The ovals are snapped to their exact coordinates by relayout() once zooming has stopped for
+    relayout_delay milliseconds. In raster mode, the tiles are redrawn at the new zoom level instead. """
     if self._zoom == zoom:  return
+    scale = float(zoom) / self._zoom
     self._zoom = zoom
-    self.mark_dirty()
+    if self._tiles == None and len(self._item_particles) > 0:
+      self.canvas.scale(self._tag, 0, 0, scale, scale)
+      self.schedule_relayout()
+
+  @property
+  def rastered(self):
+    """ Whether the layer is drawn as raster tiles rather than ovals. In 'auto' mode, a layer is also
+    drawn as tiles when zoomed out too far to draw particles (see raster.LOD_LEVELS). """
+    if self.render_mode == 'auto':
+      return self.model != None and (len(self.model) >= self.raster_threshold or self.diameter < raster.MIN_OVAL_DIAMETER)
+    return self.render_mode == 'raster'
 
   @property
   def diameter(self):
@@ -328,7 +371,7 @@ class ViewLayer(ModelCanvasLayer):
   @property
   def model_bbox(self):
     """ Returns the bounding box for the model + padding. """
-    if self.model == None or len(self.model.particles) == 0:
+    if self.model == None or len(self.model) == 0:
       return None
     box = self.model.grid.gridcoord_to_pixel_bbox(self.model.calc_bbox(), self.diameter)
     pix_padding = self.padding * self.diameter
@@ -342,14 +385,15 @@ class ViewLayer(ModelCanvasLayer):
     return (topleft[0], topleft[1], topleft[0] + dims[0], topleft[1] + dims[1])
 
   #### Layer functionality
+  @instrument.timed('layer.start')
   def start(self):
     ModelCanvasLayer.start(self)
+    if self.model != None:  self.model.subscribe(self.handle_model_change)
 
     self.add_particles_at(self.points_iterator())
-    particles = set([self.get_particle_at(gc) for gc in self.points_iterator()])
 
     self.canvas.addtag_withtag(self._running_tag, self._tag)
-    self.mark_dirty(particles)
+    self.mark_dirty()
     self.canvas.update_layer(self)
 
   def merge(self, layer):
@@ -373,20 +417,30 @@ class ViewLayer(ModelCanvasLayer):
 
   def finish(self):
     ModelCanvasLayer.finish(self)
+    if self.model != None:  self.model.unsubscribe(self.handle_model_change)
     self.canvas.dtag(self._tag, self._running_tag)
   def cancel(self):
     ModelCanvasLayer.cancel(self)
+    if self.model != None:  self.model.unsubscribe(self.handle_model_change)
     self.canvas.dtag(self._tag, self._running_tag)
 
+  @instrument.timed('layer.clean')
   def clean(self):
+    """ Returns the layer's ovals to the canvas's item pool, and deletes its other items. """
     ModelCanvasLayer.clean(self)
+    if self._relayout_id != None:
+      self.canvas.after_cancel(self._relayout_id)
+      self._relayout_id = None
+    self.hide_particles(self._item_particles)
     self.canvas.delete(self._tag)
+    self._tiles = None
     #for p in self.particles_iterator():
     #  self.canvas.delete(p.oval_id)
 
 
   #### Display functionality
 
+  @instrument.timed('layer.update')
   def update(self):
     """ Update the zoom level and viewing box so the entire model is visible, and
     updates particles as needed. """
@@ -423,37 +477,128 @@ class ViewLayer(ModelCanvasLayer):
     self.canvas['scrollregion'] = utils.box_union(visible_box, model_box)
 
 
+  @instrument.timed('layer.update_particles')
   def update_particles(self):
     """ Add new particles to canvas and update for any changes since last update. """
-    ## Update locations/colors of particles on canvas
-    for p in self.get_dirty():
-      self.update_particle(p)
-    #if len(self.get_dirty()) > 0:  print 'updated', len(self.get_dirty()), 'particles'
+    if self.rastered:
+      self.update_tiles()
+    else:
+      if self._tiles != None:
+        self.stop_tiles()
+      ## Update locations/colors of particles on canvas
+      self.tcl_calls = 0
+      self.update_items(self.get_dirty())
+      instrument.count('layer.particles_updated', len(self.get_dirty()))
     #if self.canvas.find_withtag(self._universal_tag) != ():  self.canvas.tag_raise(self._running_tag, self._universal_tag)
     self.canvas.tag_raise(self._running_tag)
+    if self._tiles != None:
+      self.canvas.tag_lower(self._tiles.tag)
     self.mark_clean()
 
+  @instrument.timed('layer.update_tiles')
+  def update_tiles(self):
+    """ Redraws the raster tiles containing dirty particles, switching to raster mode if needed. """
+    if self._tiles == None:
+      self._tiles = raster.TileRenderer(self)
+      self.hide_particles(self._item_particles)
+    ## Tiles are drawn from the model, so drawn particles are only bound to the model when next drawn as ovals
+    dirty = self.get_dirty()
+    self._tiles.invalidate(None if len(dirty) > raster.MAX_INVALIDATE else [p.gridcoord for p in dirty])
+    self._tiles.update()
+  def stop_tiles(self):
+    """ Switches from raster mode back to drawing ovals. """
+    self._tiles.clear()
+    self._tiles = None
+    for p in list(self.particles_iterator()):
+      if self.point_in_window(p.gridcoord):
+        self.show_particle(p)
+    self.add_particles_at(self.points_iterator())
+
+  def schedule_relayout(self):
+    """ Runs relayout() relayout_delay milliseconds from now, unless it is scheduled again before then. """
+    if self._relayout_id != None:
+      self.canvas.after_cancel(self._relayout_id)
+    self._relayout_id = self.canvas.after(self.relayout_delay, self.relayout)
+  def relayout(self):
+    """ Sets the ovals scaled by zooming to their exact coordinates, undoing any rounding errors. """
+    self._relayout_id = None
+    self.mark_dirty(self._item_particles)
+    self.canvas.update_layer(self)
+
   def update_particle(self, p):
-    p.model_particle = self.model.get_particle(p.gridcoord)
-    coords = self.particle_coords(p)
-    params = self.particle_params(p)
-    if self.canvas.coords(p.oval_id) != coords:
-      self.canvas.coords(p.oval_id, *coords)
-    if any([self.canvas.itemcget(p.oval_id, key) != params[key] for key in params]):
-      self.canvas.itemconfigure(p.oval_id, **params)
+    self.update_items([p])
+
+  def update_items(self, particles):
+    """ Brings the ovals of the given drawn particles up to date with their coordinates and drawing parameters.
+    The coordinates and style last given to each oval are shadowed in self._item_state, so nothing is read back
+    from the canvas and unchanged ovals are not touched. All new coordinates are set with a single Tcl call,
+    and ovals are grouped by style so each distinct style takes one tag-based itemconfigure. """
+    self.lease_items()
+    moved = []
+    styles = dict()
+    for p in particles:
+      p.bind(self.model.get_particle_type(p.gridcoord), self.model.get_body_type(p.gridcoord))
+      if p.oval_id == None:
+        continue
+      coords = self.particle_coords(p)
+      style = tuple(sorted(self.particle_params(p).items()))
+      old = self._item_state.get(p.oval_id)
+      if old == None or old[0] != coords:
+        moved.append((p.oval_id, coords))
+      if old == None or old[1] != style:
+        styles.setdefault(style, []).append(p.oval_id)
+      self._item_state[p.oval_id] = (coords, style)
+
+    self.set_items_coords(moved)
+    for style, items in styles.iteritems():
+      self.configure_items(items, dict(style))
+
+  #### Batched canvas item commands
+  ### Each of these issues a single Tcl command, however many items it applies to
+
+  def tcl_eval(self, script):
+    self.tcl_calls += 1
+    instrument.count('tcl_calls.layer')
+    return self.canvas.tk.eval(script)
+  def set_items_coords(self, items):
+    """ Sets the coordinates of each canvas item in a list of (item, coords) pairs. """
+    if len(items) == 0:  return
+    values = ' '.join(['{0} {1!r} {2!r} {3!r} {4!r}'.format(item, *[float(v) for v in coords]) for item, coords in items])
+    self.tcl_eval('foreach {{i x0 y0 x1 y1}} {{{0}}} {{{1} coords $i $x0 $y0 $x1 $y1}}'.format(values, self.canvas._w))
+  def tag_items(self, items, tag):
+    """ Adds the tag to each of the canvas items. """
+    if len(items) == 0:  return
+    self.tcl_eval(self._tag_items_script(items, tag))
+  def untag_items(self, items, tag):
+    """ Removes the tag from each of the canvas items. """
+    if len(items) == 0:  return
+    self.tcl_eval('foreach i {{{0}}} {{{1} dtag $i {{{2}}}}}'.format(' '.join(map(str, items)), self.canvas._w, tag))
+  def configure_items(self, items, params):
+    """ Configures each of the canvas items with the dict of parameters, by tagging them with a temporary tag. """
+    if len(items) == 0:  return
+    tag = self._tag + '_batch'
+    options = ' '.join(['-{0} {{{1}}}'.format(key, value) for key, value in params.iteritems()])
+    self.tcl_eval('{0}\n{1} itemconfigure {{{2}}} {3}\n{1} dtag {{{2}}}'.format(
+        self._tag_items_script(items, tag), self.canvas._w, tag, options))
+  def _tag_items_script(self, items, tag):
+    return 'foreach i {{{0}}} {{{1} addtag {{{2}}} withtag $i}}'.format(' '.join(map(str, items)), self.canvas._w, tag)
 
   def add_particle_at(self, gridcoord):
-    """ Add a single new oval to the canvas at the particular grid coordinate. """
-    oval_id = self.canvas.create_oval(0, 0, 0, 0, tags = ('particle', self._tag, self._universal_tag), state = tk.HIDDEN)
-
+    """ Add a single new drawn particle at the particular grid coordinate, with an oval on the canvas if
+    the grid coordinate is within the layer's window (see point_in_window()). """
     model_p = self.model.get_particle(gridcoord)
-    p = DrawnParticle(gridcoord = gridcoord, oval_id = oval_id, model_particle = model_p)
+    p = DrawnParticle(gridcoord = gridcoord, oval_id = None, model_particle = model_p)
+    if self.point_in_window(gridcoord):
+      self.show_particle(p)
     self._gridcoord_to_particle[gridcoord] = p
     return p
   def remove_particle_at(self, gridcoord):
     self.model.remove_particle(gridcoord)
-    self.points.remove(gridcoord)
+    self.points.discard(gridcoord)
   def get_particle_at(self, gridcoord):
+    """ Returns the drawn particle at the grid coordinate. In raster mode, it is created if needed. """
+    if self.rastered and not self.point_drawn(gridcoord):
+      return self.add_particle_at(gridcoord)
     return self._gridcoord_to_particle[gridcoord]
   def set_particle_at(self, gridcoord, p):
     old = self.get_particle_at(gridcoord) if self.point_drawn(gridcoord) else self.add_particle_at(gridcoord)
@@ -467,17 +612,65 @@ class ViewLayer(ModelCanvasLayer):
   def add_particles_at(self, gridcoords):
     """ Checks the list of grid coordinates, adding any that have not yet been drawn.
     If gridcoords is omitted, all grid coordinates in the scrollable region are checked.
-    Slow, so don't call unless you need to. """
+    Slow, so don't call unless you need to. Does nothing in raster mode, where particles are created on demand. """
+    if self.rastered:
+      return
     particles = []
     for gridcoord in gridcoords:
       if not self.point_drawn(gridcoord) and not self.point_hidden(gridcoord):
         particles.append(self.add_particle_at(gridcoord))
     self.mark_dirty(particles)
-    if len(particles) > 0:  print 'added', len(particles), 'new particles'
+    instrument.count('layer.particles_added', len(particles))
   def remove_particles_at(self, gridcoords):
     for gridcoord in set(gridcoords):
       self.remove_particle_at(gridcoord)
 
+  def show_particle(self, p):
+    """ Gives the drawn particle an oval. The oval is leased from the canvas's item pool, placed and styled
+    by the next update of the particle, so the ovals of all particles shown in between are leased together. """
+    if p in self._item_particles:
+      return
+    self._item_particles.add(p)
+    self._unleased.add(p)
+    self.mark_dirty([p])
+  def hide_particle(self, p):
+    self.hide_particles([p])
+  def hide_particles(self, particles):
+    """ Takes the ovals away from the drawn particles, returning them to the canvas's item pool. """
+    items = []
+    for p in list(particles):
+      if p not in self._item_particles:
+        continue
+      self._item_particles.discard(p)
+      if p in self._unleased:
+        self._unleased.discard(p)
+      else:
+        items.append(p.oval_id)
+        p.oval_id = None
+    self.release_items(items)
+
+  def particle_tags(self, p):
+    """ Returns the tags to give the oval of the drawn particle. """
+    if self.running:
+      return ('particle', self._tag, self._universal_tag, self._running_tag)
+    return ('particle', self._tag, self._universal_tag)
+  def lease_items(self):
+    """ Leases ovals for the particles shown since the last update, one lease per distinct set of tags. """
+    if len(self._unleased) == 0:
+      return
+    groups = dict()
+    for p in self._unleased:
+      groups.setdefault(self.particle_tags(p), []).append(p)
+    for tags, particles in groups.iteritems():
+      for p, item in zip(particles, self.canvas.item_pool.lease(len(particles), tags)):
+        p.oval_id = item
+    self._unleased.clear()
+    self.canvas.restack_layers()
+  def release_items(self, items):
+    for item in items:
+      self._item_state.pop(item, None)
+    self.canvas.item_pool.release(items)
+
 
 
   def get_dirty(self):
@@ -494,6 +687,13 @@ class ViewLayer(ModelCanvasLayer):
       #assert all([p != None for p in particles])
       self._dirty |= set(particles)
 
+  def mark_dirty_at(self, gridcoords):
+    """ Marks the drawn particles at the given grid coordinates dirty, and, in raster mode,
+    the tiles containing them, whether or not a drawn particle exists there. """
+    if self._tiles != None:
+      self._tiles.invalidate(gridcoords)
+    self.mark_dirty([self.get_particle_at(gc) for gc in gridcoords if self.point_drawn(gc)])
+
   def mark_clean(self, particles = None):
     """ Marks the given gridcoords as clean (not needing redrawing).
     If gridcoords is omitted, then all particles are considered clean. """
@@ -524,6 +724,15 @@ class ViewLayer(ModelCanvasLayer):
     return filter(lambda p: not self.particle_in_model(p), self.particles_iterator())
 
 
+  def points_in_bbox(self, box):
+    """ Returns a list of the points of this layer within the given grid coordinate bounding box.
+    Model points are found with the model's spatial index; the (usually few) layer points without
+    a model particle are checked individually. """
+    grid = self.model.grid
+    gridcoords = [gc for gc in self.model.particles_in_bbox(box) if not self.point_hidden(gc)]
+    gridcoords.extend([gc for gc in self.points if grid.gridcoord_in_bbox(gc, box) and not self.point_in_model(gc)])
+    return gridcoords
+
   def particle_in_model(self, p):
     return p.in_model
   def particle_hidden(self, p):
@@ -534,6 +743,15 @@ class ViewLayer(ModelCanvasLayer):
     return gridcoord not in self.points
   def point_drawn(self, gridcoord):
     return gridcoord in self._gridcoord_to_particle
+  def point_in_window(self, gridcoord):
+    """ Returns True if a drawn particle at this grid coordinate should have an oval on the canvas.
+    Every drawn particle of a ViewLayer has one, unless the layer is in raster mode. """
+    return not self.rastered
+
+  def selected_mask(self, xs, ys):
+    """ Returns a boolean array telling which of the grid coordinates (xs[i], ys[i]) are selected,
+    or None if the layer has no selection. Used to draw the selection in raster mode. """
+    return None
 
   def particle_coords(self, p):
     """ Returns the coordinates of the drawn particle as a tuple. Set the oval coordinates with
@@ -550,8 +768,8 @@ class ViewLayer(ModelCanvasLayer):
     fill = p.particle_specs.color if p.in_model else '#CCC'
     outline = p.body_specs.color if p.in_model else '#999'
     if not self.running:
-      fill = utils.color_blend(fill, '#FFF', .5)
-      outline = utils.color_blend(outline, '#FFF', .5)
+      fill = colors.blend(fill, '#FFF', .5)
+      outline = colors.blend(outline, '#FFF', .5)
     width = 2
     state = tk.HIDDEN if self.particle_hidden(p) else tk.NORMAL
     return dict(fill = fill, outline = outline, width = 2, state = state)
@@ -595,32 +813,38 @@ class ViewLayer(ModelCanvasLayer):
   def handle_resize(self, event):
     self.canvas.update_layer(self)
 
-  def handle_model_event(self, event):
-    event_data = utils.event_data_retrieve(event.state)
-    if event_data != None:
-      if self.model != event_data['model']:  return
-      dirty_gridcoords = event_data['dirty_gridcoords']
+  @instrument.timed('layer.handle_model_change')
+  def handle_model_change(self, change):
+    """ Redraws the particles in the changed part of the model (see Model.notify()). """
+    if change.gridcoords != None:
+      dirty_gridcoords = change.gridcoords
+    elif change.bbox != None:
+      dirty_gridcoords = set(self.model.particles_in_bbox(change.bbox))
+      dirty_gridcoords.update([gc for gc in self.points_iterator() if utils.box_contains_point(change.bbox, gc)])
     else:
       dirty_gridcoords = set(self.points_iterator()) | set(self.model.points_iterator())
-    print 'modelevent', repr(self)
 
     self.points -= set(filter(lambda gc: not self.model.has_particle(gc), dirty_gridcoords))
     self.points |= set(filter(lambda gc: self.model.has_particle(gc), dirty_gridcoords))
     self.add_particles_at(dirty_gridcoords)
-    dirty_particles = [self.get_particle_at(gc) for gc in dirty_gridcoords if self.point_drawn(gc)]
-    print 'updating', len(dirty_particles), 'dirty particles of', len(dirty_gridcoords), 'dirty gridcoords'
+    instrument.count('layer.model_change_gridcoords', len(dirty_gridcoords))
 
-    self.mark_dirty(dirty_particles)
+    self.mark_dirty_at(dirty_gridcoords)
     self.canvas.update_layer(self)
 
 
 class SelectLayer(ViewLayer):
 
+  ## Operation layers draw ovals; only the ViewLayer and the EditBackgroundLayer use raster tiles
+  render_mode = 'ovals'
+
   def __init__(self, canvas, model = None, points = None, **kargs):
     ViewLayer.__init__(self, canvas, model, points, viewmode = 'scroll', **kargs)
 
     # Initialize to empty selection
     self._selected = set([]) # Currently selected particles
+    self._selected_keys = None # sorted gridcoord keys of the selection, for selected_mask()
+    self._selected_items = set() # ovals holding self._selected_tag
 
     ## Define events
     self.canvas.event_add('<<SelectAll>>', '<Command-a>')
@@ -645,6 +869,7 @@ class SelectLayer(ViewLayer):
   def selected(self, selected):
     self.mark_dirty(self._selected ^ selected)
     self._selected = selected
+    self._selected_keys = None
 
   #### Selection utilities
   def new_selection(self, particles, append = False):
@@ -656,7 +881,7 @@ class SelectLayer(ViewLayer):
     self.selected -= set(particles)
   def box_selection(self, particles, append = False):
     box = self.model.grid.calc_bbox([p.gridcoord for p in particles])
-    box_particles = set([self.get_particle_at(gc) for gc in self.model.grid.points_iterator(box) if not self.point_hidden(gc)])
+    box_particles = set([self.get_particle_at(gc) for gc in self.points_in_bbox(box)])
     #print box, box_particles
     self.new_selection(box_particles, append)
   def body_selection(self, particle, append = False):
@@ -685,27 +910,41 @@ class SelectLayer(ViewLayer):
     self.canvas.update_layer(self)
 
   def _calc_connected_body_particles(self, particle):
-    # might be low in efficiency
-    if particle.body_specs:
-      return set([self.get_particle_at(gc) for gc in self.points if not self.point_hidden(gc) and self.get_particle_at(gc).in_model and self.get_particle_at(gc).body_specs.idx==particle.body_specs.idx])
-    else:
+    gridcoords = [gc for gc in self.model.calc_connected_body_particles(particle.gridcoord) if not self.point_hidden(gc)]
+    if len(gridcoords) == 0:
       return None
+    self.add_particles_at(gridcoords)
+    return set([self.get_particle_at(gc) for gc in gridcoords])
 
   #### Drawing functionality
   def update_particles(self):
     """ Updates the location/size of all particles marked as dirty in this layer.
     Extends ViewLayer.update_particles(). """
     ViewLayer.update_particles(self)
-    if len(self.canvas.find_withtag(self._tag)) > 0:
+    if len(self._selected_items) > 0:
       self.canvas.tag_raise(self._selected_tag, self._tag)
-  def update_particle(self, p):
-    """ Extends ViewLayer.update_particle() to give it the self._selected_tag, if it is selected."""
-    ViewLayer.update_particle(self, p)
+  def update_items(self, particles):
+    """ Extends ViewLayer.update_items() to give selected ovals the self._selected_tag, and take it from the others.
+    The ovals holding the tag are shadowed in self._selected_items. """
+    ViewLayer.update_items(self, particles)
 
-    if self.particle_selected(p):
-      self.canvas.addtag_withtag(self._selected_tag, p.oval_id)
-    else:
-      self.canvas.dtag(p.oval_id, self._selected_tag)
+    add, remove = [], []
+    for p in particles:
+      if p.oval_id == None:
+        continue
+      selected = self.particle_selected(p)
+      if selected and p.oval_id not in self._selected_items:
+        add.append(p.oval_id)
+      elif not selected and p.oval_id in self._selected_items:
+        remove.append(p.oval_id)
+    self.tag_items(add, self._selected_tag)
+    self.untag_items(remove, self._selected_tag)
+    self._selected_items.update(add)
+    self._selected_items.difference_update(remove)
+  def release_items(self, items):
+    """ Extends ViewLayer.release_items(): the item pool removes the ovals' tags. """
+    ViewLayer.release_items(self, items)
+    self._selected_items.difference_update(items)
 
   def remove_particle_at(self, gridcoord):
     ViewLayer.remove_particle_at(self, gridcoord)
@@ -718,11 +957,17 @@ class SelectLayer(ViewLayer):
     return p in self._selected
   def point_selected(self, gridcoord):
     return self.point_drawn(gridcoord) and self.particle_selected(self.get_particle_at(gridcoord))
+  def selected_mask(self, xs, ys):
+    """ Extends ViewLayer.selected_mask() to return which of the grid coordinates are selected. """
+    if self._selected_keys is None:
+      gcs = np.array([p.gridcoord for p in self._selected], dtype = np.int64).reshape(-1, 2)
+      self._selected_keys = np.unique(raster.gridcoord_keys(gcs[:, 0], gcs[:, 1]))
+    return np.in1d(raster.gridcoord_keys(xs, ys), self._selected_keys, assume_unique = False)
 
   def particle_params(self, particle):
     """ Returns characteristics of the oval corresponding to the given drawn particle.
     Extends ViewLayer.particle_params to give selected particles a thicker border.
-    Note that this modifies the behavior of ViewLayer.update_particle(), which calls this function
+    Note that this modifies the behavior of ViewLayer.update_items(), which calls this function
     to determine the drawing parameters of the oval. """
     params = ViewLayer.particle_params(self, particle)
     if self.particle_selected(particle):
@@ -730,9 +975,9 @@ class SelectLayer(ViewLayer):
     return params
 
   #### Event handlers
-  def handle_model_event(self, event):
+  def handle_model_change(self, change):
     points = set(self.points)
-    ViewLayer.handle_model_event(self, event)
+    ViewLayer.handle_model_change(self, change)
     self.points = points
 
   def handle_leftpress(self, event):
@@ -789,22 +1034,26 @@ class EditBasicLayer(SelectLayer):
     self.canvas.event_add('<<Paint>>', '<ButtonPress-1><ButtonRelease-1>')
     self.canvas.event_add('<<Move>>', '<ButtonPress-1><B1-Motion>')
     self.canvas.event_add('<<Undo>>', '<Command-z>')
+    self.canvas.event_add('<<Redo>>', '<Command-Z>')
     self.canvas.event_add('<<Copy>>', '<Command-c>')
     self.canvas.event_add('<<Cut>>', '<Command-x>')
     self.canvas.event_add('<<Paste>>', '<Command-v>')
     self.canvas.event_add('<<Rotate>>', '<Command-r>')
     self.canvas.event_add('<<Flip>>', '<Command-f>')
+    self.canvas.event_add('<<CheckBodies>>', '<Command-b>')
 
     self.add_event_handler(self.running_event_handlers, '<<LayerMerge>>', self.handle_layermerge)
     self.add_event_handler(self.running_event_handlers, '<<LayerCancel>>', self.handle_layercancel)
     self.add_event_handler(self.running_event_handlers, '<<Paint>>', self.handle_paint)
     self.add_event_handler(self.running_event_handlers, '<<Move>>', self.handle_move)
     self.add_event_handler(self.running_event_handlers, '<<Undo>>', self.handle_undo)
+    self.add_event_handler(self.running_event_handlers, '<<Redo>>', self.handle_redo)
     self.add_event_handler(self.running_event_handlers, '<<Copy>>', self.handle_copy)
     self.add_event_handler(self.running_event_handlers, '<<Cut>>', self.handle_cut)
     self.add_event_handler(self.running_event_handlers, '<<Paste>>', self.handle_paste)
     self.add_event_handler(self.running_event_handlers, '<<Rotate>>', self.handle_rotate)
     self.add_event_handler(self.running_event_handlers, '<<Flip>>', self.handle_flip)
+    self.add_event_handler(self.running_event_handlers, '<<CheckBodies>>', self.handle_check_bodies)
 
     self.add_event_handler(self.alive_event_handlers, '<<Brush>>', self.handle_brush_event, 'all')
     self.add_event_handler(self.alive_event_handlers, '<<Clipboard>>', self.handle_clipboard_event, 'all')
@@ -827,20 +1076,24 @@ class EditBasicLayer(SelectLayer):
 
   #### Layer functionality
 
+  @instrument.timed('layer.merge')
   def merge(self, layer):
     start_gc = set(layer.start_coordinates())
     finish_gc = set(layer.finish_coordinates())
     dirty_gc = start_gc | finish_gc
+    delta = self.canvas.journal.begin(self.model, dirty_gc, 'merge')
     
-    # Transfer information at these locations from the merged layer
-    self.remove_particles_at(start_gc)
-    # Add particles in the final operation state
-    self.points |= finish_gc
-    for gc in finish_gc:
-      model_p = layer.model.get_particle(gc)
-      p = DrawnParticle(gridcoord = gc, oval_id = None, model_particle = model_p)
-      self.set_particle_at(gc, p)
-      #print gc, model_p
+    with self.model.transaction():
+      # Transfer information at these locations from the merged layer
+      self.remove_particles_at(start_gc)
+      # Add particles in the final operation state
+      self.points |= finish_gc
+      for gc in finish_gc:
+        model_p = layer.model.get_particle(gc)
+        p = DrawnParticle(gridcoord = gc, oval_id = None, model_particle = model_p)
+        self.set_particle_at(gc, p)
+        #print gc, model_p
+    self.canvas.journal.commit(delta)
 
     # Transfer the selection to the parent layer
     if isinstance(layer, SelectLayer):
@@ -849,43 +1102,53 @@ class EditBasicLayer(SelectLayer):
       self.add_particles_at(selected_gc)
       self.selected = set([self.get_particle_at(gc) for gc in selected_gc])
       
-    key = utils.event_data_register(dict(model = self.model, dirty_gridcoords = dirty_gc))
-    self.canvas.event_generate('<<Model>>', state = key, when = 'tail')
-
-    print 'particles changed in merge:',len(dirty_gc)
+    self.model.notify(dirty_gc, source = self)
+    instrument.count('layer.merged_gridcoords', len(dirty_gc))
 
   #### Model editing functions
+  @instrument.timed('layer.apply_brush')
   def apply_brush(self, brush, particles):
     """ Set the given particles to have the particle and/or body type specified by the brush.
     Does NOT redraw particles to reflect the changes! Use update() to do this. """
     erase = brush == None
     modify = not erase and (brush.particle_specs == None or brush.body_specs == None)
     create = not erase and not modify
-    print erase, modify, create
-    for p in particles:
-      if erase:
-        self.model.remove_particle(p.gridcoord)
-      elif (create or modify) and p.in_model:
-        model_particle = self.model.get_particle(p.gridcoord)
-        if brush.particle_specs != None:  model_particle.particle_specs = brush.particle_specs
-        if brush.body_specs != None:  model_particle.body_specs = brush.body_specs
-      elif create and not p.in_model:
-        self.model.add_particle(p.gridcoord, brush.particle_specs, brush.body_specs)
+    gridcoords = [p.gridcoord for p in particles]
+    delta = self.canvas.journal.begin(self.model, gridcoords, 'brush')
+    with self.model.transaction():
+      for p in particles:
+        if erase:
+          self.model.remove_particle(p.gridcoord)
+        elif (create or modify) and self.model.has_particle(p.gridcoord):
+          if brush.particle_specs != None:  self.model.set_particle_type(p.gridcoord, brush.particle_specs)
+          if brush.body_specs != None:  self.model.set_body_type(p.gridcoord, brush.body_specs)
+        elif create:
+          self.model.add_particle(p.gridcoord, brush.particle_specs, brush.body_specs)
+    self.canvas.journal.commit(delta)
     self.mark_dirty(particles)
     
-    ### Emit model-changed event
-    gridcoords = [p.gridcoord for p in particles]
-    key = utils.event_data_register(dict(dirty_gridcoords = gridcoords, model = self.model))
-    self.canvas.event_generate('<<Model>>', state=key, when='tail')
+    ### Announce the change to the model's views
+    self.model.notify(gridcoords, source = self)
+
+  def show_journal_delta(self, delta):
+    """ Redraws the particles changed by undoing or redoing a journal Delta (which may be None). """
+    if delta == None:
+      return
+    gridcoords = delta.gridcoords
+    self.points.update(gridcoords)
+    self.add_particles_at(gridcoords)
+    self.mark_dirty_at(gridcoords)
+    self.model.notify(gridcoords, source = self)
+    self.canvas.update_layer(self)
 
   #### Event handlers
 
   def handle_brush_event(self, event):
-    self.brush = utils.event_data_retrieve(event.state)
+    self.brush = event_store.receive(event)
 
   def handle_clipboard_event(self, event):
     print 'clipboard'
-    self.clipboard_data = utils.event_data_retrieve(event.state)
+    self.clipboard_data = event_store.receive(event)
 
   def handle_layermerge(self, event):
     print 'layermerge'
@@ -917,6 +1180,11 @@ class EditBasicLayer(SelectLayer):
 
   def handle_undo(self, event):
     print 'undo'
+    self.show_journal_delta(self.canvas.journal.undo(self.model))
+
+  def handle_redo(self, event):
+    print 'redo'
+    self.show_journal_delta(self.canvas.journal.redo(self.model))
 
   def handle_cut(self, event):
     print 'cut'
@@ -933,15 +1201,15 @@ class EditBasicLayer(SelectLayer):
     if len(self.selected) == 0:
       return
     model, coordinates = self.get_operation_particles()
-    key = utils.event_data_register(dict(model = model, coordinates = coordinates))
-    self.canvas.event_generate('<<Clipboard>>', state = key)
+    event_store.generate(self.canvas, '<<Clipboard>>', dict(model = model.snapshot(), coordinates = tuple(coordinates)))
 
 
   def handle_paste(self, event):
     print 'paste'
     if self.clipboard_data == None:  return
-    model = deepcopy(self.clipboard_data['model'])
-    coordinates = deepcopy(self.clipboard_data['coordinates'])
+    ## The clipboard holds a snapshot and a tuple, so neither needs copying here
+    model = self.clipboard_data['model'].copy()
+    coordinates = self.clipboard_data['coordinates']
     layer = PasteLayer(self.canvas, model, coordinates)
     layer.brush = self._brush
     self.canvas.start_layer(layer)
@@ -960,30 +1228,104 @@ class EditBasicLayer(SelectLayer):
 
   def handle_flip(self, event):
     print 'flip'
+
+  def handle_check_bodies(self, event):
+    """ Checks that every body is contiguous, selecting the stray pieces of split bodies and isolated particles. """
+    report = body_analysis.analyze_bodies(self.model)
+    print report.summary()
+    gridcoords = [gc for gc in report.problem_gridcoords() if not self.point_hidden(gc)]
+    self.add_particles_at(gridcoords)
+    self.new_selection([self.get_particle_at(gc) for gc in gridcoords])
+    self.canvas.update_layer(self)
   
   def get_operation_particles(self):
-    model = Model(grid_type = self.model.grid.grid_type)
+    """ Returns a new model of the particles to operate on (the selection, or the whole layer if nothing is
+    selected) and their grid coordinates. Without a selection, the model is an O(1) copy-on-write copy. """
     if len(self.selected) > 0:
-      model.particles = [p.model_particle for p in self.selected if p.in_model]
       coordinates = [p.gridcoord for p in self.selected]
+      model = self.model.extract(coordinates)
     else:
-      model.particles = list(self.model.particles)
+      model = self.model.copy()
       coordinates = list(self.points)
     return model, coordinates
 
 
 
 class EditBackgroundLayer(EditBasicLayer):
+  """ The editable layer showing the whole model, with a blank particle in every empty cell.
+  Only the cells within the layer's window -- the visible part of the canvas plus a margin of
+  window_margin cells -- have ovals. When the view scrolls out of the window, the window moves and
+  the ovals of the cells that left it are reused for the cells that entered it, so the number of
+  canvas items depends on the size of the canvas rather than that of the model or scroll region.
+  Blank particles outside the window are forgotten unless they are selected.
+  In raster mode, the tiles show a blank particle in every empty cell instead, and there is no window. """
+
+  window_margin = 8
+  render_mode = 'auto'
+  raster_blank_cells = True
 
   def __init__(self, canvas, model = None, coordinates = None, **kargs):
     EditBasicLayer.__init__(self, canvas, model, coordinates, **kargs)
 
+    self._window = None # gridcoord bbox of the cells with ovals
+
+    self.add_event_handler(self.alive_event_handlers, '<<Scroll>>', self.handle_scroll)
+
+  def set_model(self, model):
+    self._window = None
+    EditBasicLayer.set_model(self, model)
+
   def update_view_scroll(self):
     EditBasicLayer.update_view_scroll(self)
     if self.model != None:
-      box = self.model.grid.pixel_to_gridcoord_bbox(self.scrollable_bbox, self.diameter)
-      self.points |= set(self.model.grid.points_iterator(box))
-      self.add_particles_at(self.points)
+      self.update_window()
+
+  def update_window(self):
+    """ Moves the window if the visible part of the canvas is no longer inside it.
+    In raster mode there are no ovals, so the window is dropped. """
+    if self.rastered:
+      self._window = None
+      return
+    grid = self.model.grid
+    visible_box = grid.pixel_to_gridcoord_bbox(self.visible_bbox, self.diameter)
+    if utils.box_contains_box(self._window, visible_box):
+      return
+    margin = self.window_margin
+    old_window = self._window
+    window = (visible_box[0] - margin, visible_box[1] - margin, visible_box[2] + margin, visible_box[3] + margin)
+    self._window = window
+
+    ## Hide the particles that left the window first, so their ovals can be reused
+    left = [p for p in self._item_particles if not utils.box_contains_point(window, p.gridcoord)]
+    self.hide_particles(left)
+    self.forget_blank_particles(left)
+
+    new_points = []
+    for new_box in utils.box_subtract(window, old_window):
+      new_points.extend(grid.points_iterator(new_box))
+    self.add_particles_at(new_points)
+    for gc in new_points:
+      self.show_particle(self.get_particle_at(gc))
+    instrument.count('layer.window_moves')
+
+  def forget_blank_particles(self, particles):
+    """ Forgets the particles that are blank and not selected among the given particles, which have no ovals. """
+    for p in particles:
+      if not self.point_in_model(p.gridcoord) and not self.particle_selected(p):
+        del self._gridcoord_to_particle[p.gridcoord]
+        self._dirty.discard(p)
+
+  def points_in_bbox(self, box):
+    """ Every cell is a point of the background layer, but only the occupied cells and the blank
+    cells within the visible part of the canvas are returned, so a large box costs no more than
+    the particles it contains. """
+    grid = self.model.grid
+    gridcoords = self.model.particles_in_bbox(box)
+    visible_box = grid.pixel_to_gridcoord_bbox(self.visible_bbox, self.diameter)
+    visible_box = utils.box_intersection(box, visible_box)
+    if visible_box != None:
+      gridcoords.extend([gc for gc in grid.points_iterator(visible_box) if not self.point_in_model(gc)])
+    return gridcoords
 
 
   #### Particle information
@@ -991,6 +1333,23 @@ class EditBackgroundLayer(EditBasicLayer):
     return False
   def point_hidden(self, gridcoord):
     return False
+  def point_in_window(self, gridcoord):
+    return not self.rastered and utils.box_contains_point(self._window, gridcoord)
+
+  def handle_scroll(self, event):
+    self.canvas.update_layer(self)
+
+  def handle_model_change(self, change):
+    """ Extends EditBasicLayer.handle_model_change() to forget the blank particles the change left outside the
+    window, e.g. cells erased off screen, just as update_window() forgets those leaving the window. """
+    EditBasicLayer.handle_model_change(self, change)
+    if self.rastered:
+      return
+    if change.gridcoords != None:
+      particles = [self._gridcoord_to_particle.get(gc) for gc in change.gridcoords]
+    else:
+      particles = self._gridcoord_to_particle.values()
+    self.forget_blank_particles([p for p in particles if p != None and not self.point_in_window(p.gridcoord)])
 
   def handle_layermerge(self, event):
     pass
@@ -1002,13 +1361,12 @@ class EditBackgroundLayer(EditBasicLayer):
     self.canvas.update_layer(self)
 
   def get_operation_particles(self):
-    model = Model(grid_type = self.model.grid.grid_type)
     if len(self.selected) > 0:
-      model.particles = [p.model_particle for p in self.selected if p.in_model]
       coordinates = [p.gridcoord for p in self.selected]
+      model = self.model.extract(coordinates)
     else:
-      model.particles = list(self.model.particles)
-      coordinates = [p.gridcoord for p in model.particles]
+      model = self.model.copy()
+      coordinates = list(model.points_iterator())
     return model, coordinates
 
 class MoveLayer(SelectLayer):
@@ -1018,6 +1376,7 @@ class MoveLayer(SelectLayer):
 
     self._startpos = startpos
     self._offset = (0, 0)
+    self._drawn_offset = (0, 0) # rounded offset the moving ovals are drawn at
 
     self._duplicating = False
 
@@ -1026,6 +1385,8 @@ class MoveLayer(SelectLayer):
 
     self._gridcoord_to_particle_moving = dict() # originally selected particles being moved
     self._gridcoord_to_particle_stationary = dict() # new particles placed in the old locations of the originals
+    self._moving = set()
+    self._stationary = set()
 
     self.add_event_handler(self.running_event_handlers, '<B1-Motion>', self.handle_drag)
     self.add_event_handler(self.running_event_handlers, '<ButtonRelease-1>', self.handle_release)
@@ -1036,16 +1397,16 @@ class MoveLayer(SelectLayer):
     assert False, "Cannot set the model of a MoveLayer after instantiation"
 
   def add_particle_at(self, gridcoord):
-    oval_id_stationary = self.canvas.create_oval(0, 0, 0, 0, tags = ('particle', self._tag, self._universal_tag, self._stationary_tag), state = tk.HIDDEN)
-    oval_id_moving = self.canvas.create_oval(0, 0, 0, 0, tags = ('particle', self._tag, self._universal_tag, self._moving_tag), state = tk.HIDDEN)
-
     model_p = self.model.get_particle(gridcoord)
-    moving = DrawnParticle(gridcoord = gridcoord, oval_id = oval_id_moving, model_particle = model_p)
-    stationary = DrawnParticle(gridcoord = gridcoord, oval_id = oval_id_stationary, model_particle = None)
+    moving = DrawnParticle(gridcoord = gridcoord, oval_id = None, model_particle = model_p)
+    stationary = DrawnParticle(gridcoord = gridcoord, oval_id = None, model_particle = None)
 
     self._gridcoord_to_particle_moving[gridcoord] = moving
     self._gridcoord_to_particle_stationary[gridcoord] = stationary
-    self.mark_dirty([moving, stationary])
+    self._moving.add(moving)
+    self._stationary.add(stationary)
+    self.show_particle(moving)
+    self.show_particle(stationary)
     return moving
   def get_moving_particle_at(self, gridcoord):
     return self._gridcoord_to_particle_moving[gridcoord]
@@ -1061,7 +1422,6 @@ class MoveLayer(SelectLayer):
   def start(self):
     SelectLayer.start(self)
 
-    self.canvas.tag_lower(self._stationary_tag, self._moving_tag)
     self.selected = set(self.moving_particles_iterator())
     
   def merge(self):
@@ -1073,19 +1433,25 @@ class MoveLayer(SelectLayer):
     SelectLayer.finish(self)
 
     offset = self._offset_rounded()
-      
-    for p in self.stationary_particles_iterator():
-      if not self._duplicating or p.model_particle == None:
-        self.model.remove_particle(p.gridcoord)
-      else:
-        self.model.set_particle(p.gridcoord, p.model_particle)
+    moving = list(self.moving_particles_iterator())
+    self._move_particles(moving, offset)
 
-    for p in self.moving_particles_iterator():
-      self._move_particle(p, offset)
-      if p.model_particle == None:
-        self.model.remove_particle(p.gridcoord)
-      else:
-        self.model.set_particle(p.gridcoord, p.model_particle)
+    dirty_gc = [p.gridcoord for p in self.particles_iterator()]
+    delta = self.canvas.journal.begin(self.model, dirty_gc, 'move')
+      
+    with self.model.transaction():
+      for p in self.stationary_particles_iterator():
+        if not self._duplicating or p.model_particle == None:
+          self.model.remove_particle(p.gridcoord)
+        else:
+          self.model.set_particle(p.gridcoord, p.model_particle)
+
+      for p in moving:
+        if p.model_particle == None:
+          self.model.remove_particle(p.gridcoord)
+        else:
+          self.model.set_particle(p.gridcoord, p.model_particle)
+    self.canvas.journal.commit(delta)
 
     if self._duplicating:
       self.points |= set([p.gridcoord for p in self.moving_particles_iterator()])
@@ -1110,20 +1476,38 @@ class MoveLayer(SelectLayer):
   def particle_hidden(self, p):
     return self.particle_stationary(p) and not self._duplicating
   def particle_moving(self, p):
-    return self._moving_tag in self.canvas.gettags(p.oval_id)
+    return p in self._moving
   def particle_stationary(self, p):
-    return self._stationary_tag in self.canvas.gettags(p.oval_id)
+    return p in self._stationary
+  def particle_tags(self, p):
+    tag = self._moving_tag if self.particle_moving(p) else self._stationary_tag
+    return SelectLayer.particle_tags(self, p) + (tag,)
+  def lease_items(self):
+    """ Extends ViewLayer.lease_items() to keep the stationary ovals below the moving ones. """
+    leasing = len(self._unleased) > 0
+    SelectLayer.lease_items(self)
+    if leasing and len(self._moving) > 0:
+      self.canvas.tag_lower(self._stationary_tag, self._moving_tag)
 
 
   def particle_coords(self, p):
     coords = SelectLayer.particle_coords(self, p)
     if self.particle_moving(p):
-      offset = self._offset_rounded()
+      offset = self._drawn_offset
       coords = (coords[0] + offset[0], coords[1] + offset[1],
           coords[2] + offset[0], coords[3] + offset[1])
     return coords
 
-
+  def update_particles(self):
+    """ Extends SelectLayer.update_particles() to drag the moving ovals to the current offset with a single
+    canvas.move() on the moving tag, rather than updating each of them.
+    The coordinates shadowed in _item_state are left at the offset each oval was last updated at; any oval
+    updated later is compared against them and set again, so they only cost a redundant coords command. """
+    offset = self._offset_rounded()
+    if offset != self._drawn_offset:
+      self.canvas.move(self._moving_tag, offset[0] - self._drawn_offset[0], offset[1] - self._drawn_offset[1])
+      self._drawn_offset = offset
+    SelectLayer.update_particles(self)
 
   def handle_drag(self, event):
     posx = self.canvas.canvasx(event.x)
@@ -1132,7 +1516,6 @@ class MoveLayer(SelectLayer):
     
     self._set_duplicating(event.state & MOD_SHIFT)
 
-    self.mark_dirty(self.moving_particles_iterator())
     self.canvas.update_layer(self)
 
   def handle_release(self, event):
@@ -1165,14 +1548,19 @@ class MoveLayer(SelectLayer):
     offset = (finalpos_rounded[0] - startpos_rounded[0], finalpos_rounded[1] - startpos_rounded[1])
     return offset
 
-  def _move_particle(self, p, offset):
+  def _move_particles(self, particles, offset):
+    """ Moves the given drawn particles by the pixel offset, which should be a difference of grid positions.
+    The cell centers are converted rather than the corners, so rounding errors cannot push a particle
+    into the neighboring cell. """
+    if len(particles) == 0:  return
     diameter = self.diameter
     grid = self.model.grid
 
-    old_pos = grid.gridcoord_to_pixel(p.gridcoord, diameter)
-    new_pos = (old_pos[0] + offset[0], old_pos[1] + offset[1])
-    new_gc = grid.pixel_to_gridcoord(new_pos, diameter)
-    p.gridcoord = new_gc
+    xs, ys = np.array([p.gridcoord for p in particles]).T
+    old_xs, old_ys = grid.gridcoords_to_pixels(xs, ys, diameter)
+    new_xs, new_ys = grid.pixels_to_gridcoords(old_xs + (offset[0] + diameter / 2.0), old_ys + (offset[1] + diameter / 2.0), diameter)
+    for p, new_gc in zip(particles, zip(new_xs.tolist(), new_ys.tolist())):
+      p.gridcoord = new_gc
 
 class PasteLayer(EditBasicLayer):
 
@@ -1208,17 +1596,23 @@ class RotateLayer(EditBasicLayer):
     box = grid.gridcoord_to_pixel_bbox(grid.calc_bbox(self.points), self.diameter)
     center_pixel = (int((box[0] + box[2]) / 2), int((box[1] + box[3]) / 2))
     center_gc = grid.pixel_to_gridcoord(center_pixel, self.diameter)
-    mapping = grid.rotate_gridcoords(self.points, center_gc, self._steps)
+    old_gcs = list(self.points)
+    xs, ys = np.array(old_gcs, dtype = np.int64).reshape(-1, 2).T
+    new_xs, new_ys = grid.transform_gridcoords(xs, ys, grid.rotation(center_gc, self._steps))
+    mapping = dict(zip(old_gcs, zip(new_xs.tolist(), new_ys.tolist())))
     #print center_gc, mapping
     
-    old_particles = {gc: deepcopy(self.get_particle_at(gc)) for gc in self.points}
+    old_model = self.model.snapshot()
     old_selection = set([p.gridcoord for p in self.selected])
-
-    self.remove_particles_at(self.points)
-    for old_gc, new_gc in mapping.iteritems():
-      self.set_particle_at(new_gc, old_particles[old_gc])
-      if old_gc in old_selection:
-        self.new_selection([self.get_particle_at(new_gc)], append = True)
+    delta = self.canvas.journal.begin(self.model, mapping.keys() + mapping.values(), 'rotate')
+
+    with self.model.transaction():
+      self.remove_particles_at(self.points)
+      for old_gc, new_gc in mapping.iteritems():
+        self.set_particle_at(new_gc, DrawnParticle(new_gc, None, old_model.get_particle(old_gc)))
+        if old_gc in old_selection:
+          self.new_selection([self.get_particle_at(new_gc)], append = True)
+    self.canvas.journal.commit(delta)
 
     self.canvas.update_layer(self)
     #self.canvas.merge_top_layer()
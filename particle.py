@@ -1,48 +1,69 @@
-
-from copy import deepcopy
-
-
 class Particle(object):
-  gridcoord = None
+  """ Relates a grid coordinate to a particle type and body type.
+  The ParticleSpecs and BodySpecs objects are shared, never copied: copying a Particle
+  (copy(), copy.copy() or copy.deepcopy()) gives a new Particle referring to the same specs. """
+  __slots__ = ('gridcoord', 'particle_specs', 'body_specs')
 
-  particle_specs = None
-  body_specs = None
   def __init__(self, gridcoord, particle_specs, body_specs):
     self.gridcoord = gridcoord
 
     self.particle_specs = particle_specs
     self.body_specs = body_specs
-#
-#  def copy(self):
-#    new_par = deepcopy(self)
-#    new_par.particle_specs = self.particle_specs
-#    new_par.body_specs = self.body_specs
-#    return new_par
 
+  def copy(self):
+    return Particle(self.gridcoord, self.particle_specs, self.body_specs)
+
+  def __copy__(self):
+    return self.copy()
   def __deepcopy__(self, memo):
-    gc_copy = deepcopy(self.gridcoord, memo)
-    pspecs_copy = deepcopy(self.particle_specs, memo)
-    bspecs_copy = deepcopy(self.body_specs, memo)
-    return Particle(gc_copy, pspecs_copy, bspecs_copy)
+    return self.copy()
 
 
 class DrawnParticle(object):
+  """ A particle drawn on a canvas as the oval oval_id, optionally bound to a model Particle.
+  Binding a particle (the model_particle setter or bind()) does not copy it; the bound Particle
+  is only copied the first time it has to be modified through this DrawnParticle (copy-on-write),
+  after which the DrawnParticle owns its copy and modifies it in place. """
+  __slots__ = ('_gridcoord', 'oval_id', '_particle', '_owned')
+
   def __init__(self, gridcoord, oval_id, model_particle = None):
     ## Particle parameters
     self._gridcoord = gridcoord
     self.oval_id = oval_id
-    self._particle = deepcopy(model_particle)
+    self._particle = None
+    self._owned = False
+    self.model_particle = model_particle
 
   @property
   def model_particle(self):
     return self._particle
   @model_particle.setter
   def model_particle(self, p):
-    self._particle = deepcopy(p)
-    if self._particle != None:
-      self._particle.gridcoord = self._gridcoord
-    #self.in_model = p != None
-    assert (self._particle!=None) == self.in_model
+    self._particle = p
+    self._owned = False
+    if p != None and p.gridcoord != self._gridcoord:
+      self._own().gridcoord = self._gridcoord
+
+  def bind(self, particle_specs, body_specs):
+    """ Sets the particle and body types of the bound particle, creating one if needed.
+    If particle_specs is None, the DrawnParticle is unbound from the model.
+    Once the DrawnParticle owns its particle, this allocates nothing. """
+    if particle_specs == None:
+      self._particle = None
+      self._owned = False
+    elif self._owned:
+      self._particle.particle_specs = particle_specs
+      self._particle.body_specs = body_specs
+    else:
+      self._particle = Particle(self._gridcoord, particle_specs, body_specs)
+      self._owned = True
+
+  def _own(self):
+    """ Makes sure the bound particle is private to this DrawnParticle before it is modified. """
+    if not self._owned:
+      self._particle = self._particle.copy()
+      self._owned = True
+    return self._particle
 
   @property
   def in_model(self):
@@ -53,10 +74,9 @@ class DrawnParticle(object):
     return self._gridcoord
   @gridcoord.setter
   def gridcoord(self, gc):
-    assert (self._particle!=None) == self.in_model
     self._gridcoord = gc
     if self.in_model:
-      self._particle.gridcoord = gc
+      self._own().gridcoord = gc
 
   @property
   def particle_specs(self):
@@ -64,7 +84,7 @@ class DrawnParticle(object):
   @particle_specs.setter
   def particle_specs(self, specs):
     assert self.in_model
-    self._particle.particle_specs = specs
+    self._own().particle_specs = specs
 
   @property
   def body_specs(self):
@@ -72,9 +92,16 @@ class DrawnParticle(object):
   @body_specs.setter
   def body_specs(self, specs):
     assert self.in_model
-    self._particle.body_specs = specs
+    self._own().body_specs = specs
+
+  def copy(self):
+    """ Returns a new DrawnParticle for the same oval, sharing the bound particle until either is modified. """
+    p = DrawnParticle(self._gridcoord, self.oval_id)
+    p._particle = self._particle
+    self._owned = False
+    return p
 
+  def __copy__(self):
+    return self.copy()
   def __deepcopy__(self, memo):
-    gc_copy = deepcopy(self._gridcoord, memo)
-    model_p_copy = deepcopy(self._particle, memo)
-    return DrawnParticle(gc_copy, self.oval_id, model_p_copy)
\ No newline at end of file
+    return self.copy()
@@ -0,0 +1,265 @@
+import base64
+
+import Tkinter as tk
+import numpy as np
+
+import colors
+import instrument
+
+""" Raster rendering of a ViewLayer's particles, for models too large to draw with one oval per particle.
+The canvas is divided into TILE_SIZE x TILE_SIZE pixel tiles. Each tile covering the visible part of the
+canvas is rasterized into a NumPy RGB array, which is shown as a PhotoImage on the canvas. Particles are drawn
+as discs with the same colors and outline widths the layer uses for its ovals (see ViewLayer.particle_params()),
+including the selection and the faded colors of a paused layer. Only tiles that are new or that contain
+changed particles are rasterized again.
+When zoomed out so far that particles would be only a few pixels across, the tiles show the model at a lower
+level of detail (see LOD_LEVELS): each block of cells is drawn as a single patch, colored by the particle type
+making up most of it (or a mix of the types in it) and lightened where it is sparse, and at the lowest level just
+shaded by its density. Blocks are summarized a chunk at a time by Model.aggregate_blocks(), so the time to draw a
+tile depends on its size in pixels rather than on the number of particles in it. Blank cells and the selection
+are not shown below the particle level.
+render_image() rasterizes any part of a model, and is also used to draw thumbnails (see render_thumbnail()). """
+
+TILE_SIZE = 256
+
+BACKGROUND = (255, 255, 255)
+BLANK_FILL = '#CCC'
+BLANK_OUTLINE = '#999'
+
+## Levels of detail, as (minimum cell diameter in pixels, block size in cells, style), from most to least detailed
+LOD_LEVELS = ((4.0, 1, 'particles'), (1.0, 4, 'types'), (0.0, 16, 'density'))
+## Cell diameter below which layers in 'auto' render mode are always drawn as tiles
+MIN_OVAL_DIAMETER = LOD_LEVELS[0][0]
+DENSITY_COLOR = (64, 64, 64)
+
+## Above this many changed grid coordinates, every tile is redrawn rather than working out which ones changed
+MAX_INVALIDATE = 10000
+
+def gridcoord_keys(xs, ys):
+  """ Packs arrays of grid coordinates into single int64 keys, for set operations on grid coordinates. """
+  return (np.asarray(xs, dtype = np.int64) << 32) | (np.asarray(ys, dtype = np.int64) & 0xFFFFFFFF)
+
+def lod_level(diameter):
+  """ Returns the (block size, style) to draw cells of the given diameter with. """
+  for min_diameter, block_size, style in LOD_LEVELS:
+    if diameter >= min_diameter:
+      return block_size, style
+  return LOD_LEVELS[-1][1:]
+
+_disc_cache = dict()
+def disc_offsets(size, width):
+  """ Returns the (dy, dx) pixel offsets of the inside and of the outline of a disc with a
+  bounding box of size x size pixels and an outline width pixels wide. """
+  key = (size, width)
+  if key not in _disc_cache:
+    center = (size - 1) / 2.0
+    dy, dx = np.mgrid[0:size, 0:size]
+    dist = np.hypot(dx - center, dy - center)
+    radius = size / 2.0
+    disc = dist <= radius
+    outline = disc & (dist > radius - width)
+    inside = disc & ~outline
+    _disc_cache[key] = ((dy[inside], dx[inside]), (dy[outline], dx[outline]))
+  return _disc_cache[key]
+
+
+class TileRenderer(object):
+  """ Keeps the tiles covering the visible part of the canvas up to date for one layer.
+  invalidate() marks the tiles containing some grid coordinates (or all tiles) as needing to be redrawn;
+  update() redraws them, adds tiles scrolled into view and drops tiles scrolled out of it. """
+
+  def __init__(self, layer, tile_size = TILE_SIZE):
+    self.layer = layer
+    self.tile_size = tile_size
+    self.tag = layer._tag + '_tile'
+    self._tiles = dict() # tile key -> (image item, PhotoImage)
+    self._invalid = set()
+    self._style = None # (diameter, running) of the layer when the tiles were drawn
+
+  @property
+  def canvas(self):
+    return self.layer.canvas
+
+  def invalidate(self, gridcoords = None):
+    """ Marks the tiles overlapping the particles at the given grid coordinates as needing to be redrawn,
+    or every tile if gridcoords is omitted. """
+    if gridcoords == None or len(gridcoords) > MAX_INVALIDATE:
+      self._invalid.update(self._tiles)
+      return
+    if len(gridcoords) == 0:
+      return
+    xs, ys = np.array(list(gridcoords), dtype = np.int64).reshape(-1, 2).T
+    diameter = self.layer.diameter
+    pxs, pys = self.layer.model.grid.gridcoords_to_pixels(xs, ys, diameter)
+    size = self.tile_size
+    for x0s, y0s in ((pxs, pys), (pxs + diameter, pys), (pxs, pys + diameter), (pxs + diameter, pys + diameter)):
+      keys = zip((x0s // size).astype(int).tolist(), (y0s // size).astype(int).tolist())
+      self._invalid.update([key for key in keys if key in self._tiles])
+
+  def update(self):
+    """ Redraws the invalid tiles, and makes sure the visible part of the canvas is covered by tiles. """
+    style = (self.layer.diameter, self.layer.running)
+    if style != self._style:
+      self._style = style
+      self._invalid.update(self._tiles)
+
+    size = self.tile_size
+    box = self.layer.visible_bbox
+    keys = set([(tx, ty) for tx in xrange(int(box[0] // size), int((box[2] - 1) // size) + 1)
+        for ty in xrange(int(box[1] // size), int((box[3] - 1) // size) + 1)])
+    for key in set(self._tiles) - keys:
+      self.canvas.delete(self._tiles.pop(key)[0])
+    for key in keys:
+      if key not in self._tiles or key in self._invalid:
+        self.draw_tile(key)
+    self._invalid.clear()
+
+  def clear(self):
+    """ Removes all tiles from the canvas. """
+    self.canvas.delete(self.tag)
+    self._tiles.clear()
+    self._invalid.clear()
+
+  @instrument.timed('raster.draw_tile')
+  def draw_tile(self, key):
+    data = photo_data(self.render_tile(key))
+    if key in self._tiles:
+      self._tiles[key][1].configure(data = data, format = 'PPM')
+    else:
+      photo = tk.PhotoImage(master = self.canvas, data = data, format = 'PPM')
+      item = self.canvas.create_image(key[0] * self.tile_size, key[1] * self.tile_size, image = photo, anchor = tk.NW,
+          tags = (self.tag, self.layer._tag, self.layer._universal_tag))
+      self._tiles[key] = (item, photo)
+
+  def render_tile(self, key):
+    """ Returns the tile with the given key as a tile_size x tile_size x 3 array of RGB values. """
+    layer, size = self.layer, self.tile_size
+    return render_image(layer.model, key[0] * size, key[1] * size, size, size, layer.diameter,
+        faded = not layer.running, blank_cells = layer.raster_blank_cells, selected_mask = layer.selected_mask)
+
+
+def photo_data(image):
+  """ Returns the height x width x 3 array of RGB values as PPM data for a PhotoImage. """
+  return base64.b64encode('P6 {0} {1} 255\n'.format(image.shape[1], image.shape[0]) + image.tobytes())
+
+def render_thumbnail(model, width, height, padding = 0):
+  """ Returns a height x width x 3 array of RGB values showing the whole model, zoomed to fit with
+  padding cells of space around it, and centered. """
+  box = model.calc_bbox() if len(model) > 0 else None
+  if box == None:
+    image = np.empty((height, width, 3), dtype = np.uint8)
+    image[:] = BACKGROUND
+    return image
+  x1, y1, x2, y2 = model.grid.gridcoord_to_pixel_bbox(box, 1.0)
+  diameter = min(width / (x2 - x1 + 2.0 * padding), height / (y2 - y1 + 2.0 * padding))
+  x0 = int(round((x1 + x2) / 2.0 * diameter - width / 2.0))
+  y0 = int(round((y1 + y2) / 2.0 * diameter - height / 2.0))
+  return render_image(model, x0, y0, width, height, diameter)
+
+def render_image(model, x0, y0, width, height, diameter, faded = False, blank_cells = False, selected_mask = None):
+  """ Returns a height x width x 3 array of RGB values showing the part of the model drawn with cells of the
+  given diameter whose top left pixel is (x0, y0).
+  If faded, colors are blended halfway to white, as for a paused layer. If blank_cells, empty cells are drawn
+  as blank particles. selected_mask is a function such as ViewLayer.selected_mask() telling which particles have
+  the thick outline of selected particles. """
+  image = np.empty((height, width, 3), dtype = np.uint8)
+  image[:] = BACKGROUND
+  grid = model.grid
+
+  box = grid.pixel_to_gridcoord_bbox((x0, y0, x0 + width, y0 + height), diameter)
+  block_size, style = lod_level(diameter)
+  if style != 'particles':
+    return render_blocks(image, model, x0, y0, diameter, box, block_size, style, faded)
+
+  ## Find the cells overlapping the image and the model row (or -1) of each
+  if blank_cells:
+    xs, ys = np.mgrid[box[0]:box[2], box[1]:box[3]]
+    xs, ys = xs.ravel(), ys.ravel()
+    rows = model.rows_at(xs, ys)
+  else:
+    rows = model.rows_in_bbox(box)
+    xs, ys = model.xs[rows], model.ys[rows]
+  if len(rows) == 0:
+    return image
+
+  ## Colors, as in ViewLayer.particle_params()
+  fill_table = np.array([colors.rgb(specs.color) for specs in model.particle_specs_table] + [colors.rgb(BLANK_FILL)])
+  outline_table = np.array([colors.rgb(specs.color) for specs in model.body_specs_table] + [colors.rgb(BLANK_OUTLINE)])
+  ptypes, bodies = np.empty(len(rows), dtype = np.int32), np.empty(len(rows), dtype = np.int32)
+  ptypes.fill(-1)
+  bodies.fill(-1)
+  occupied = rows >= 0
+  ptypes[occupied] = model.particle_type_ids[rows[occupied]]
+  bodies[occupied] = model.body_ids[rows[occupied]]
+  fills, outlines = fill_table[ptypes], outline_table[bodies]
+  if faded:
+    fills = (fills + 255) // 2
+    outlines = (outlines + 255) // 2
+
+  pxs, pys = grid.gridcoords_to_pixels(xs, ys, diameter)
+  pxs = np.round(pxs - x0).astype(np.int64)
+  pys = np.round(pys - y0).astype(np.int64)
+  disc_size = max(1, int(round(diameter)))
+  selected = None if selected_mask == None else selected_mask(xs, ys)
+  if selected is None:
+    selected = np.zeros(len(rows), dtype = np.bool_)
+  for width, cells in ((2, ~selected), (4, selected)):
+    if not cells.any():
+      continue
+    inside, outline = disc_offsets(disc_size, width)
+    _stamp(image, pxs[cells], pys[cells], inside, fills[cells])
+    _stamp(image, pxs[cells], pys[cells], outline, outlines[cells])
+  return image
+
+def render_blocks(image, model, x0, y0, diameter, box, block_size, style, faded):
+  """ Draws the part of the model in the grid coordinate bounding box onto the image at a lower level of detail,
+  as blocks of block_size x block_size cells. See render_image(). """
+  height, width = image.shape[:2]
+  xs, ys, type_counts = model.aggregate_blocks(box, block_size)
+  if len(xs) == 0:
+    return image
+
+  ## Color of each block
+  counts = type_counts.sum(axis = 1)
+  density = counts / float(block_size * block_size)
+  background = np.array(BACKGROUND, dtype = float)
+  if style == 'density':
+    block_colors = background + (np.array(DENSITY_COLOR) - background) * density[:, np.newaxis]
+  else:
+    type_colors = np.array([colors.rgb(specs.color) for specs in model.particle_specs_table], dtype = float)
+    majority = type_counts.argmax(axis = 1)
+    mixed = type_counts.dot(type_colors) / counts[:, np.newaxis]
+    block_colors = np.where((type_counts.max(axis = 1) * 2 > counts)[:, np.newaxis], type_colors[majority], mixed)
+    block_colors = background + (block_colors - background) * (0.5 + 0.5 * density)[:, np.newaxis]
+  if faded:
+    block_colors = (block_colors + 255) / 2
+  block_colors = np.round(block_colors).astype(np.uint8)
+
+  ## Look up the block containing each pixel of the image in a grid of the blocks overlapping it
+  bx0, by0 = box[0] // block_size, box[1] // block_size
+  nbx, nby = (box[2] - 1) // block_size - bx0 + 1, (box[3] - 1) // block_size - by0 + 1
+  blocks = np.empty((nbx, nby), dtype = np.int64)
+  blocks.fill(-1)
+  blocks[xs // block_size - bx0, ys // block_size - by0] = np.arange(len(xs))
+  pys, pxs = np.mgrid[0:height, 0:width] + 0.5
+  gxs, gys = model.grid.pixels_to_gridcoords(pxs + x0, pys + y0, diameter)
+  bxs, bys = gxs // block_size - bx0, gys // block_size - by0
+  inside = (bxs >= 0) & (bxs < nbx) & (bys >= 0) & (bys < nby)
+  pixel_blocks = np.empty((height, width), dtype = np.int64)
+  pixel_blocks.fill(-1)
+  pixel_blocks[inside] = blocks[bxs[inside], bys[inside]]
+  drawn = pixel_blocks >= 0
+  image[drawn] = block_colors[pixel_blocks[drawn]]
+  return image
+
+def _stamp(image, pxs, pys, offsets, values):
+  """ Paints the pixel offsets around each (pxs[i], pys[i]) in values[i]. """
+  dys, dxs = offsets
+  if len(dys) == 0:
+    return
+  ys = (pys[:, np.newaxis] + dys[np.newaxis, :]).ravel()
+  xs = (pxs[:, np.newaxis] + dxs[np.newaxis, :]).ravel()
+  values = np.repeat(values, len(dys), axis = 0)
+  height, width = image.shape[:2]
+  inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+  image[ys[inside], xs[inside]] = values[inside]
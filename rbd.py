@@ -1,13 +1,15 @@
 import Tkinter as tk
 import ttk
 import tkFileDialog
+import os
 
 from design_box import DesignBox
 from tool_box import ToolBox
 # from Operation import Operation
 from model import Model
 import rbd_io
-import utils
+import instrument
+import event_store
 
 sticky_all = tk.N + tk.S + tk.W + tk.E
 
@@ -16,10 +18,14 @@ sticky_all = tk.N + tk.S + tk.W + tk.E
 #  <<Brush>>           changes to currently selected brush
 #  <<ParticleSpecs>>   changes to characteristics of a particular particle type (i.e. name, color)
 #  <<BodySpecs>>       changes to characteristics of a particular body type (i.e. color)
-#  <<Model>>           changes to a Model object (adding/removing/painting particles)
 #  <<ModelSelect>>     new model selected for editing
+#  <<ModelRemove>>     model removed from the list of models
 # Bind a widget to these events just as you would an ordinary event:
 #  widget.bind('<<Brush>>', handler_function)
+# Generate them with a payload with event_store.generate(), and read the payload in the handler
+# with event_store.receive(event)
+# Changes to a Model object (adding/removing/painting particles) are not events: views subscribe to the
+# models they show with Model.subscribe(), and editors announce their changes with Model.notify()
 #
 # Make Application query-able for global model-editing properties
 #   get_brush()
@@ -38,11 +44,15 @@ class Application(tk.Frame):
 
     self.layoutWidgets()
 
-    self.event_generate('<<Brush>>', state=utils.event_data_register(self.get_brush()))
+    event_store.generate(self, '<<Brush>>', self.get_brush())
 
     # Set focusing properties so the DesignCanvas is usually in focus
     self.bind_all('<ButtonPress-1>', self.handle_focus, add='+')
 
+    # F12 shows the instrumentation overlay
+    self.stats_overlay = None
+    self.bind_all('<F12>', self.toggle_stats_overlay, add='+')
+
   def initWidgets(self):
     self.design_box = DesignBox(self)
     self.tool_box = ToolBox(self, self.export_data, self.import_data)
@@ -113,10 +123,20 @@ class Application(tk.Frame):
     focus_allowed = ['Entry']
     if event.widget.winfo_class() not in focus_allowed:
       self.design_box.canvas.focus_set()
-    print event.widget.winfo_class(), self.focus_get()
+
+  def toggle_stats_overlay(self, event = None):
+    if self.stats_overlay != None and self.stats_overlay.winfo_exists():
+      self.stats_overlay.destroy()
+      self.stats_overlay = None
+    else:
+      self.stats_overlay = instrument.StatsOverlay(self)
+
 
 
 
+## Set RBD_STATS to a log file path to turn on instrumentation; the stats are written to it on exit
+if os.environ.get('RBD_STATS'):
+  instrument.enable(os.environ['RBD_STATS'])
 
 app = Application()
 
@@ -125,3 +145,5 @@ app.master.title('Rigid Body Designer')
 
 app.mainloop()
 app.quit()
+if instrument.enabled:
+  instrument.dump()
@@ -1,8 +1,12 @@
 import random, math
 import xml.parsers.expat
 
+import numpy as np
+
 from brush import Brush
 from model import Model, Particle
+import body_analysis
+import instrument
 
 def random_position(model, box_width, box_height):
   angle = random.uniform(0, 2*math.pi)
@@ -14,18 +18,19 @@ def random_position(model, box_width, box_height):
 def transform_particle_positions(model, offset_x, offset_y, angle = 0):
   diameter = 1
 
-  particles = model.particles
-  gridcoords = [p.gridcoord for p in particles]
   grid = model.grid
-  bbox = grid.gridcoord_to_pixel_bbox(grid.calc_bbox(gridcoords), diameter)
+  bbox = grid.gridcoord_to_pixel_bbox(model.calc_bbox(), diameter)
   if bbox == None:  return None
 
-  particle_pixel_coords = [grid.gridcoord_to_pixel(gc, diameter) for gc in gridcoords]
-  particle_pos = [(x - bbox[0], y - bbox[1]) for x,y in particle_pixel_coords]
+  ## Pixel positions with a cell diameter of 1 are the continuous positions of the particles,
+  ## whatever the grid's layout
+  xs, ys = grid.gridcoords_to_pixels(model.xs, model.ys, diameter)
+  xs = xs - bbox[0]
+  ys = ys - bbox[1]
 
   cosine = math.cos(angle)
   sine = math.sin(angle)
-  transformed_pos = [(x*cosine + y*sine + offset_x, -x*sine + y*cosine + offset_y) for x,y in particle_pos]
+  transformed_pos = zip((xs*cosine + ys*sine + offset_x).tolist(), (-xs*sine + ys*cosine + offset_y).tolist())
 
   #print "Angle =", angle
   #print "Offset = ({0}, {1})".format(offset_x, offset_y)
@@ -47,7 +52,7 @@ def calc_model_lattice_positions(models, copies):
   max_width = 0
   for model, num_copies in zip(models, copies):
     grid = model.grid
-    bbox = grid.gridcoord_to_pixel_bbox(grid.calc_bbox(list(model.points_iterator())), diameter)
+    bbox = grid.gridcoord_to_pixel_bbox(model.calc_bbox(), diameter)
     model_width = bbox[2] - bbox[0]
     model_height = bbox[3] - bbox[1]
     model_sizes[model] = (model_width, model_height)
@@ -77,11 +82,23 @@ def calc_model_lattice_positions(models, copies):
   return ((width, height), lattice_positions)
 
 
+def model_body_indices(model):
+  """ Returns an array holding the BodySpecs index of each particle, in the model's row order. """
+  table = np.array([specs.idx for specs in model.body_specs_table] or [0], dtype = np.int64)
+  return table[model.body_ids]
+
+@instrument.timed('io.export_xml')
 def export_xml(path, models, copies):
-  tot_particles = sum([num_copies * len(model.particles) for model, num_copies in zip(models, copies)])
+  tot_particles = sum([num_copies * len(model) for model, num_copies in zip(models, copies)])
   print "Exporting to", path
   print "Total number of particles:", tot_particles
 
+  for i, model in enumerate(models):
+    report = body_analysis.analyze_bodies(model)
+    if not report.ok:
+      print "Warning: model {0} has non-contiguous bodies:".format(i)
+      print report.summary()
+
   size, lattice_positions = calc_model_lattice_positions(models, copies)
   print "Box dimensions:", size
   lattice_positions = iter(lattice_positions)
@@ -104,19 +121,20 @@ def export_xml(path, models, copies):
   out.write('<body num="{0}">\n'.format(tot_particles))
   idx_offset = 0
   for model, num_copies in zip(models, copies):
-    num_bodies = len(set([p.body_specs.idx for p in model.particles]))
+    body_idx = model_body_indices(model)
+    num_bodies = len(set([specs.idx for specs in model.body_specs_in_use()]))
     print "Number of rigid bodies in model ({0} copies):".format(num_copies), num_bodies
     for i in range(num_copies):
-      for p in model.particles:
-        out.write('{0}\n'.format(p.body_specs.idx + idx_offset))
+      out.write(''.join(['{0}\n'.format(idx) for idx in (body_idx + idx_offset).tolist()]))
       idx_offset = idx_offset + num_bodies
   out.write('</body>\n')
 
   out.write('<type num="{0}">\n'.format(tot_particles))
   for model, num_copies in zip(models, copies):
+    names = [specs.name + '\n' for specs in model.particle_specs_table]
+    type_lines = ''.join([names[t] for t in model.particle_type_ids.tolist()])
     for i in range(num_copies):
-      for p in model.particles:
-        out.write(p.particle_specs.name + '\n')
+      out.write(type_lines)
   out.write('</type>\n')
 
   out.write('<diameter num="{0}">\n'.format(tot_particles))
@@ -128,6 +146,7 @@ def export_xml(path, models, copies):
 
   out.close()
 
+@instrument.timed('io.export_rbd')
 def export_rbd(path, models, particle_specs, body_specs):
   out = open(path, 'w')
 
@@ -141,7 +160,7 @@ def export_rbd(path, models, particle_specs, body_specs):
     particles = model.particles
     grid = model.grid
     grid_type = grid.grid_type
-    box = grid.calc_bbox([p.gridcoord for p in particles])
+    box = model.calc_bbox()
     out.write('<model index="{0}" grid_type="{1}" bbox="{2}">\n'.format(i, grid_type, box))
     for particle in particles:
       gridcoord = particle.gridcoord
@@ -151,6 +170,7 @@ def export_rbd(path, models, particle_specs, body_specs):
     out.write('</model>\n')
   out.write('</rbd>\n')
 
+@instrument.timed('io.import_rbd')
 def import_rbd(path, rbd):
   model_data = []
   model_particles = []
@@ -188,6 +208,8 @@ def import_rbd(path, rbd):
   p.StartElementHandler = process_node_start
   p.ParseFile(open(path, 'r'))
 
+  ## The undo history belongs to the models being replaced
+  design_box.canvas.journal.clear()
   tool_box.set_particle_specs(particle_specs)
   tool_box.set_body_specs(body_specs)
 
@@ -0,0 +1,240 @@
+import random
+import unittest
+
+import numpy as np
+
+from brush import Brush
+from model import Model
+from journal import Journal
+
+""" Tests of undo/redo with the Journal, and of the Model methods it relies on: type_ids_at(), set_type_ids_at()
+and transaction(). Random edits are checked against a history of the model's states, and the model's indexes
+against ones recomputed from its particles. Run with python -m unittest test_journal """
+
+PARTICLE_SPECS = [Brush.ParticleSpecs(name = 'P{0}'.format(i), color = '#F0{0}'.format(i)) for i in range(3)]
+BODY_SPECS = [Brush.BodySpecs(idx = i, color = '#0F{0}'.format(i)) for i in range(3)]
+
+## Random edits are made within a square of this many cells on a side
+SIDE = 24
+
+def model_state(model):
+  """ Returns a dict mapping the grid coordinate of each particle of the model to its specs. """
+  return dict([(p.gridcoord, (p.particle_specs, p.body_specs)) for p in model.particles])
+
+def random_edit(model, rng, journal = None):
+  """ Paints or erases a random set of cells of the model, as a brush stroke or a merged layer would,
+  recording the edit in the journal if one is given. Returns the Delta committed, if any. """
+  gridcoords = set([(rng.randrange(SIDE), rng.randrange(SIDE)) for i in range(rng.randint(1, 30))])
+  delta = journal.begin(model, gridcoords, 'edit') if journal != None else None
+  with model.transaction():
+    for gridcoord in gridcoords:
+      if rng.random() < 0.3:
+        model.remove_particle(gridcoord)
+      else:
+        model.add_particle(gridcoord, rng.choice(PARTICLE_SPECS), rng.choice(BODY_SPECS))
+  return journal.commit(delta) if journal != None else None
+
+class ModelIndexesMixin(object):
+
+  def assertIndexesConsistent(self, model):
+    """ Checks the model's indexes against the ones recomputed from its particles. """
+    state = model_state(model)
+    gridcoords = state.keys()
+    self.assertEqual(len(model), len(state))
+    if len(gridcoords) == 0:
+      self.assertEqual(model.calc_bbox(), None)
+    else:
+      xs, ys = zip(*gridcoords)
+      self.assertEqual(model.calc_bbox(), (min(xs), min(ys), max(xs) + 1, max(ys) + 1))
+    for axis in (0, 1):
+      histogram = dict()
+      for gridcoord in gridcoords:
+        histogram[gridcoord[axis]] = histogram.get(gridcoord[axis], 0) + 1
+      self.assertEqual(model.axis_histogram(axis), histogram)
+    for specs in PARTICLE_SPECS:
+      self.assertEqual(set(model.particle_type_gridcoords(specs)), set([gc for gc in gridcoords if state[gc][0] is specs]))
+    for specs in BODY_SPECS:
+      self.assertEqual(set(model.body_gridcoords(specs)), set([gc for gc in gridcoords if state[gc][1] is specs]))
+    for gridcoord in gridcoords:
+      self.assertTrue(model.has_particle(gridcoord))
+    self.assertEqual(set(model.particles_in_bbox((0, 0, SIDE, SIDE))), set(gridcoords))
+
+
+class TestTypeIds(unittest.TestCase, ModelIndexesMixin):
+
+  def test_round_trip(self):
+    rng = random.Random(1)
+    source, model = Model(), Model()
+    for i in range(5):
+      random_edit(source, rng)
+      random_edit(model, rng)
+    xs, ys = np.meshgrid(np.arange(SIDE), np.arange(SIDE))
+    xs, ys = xs.ravel(), ys.ravel()
+    ## Both models hold the same specs objects, registered in their own order, so ids are translated by specs
+    ptypes, bodies = source.type_ids_at(xs, ys)
+    ptype_ids = np.array([-1 if t < 0 else model._particle_specs_id(source.particle_specs_table[t]) for t in ptypes.tolist()])
+    body_ids = np.array([-1 if b < 0 else model._body_specs_id(source.body_specs_table[b]) for b in bodies.tolist()])
+    model.set_type_ids_at(xs, ys, ptype_ids, body_ids)
+    self.assertEqual(model_state(model), model_state(source))
+    self.assertIndexesConsistent(model)
+
+  def test_empty_cells(self):
+    model = Model()
+    model.add_particle((1, 2), PARTICLE_SPECS[0], BODY_SPECS[1])
+    ptypes, bodies = model.type_ids_at([1, 2, 1000], [2, 2, -1000])
+    self.assertEqual(ptypes.tolist(), [0, -1, -1])
+    self.assertEqual(bodies.tolist(), [0, -1, -1])
+
+
+class TestTransaction(unittest.TestCase, ModelIndexesMixin):
+
+  def test_matches_direct_edits(self):
+    rng = random.Random(2)
+    for trial in range(20):
+      direct, batched = Model(), Model()
+      for i in range(5):
+        ops = [(rng.random() < 0.3, (rng.randrange(SIDE), rng.randrange(SIDE)), rng.choice(PARTICLE_SPECS), rng.choice(BODY_SPECS))
+            for j in range(rng.randint(1, 60))]
+        for erase, gridcoord, particle_specs, body_specs in ops:
+          if erase:  direct.remove_particle(gridcoord)
+          else:  direct.add_particle(gridcoord, particle_specs, body_specs)
+        with batched.transaction():
+          for erase, gridcoord, particle_specs, body_specs in ops:
+            if erase:  batched.remove_particle(gridcoord)
+            else:  batched.add_particle(gridcoord, particle_specs, body_specs)
+        self.assertEqual(model_state(batched), model_state(direct))
+        self.assertIndexesConsistent(batched)
+
+  def test_one_notification(self):
+    model = Model()
+    changes = []
+    model.subscribe(changes.append)
+    with model.transaction():
+      with model.transaction():
+        model.add_particle((0, 0), PARTICLE_SPECS[0], BODY_SPECS[0])
+        model.notify([(0, 0)])
+      model.add_particle((3, 4), PARTICLE_SPECS[1], BODY_SPECS[1])
+      model.notify([(3, 4)])
+      self.assertEqual(changes, [])
+    self.assertEqual(len(changes), 1)
+    self.assertEqual(set(changes[0].gridcoords), set([(0, 0), (3, 4)]))
+
+
+class TestJournal(unittest.TestCase, ModelIndexesMixin):
+
+  def test_random_undo_redo(self):
+    """ Random edits, undos and redos, checked against the history of the model's states. """
+    rng = random.Random(3)
+    journal = Journal()
+    model = Model()
+    history = [model_state(model)] # states the model can be undone to, the current one last
+    future = [] # states the model can be redone to, the next one last
+    for step in range(300):
+      action = rng.random()
+      if action < 0.5:
+        if random_edit(model, rng, journal) != None:
+          history.append(model_state(model))
+          future = []
+      elif action < 0.8:
+        self.assertEqual(journal.can_undo(model), len(history) > 1)
+        if journal.undo(model) != None:
+          future.append(history.pop())
+      else:
+        self.assertEqual(journal.can_redo(model), len(future) > 0)
+        if journal.redo(model) != None:
+          history.append(future.pop())
+      self.assertEqual(model_state(model), history[-1])
+    self.assertIndexesConsistent(model)
+
+  def test_unchanged_edit_not_recorded(self):
+    journal = Journal()
+    model = Model()
+    model.add_particle((0, 0), PARTICLE_SPECS[0], BODY_SPECS[0])
+    delta = journal.begin(model, [(0, 0), (1, 1)])
+    model.add_particle((0, 0), PARTICLE_SPECS[0], BODY_SPECS[0])
+    self.assertEqual(journal.commit(delta), None)
+    self.assertFalse(journal.can_undo(model))
+
+  def test_models_have_separate_histories(self):
+    rng = random.Random(4)
+    journal = Journal()
+    a, b = Model(), Model()
+    a_states = [model_state(a)]
+    for i in range(3):
+      while random_edit(a, rng, journal) == None:
+        pass
+      a_states.append(model_state(a))
+    journal.undo(a)
+    while random_edit(b, rng, journal) == None:
+      pass
+    ## Editing b neither hides a's history nor empties its redo stack
+    self.assertTrue(journal.can_redo(a))
+    journal.redo(a)
+    self.assertEqual(model_state(a), a_states[-1])
+    for state in reversed(a_states[:-1]):
+      journal.undo(a)
+      self.assertEqual(model_state(a), state)
+    self.assertFalse(journal.can_undo(a))
+    self.assertTrue(journal.can_undo(b))
+
+  def test_discard_and_eviction(self):
+    journal = Journal()
+    a, b = Model(), Model()
+    def paint(model, row, cells = 5):
+      """ Paints a row of new cells, so deltas of the same number of cells have the same size. """
+      gridcoords = [(x, row) for x in range(cells)]
+      delta = journal.begin(model, gridcoords)
+      for gridcoord in gridcoords:
+        model.add_particle(gridcoord, PARTICLE_SPECS[0], BODY_SPECS[0])
+      return journal.commit(delta)
+    deltas = [paint(model, row) for row, model in enumerate((a, b, a, b))]
+    size = deltas[0].nbytes
+    self.assertEqual(journal.nbytes, 4 * size)
+
+    ## The oldest delta goes first, whatever its model
+    journal.max_bytes = 4 * size
+    paint(b, 4)
+    self.assertEqual(journal.nbytes, 4 * size)
+    self.assertTrue(journal.undo(a) is deltas[2])
+    self.assertFalse(journal.can_undo(a))
+
+    journal.discard(b)
+    self.assertFalse(journal.can_undo(b))
+    self.assertEqual(journal.nbytes, size)
+    journal.redo(a)
+    journal.clear()
+    self.assertFalse(journal.can_undo(a) or journal.can_redo(a))
+    self.assertEqual(journal.nbytes, 0)
+
+    ## Undone deltas are evicted too, rather than crowding out the edit just made
+    big = paint(a, 10, cells = 1000)
+    journal.max_bytes = big.nbytes + 1
+    journal.undo(a)
+    paint(b, 10)
+    self.assertTrue(journal.can_undo(b))
+    self.assertFalse(journal.can_redo(a))
+    self.assertTrue(journal.nbytes <= journal.max_bytes)
+
+    ## A redo stack loses the delta to be redone last, so the others can still be redone in order
+    journal.clear()
+    journal.max_bytes = 3 * size
+    undone = [paint(a, row) for row in (20, 21, 22)]
+    states = [model_state(a)]
+    for i in range(3):
+      journal.undo(a)
+      states.append(model_state(a))
+    paint(b, 20)
+    self.assertEqual(journal.nbytes, 3 * size)
+    self.assertTrue(journal.redo(a) is undone[0])
+    self.assertEqual(model_state(a), states[2])
+    self.assertTrue(journal.redo(a) is undone[1])
+    self.assertEqual(model_state(a), states[1])
+    self.assertFalse(journal.can_redo(a))
+
+    ## The delta being committed is kept, even alone over max_bytes
+    journal.max_bytes = 1
+    paint(b, 30)
+    self.assertTrue(journal.can_undo(b))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,7 +1,7 @@
 import Tkinter as tk
 import ttk
 
-import utils
+import event_store
 from tools import ModelSelectBox, BrushSelectBox, BrushEditBox, IOBox, OperationBox
 
 
@@ -24,7 +24,8 @@ class ToolBox(tk.Frame):
     self.rowconfigure(0, weight = 1)
     self.columnconfigure(0, weight = 1)
 
-    self.models_box = ModelSelectBox(master = self, callback = self.model_select_callback)
+    self.models_box = ModelSelectBox(master = self, callback = self.model_select_callback,
+      remove_callback = self.model_remove_callback)
     self.brush_box = BrushSelectBox(master = self, callback = self.brush_select_callback)
     self.edit_box = BrushEditBox(master = self,
       particlespecs_callback = self.particle_specs_change_callback,
@@ -60,19 +61,20 @@ class ToolBox(tk.Frame):
 
 
   def model_select_callback(self, data = None):
-    self.event_generate('<<ModelSelect>>', state = utils.event_data_register(data))
+    event_store.generate(self, '<<ModelSelect>>', data)
     print 'Generated <<ModelSelect>> event:', data
+  def model_remove_callback(self, data = None):
+    event_store.generate(self, '<<ModelRemove>>', data)
 
   def brush_select_callback(self, data = None):
-    key = utils.event_data_register(data)
-    self.event_generate('<<Brush>>', state = key)
+    event_store.generate(self, '<<Brush>>', data)
     print 'Generated <<Brush>> event:', data
 
   def particle_specs_change_callback(self, data = None):
-    self.event_generate('<<ParticleSpecs>>', state = utils.event_data_register(data))
+    event_store.generate(self, '<<ParticleSpecs>>', data)
     print 'Generated <<ParticleSpecs>> event:', data
 
   def body_specs_change_callback(self, data = None):
-    self.event_generate('<<BodySpecs>>', state = utils.event_data_register(data))
+    event_store.generate(self, '<<BodySpecs>>', data)
     print 'Generated <<BodySpecs>> event:', data
     
\ No newline at end of file
@@ -6,9 +6,10 @@ import itertools as it
 import re
 
 from model import Model
-from model_canvas import ModelCanvas
 from brush import Brush
-import utils
+import event_store
+import colors
+import raster
 
 sticky_all = tk.N + tk.S + tk.E + tk.W
 
@@ -18,7 +19,7 @@ def tuple2color(vals):
   return '#' + ''.join(str_vals)
 
 class ModelSelectBox(tk.Frame):
-  def __init__(self, master, callback):
+  def __init__(self, master, callback, remove_callback = None):
     tk.Frame.__init__(self, master)
 
     self.callback = callback
@@ -26,7 +27,7 @@ class ModelSelectBox(tk.Frame):
     self.rowconfigure(0, weight = 1)
     self.columnconfigure(0, weight = 1)
 
-    self.listbox = self.ModelsList(self, callback)
+    self.listbox = self.ModelsList(self, callback, remove_callback)
     self.listbox.grid(row = 0, column = 0, sticky = sticky_all)
 
     self.add_button = tk.Button(self, text = '+', command = self.listbox.add_model)
@@ -59,10 +60,11 @@ class ModelSelectBox(tk.Frame):
 
 
   class ModelsList(tk.Canvas):
-    def __init__(self, master, callback):
+    def __init__(self, master, callback, remove_callback = None):
       tk.Canvas.__init__(self, master, highlightthickness = 0)
 
       self.callback = callback
+      self.remove_callback = remove_callback # called with each model removed from the list
 
       self.frame = tk.Frame(self)
       self.elements = []
@@ -97,10 +99,12 @@ class ModelSelectBox(tk.Frame):
       else:
         return self.elements[self.cur_idx]
     def remove_element(self, idx):
-      self.elements[idx].grid_forget()
-      del self.elements[idx]
+      elem = self.elements.pop(idx)
+      ## Destroying the element destroys its thumbnail, which stops following the model
+      elem.destroy()
       if self.cur_idx >= len(self.elements):
         self.cur_idx = len(self.elements) - 1
+      if self.remove_callback != None:  self.remove_callback(elem.model)
     def select_element(self, idx):
       self.elements[self.cur_idx]['bg'] = '#CCCCCC'
       #self.elements[self.cur_idx].update_thumbnail()
@@ -113,13 +117,25 @@ class ModelSelectBox(tk.Frame):
     def get_elements(self):
       return self.elements[:]
     def clear_elements(self):
-      for elem in self.elements:
-        elem.grid_forget()
-      self.elements = []
+      elements, self.elements = self.elements, []
       self.cur_idx = -1
+      for elem in elements:
+        elem.destroy()
+        if self.remove_callback != None:  self.remove_callback(elem.model)
 
     def handle_resize(self, event):
       self.itemconfigure('frame', width = event.width)
+      self.refresh_thumbnails()
+
+    def yview(self, *args):
+      """ Extends Canvas.yview() to refresh the thumbnails scrolled into view. """
+      result = tk.Canvas.yview(self, *args)
+      if len(args) > 0:  self.refresh_thumbnails()
+      return result
+
+    def refresh_thumbnails(self):
+      for elem in self.elements:
+        elem.thumbnail.schedule_refresh()
 
     class ModelsListElement(tk.Frame):
       def __init__(self, master, model = None):
@@ -131,17 +147,12 @@ class ModelSelectBox(tk.Frame):
 
         self.columnconfigure(1, weight = 1)
 
-        self.thumbnail = ModelCanvas(self, mode = 'view', model = model)
-        self.thumbnail.configure(width = 100, height = 100)
-        #self.thumbnail.set_model(model)
-        self.thumbnail.padding = 5
+        self.thumbnail = ModelThumbnail(self, model, viewport = master.master, width = 100, height = 100, padding = 5)
         self.thumbnail.grid(row = 0, column = 0, sticky = sticky_all)
 
         self.copies_entry = tk.Entry(self, textvariable = self.copies_var)
         self.copies_entry.grid(row = 0, column = 1, sticky = tk.E + tk.W)
 
-        #self.bind_all('<<Model>>', lambda e: self.update_thumbnail(), add='+')
-
       @property
       def model(self):
       	return self._model
@@ -158,7 +169,86 @@ class ModelSelectBox(tk.Frame):
       	self.copies_var.set(num)
 
       def update_thumbnail(self):
-        pass
+        self.thumbnail.refresh()
+
+class ModelThumbnail(tk.Label):
+  """ Shows a model zoomed to fit in a small image, e.g. in the list of models.
+  The image is rendered offscreen by raster.render_thumbnail() rather than drawn with canvas items, and is
+  only rendered again when the model's version (or the colors of its types) has changed since it was last drawn.
+  The thumbnail subscribes to changes of its model (see Model.subscribe()), and refreshes are debounced: a burst of edits
+  redraws the thumbnail once, refresh_delay milliseconds after the last of them. A thumbnail scrolled out
+  of its viewport (a scrolling canvas containing it) is not drawn until it is scrolled back into view. """
+
+  refresh_delay = 300 # milliseconds
+
+  def __init__(self, master, model, viewport = None, width = 100, height = 100, padding = 0):
+    tk.Label.__init__(self, master, bd = 0, highlightthickness = 0, bg = '#FFF')
+    self._model = model
+    self.viewport = viewport
+    self.padding = padding
+    self._photo = tk.PhotoImage(master = self, width = width, height = height)
+    self['image'] = self._photo
+    self._drawn_key = None
+    self._refresh_id = None
+
+    if model != None:  model.subscribe(self.handle_model_change)
+    self.bind('<Destroy>', self.handle_destroy, add = '+')
+    self.bind('<Map>', lambda e: self.schedule_refresh(), add = '+')
+    self.schedule_refresh()
+
+  @property
+  def model(self):
+    return self._model
+  def set_model(self, model):
+    if self._model != None:  self._model.unsubscribe(self.handle_model_change)
+    self._model = model
+    if model != None:  model.subscribe(self.handle_model_change)
+    self.schedule_refresh()
+
+  def handle_model_change(self, change):
+    self.schedule_refresh()
+  def handle_destroy(self, event):
+    if event.widget is self:
+      if self._model != None:  self._model.unsubscribe(self.handle_model_change)
+      if self._refresh_id != None:
+        self.after_cancel(self._refresh_id)
+        self._refresh_id = None
+
+  def schedule_refresh(self):
+    """ Refreshes the thumbnail refresh_delay milliseconds from now, unless another refresh is scheduled before then. """
+    if self._refresh_id != None:
+      self.after_cancel(self._refresh_id)
+    self._refresh_id = self.after(self.refresh_delay, self.refresh)
+
+  def refresh(self):
+    """ Draws the model again if it has changed since it was last drawn and the thumbnail is in view. """
+    if self._refresh_id != None:
+      self.after_cancel(self._refresh_id)
+      self._refresh_id = None
+    key = self.draw_key()
+    if key == self._drawn_key or not self.in_view():
+      return
+    width, height = self._photo.width(), self._photo.height()
+    image = raster.render_thumbnail(self.model, width, height, self.padding)
+    self._photo.configure(data = raster.photo_data(image), format = 'PPM')
+    self._drawn_key = key
+
+  def draw_key(self):
+    """ Returns a key that changes whenever the thumbnail would look different. """
+    model = self.model
+    return (model.version, tuple([specs.color for specs in model.particle_specs_table]),
+        tuple([specs.color for specs in model.body_specs_table]))
+
+  def in_view(self):
+    """ Returns True iff the thumbnail is mapped and part of it is visible in its viewport. """
+    if not self.winfo_ismapped():
+      return False
+    if self.viewport == None:
+      return True
+    top = self.viewport.canvasy(0)
+    bottom = top + self.viewport.winfo_height()
+    y = self.winfo_rooty() - self.viewport.winfo_rooty() + top
+    return y + self.winfo_height() > top and y < bottom
 
 class BrushSelectBox(tk.Frame):
   def __init__(self, master, callback):
@@ -299,6 +389,9 @@ class BrushEditBox(tk.Frame):
   part_color_entry = None
   body_color_entry = None
 
+  part_color = None # last color shown or set for the particle type
+  body_color = None # last color shown or set for the body type
+
   get_brush = None
   # brush_change_callback = None
   def __init__(self, master, particlespecs_callback, bodyspecs_callback):
@@ -335,7 +428,7 @@ class BrushEditBox(tk.Frame):
 
   def handle_brush_event(self, event):
     # brush = self.get_brush()
-    brush = utils.event_data_retrieve(event.state)
+    brush = event_store.receive(event)
 
     if brush.particle_specs == None:
       self.part_name_entry['state'] = tk.DISABLED
@@ -345,6 +438,7 @@ class BrushEditBox(tk.Frame):
       self.part_color_entry['state'] = tk.NORMAL
       self.part_name_var.set(brush.particle_specs.name)
       self.part_color_var.set(brush.particle_specs.color)
+      self.part_color = brush.particle_specs.color
       print brush.particle_specs.color
 
     if brush.body_specs == None:
@@ -352,7 +446,12 @@ class BrushEditBox(tk.Frame):
     else:
       self.body_color_entry['state'] = tk.NORMAL
       self.body_color_var.set(brush.body_specs.color)
+      self.body_color = brush.body_specs.color
 
+  def forget_color(self, old_color, new_color):
+    """ Drops the cached color arithmetic of a color replaced by an edit. """
+    if old_color != None and old_color != new_color:
+      colors.forget(old_color)
   def validate_color(self, color):
     return re.match(r"^#([0-9A-Fa-f]{3}){1,3}$", color)
   def update_particlespecs(self):
@@ -360,11 +459,15 @@ class BrushEditBox(tk.Frame):
       return
     name = self.part_name_var.get()
     color = self.part_color_var.get()
+    self.forget_color(self.part_color, color)
+    self.part_color = color
     self.particlespecs_callback(dict(name = name, color = color))
   def update_bodyspecs(self):
     if not self.validate_color(self.body_color_var.get()):
       return
     color = self.body_color_var.get()
+    self.forget_color(self.body_color, color)
+    self.body_color = color
     self.bodyspecs_callback(dict(color = color))
 
 
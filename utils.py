@@ -39,6 +39,20 @@ def box_intersection(box1, box2):
       return None
     else:
       return intersection
+def box_subtract(box1, box2):
+  """ Returns a list of disjoint boxes that together cover the part of box1 outside box2. """
+  if box1 == None:
+    return []
+  inner = box_intersection(box1, box2)
+  if inner == None:
+    return [box1]
+  boxes = [
+    (box1[0], box1[1], box1[2], inner[1]), # above
+    (box1[0], inner[3], box1[2], box1[3]), # below
+    (box1[0], inner[1], inner[0], inner[3]), # left
+    (inner[2], inner[1], box1[2], inner[3]), # right
+  ]
+  return [b for b in boxes if b[0] < b[2] and b[1] < b[3]]
 
 
 
@@ -53,40 +67,6 @@ def remove_tag(widget, tag):
   new_tags = [t for t in cur_tags if t != tag]
   widget.bindtags(tuple(new_tags))
 
-## Event data communication
-## Because Tkinter fails to implement the Event.data field, it is difficult
-## to communicate information about virtual events important for optimizing
-## certain functions. These functions make this communication possible by
-## allowing widgets to register and retrieve information using a unique,
-## randomly generated integer. This integer should be stored in the state field
-## of the event.
-event_data = dict()
-def event_data_register(data, widget = None, expires = None):
-  """ Registers the given data to a randomly generated integer key, which is returned.
-  If you would like the data to be cleaned up after a certain amount of time, the
-  widget and expires arguments allow you to use widget.after() to schedule the data
-  to be deleted after expires milliseconds. """
-  import random
-  key = random.randint(0,10**6)
-  event_data[key] = data
-
-  ## Optionally delete the event data after a certain amount of time
-  ## This is useful if you're generating a lot of events and need to save memory.
-  ## Note that most events will get handled very quickly, so expiration after
-  ## even a second is probably overkill unless you need to store the data
-  ## long term (in which case you should probably store it somewhere else...) :)
-  if expires != None and widget != None:
-    widget.after(expires, event_data_remove, key)
-
-  return key
-def event_data_retrieve(key):
-  if key in event_data:
-    return event_data[key]
-  else:
-    return None
-def event_data_remove(key):
-  del event_data[key]
-
 def color_str_to_tuple(color_str):
   depth = (len(color_str) - 1)/3
   color_data = []